@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+"""
+Asynchronous replacement for the Selenium scraping in download_items_excels.py
+and files_download.py.
+
+For every term in data/items.csv:
+1) Fetch the neurosynth studies table for the term without a browser. The
+   DataTables JSON endpoint that fills the page is tried first; the
+   server-rendered HTML page is the fallback.
+2) Resolve the DOIs of the PMIDs. PubMed's E-utilities esummary returns up to
+   200 PMIDs per request; PMIDs it does not cover fall back to parsing the
+   PubMed page (the <span class="identifier doi"> used by extract_doi_from_pubmed).
+   PMIDs already in the PMID -> DOI cache (pmid_cache.py) are not requested.
+3) Write ./proc/term_csv/<term>.csv with the same columns as fetch_study_items.
+
+All requests share one aiohttp connection pool. A token bucket per host limits
+the request rate (PubMed allows ~3 requests/s without an API key) instead of
+fixed time.sleep(3) pauses. Failed requests (connection errors, 429, 5xx) are
+retried with exponential back-off and jitter, honouring Retry-After. Hosts are
+parameters, so the fetcher can be run against a local fixture server.
+
+Usage (example):
+  python async_fetcher.py --items_csv ./data/items.csv --out_dir ./proc/term_csv
+  python async_fetcher.py --terms pain memory --base_url http://localhost:8000 \
+    --pubmed_url http://localhost:8000/pubmed --eutils_url http://localhost:8000/eutils
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+from urllib.parse import urlparse, quote
+
+import aiohttp
+import pandas as pd
+from bs4 import BeautifulSoup
+
+from pmid_cache import PmidCache, DEFAULT_CACHE_PATH
+
+
+NEUROSYNTH_URL = "https://neurosynth.org"
+PUBMED_URL = "https://pubmed.ncbi.nlm.nih.gov"
+EUTILS_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+
+# PMIDs per esummary request
+ESUMMARY_BATCH = 200
+
+USER_AGENT = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+              "AppleWebKit/537.36 (KHTML, like Gecko) "
+              "Chrome/120.0.0.0 Safari/537.36")
+
+TERM_CSV_COLUMNS = [
+    "paper_name", "paper_url", "Title", "Author", "Journal", "Loading", "PMID", "Doi", "download_status"
+]
+
+
+class TokenBucket:
+    """
+    Allow `rate` requests per second on average, with bursts of up to `burst`.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncFetcher:
+    """
+    Pooled, rate-limited HTTP GETs with retries. Use as `async with AsyncFetcher(...) as fetcher`.
+
+    Args:
+        concurrency (int): Maximum open connections overall.
+        default_rate (float): Requests per second per host, unless given in `host_rates`.
+        host_rates (dict, optional): {hostname: requests per second}.
+        retries (int): Extra attempts after a failed request.
+        backoff (float): Seconds before the first retry; doubles each time.
+        timeout (float): Total timeout per request in seconds.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 16,
+        default_rate: float = 5.0,
+        host_rates: dict = None,
+        retries: int = 4,
+        backoff: float = 1.0,
+        timeout: float = 30.0
+    ):
+        self.concurrency = concurrency
+        self.default_rate = default_rate
+        self.host_rates = host_rates or {}
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.buckets = {}
+        self.session = None
+        self.n_requests = 0
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={"User-Agent": USER_AGENT},
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    def _bucket(self, url: str) -> TokenBucket:
+        host = urlparse(url).hostname or ""
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.host_rates.get(host, self.default_rate))
+        return self.buckets[host]
+
+    async def get_text(self, url: str, params: dict = None):
+        """
+        Body of `url` as text, or None for 404 and after the last failed retry.
+        """
+        for attempt in range(self.retries + 1):
+            await self._bucket(url).acquire()
+            self.n_requests += 1
+            delay = self.backoff * 2 ** attempt * (1 + random.random())
+            try:
+                async with self.session.get(url, params=params) as response:
+                    if response.status == 200:
+                        return await response.text()
+                    if response.status == 404:
+                        return None
+                    if response.status != 429 and response.status < 500:
+                        print(f"HTTP {response.status} for {url}; not retrying.")
+                        return None
+                    retry_after = response.headers.get("Retry-After", "")
+                    if retry_after.isdigit():
+                        delay = max(delay, float(retry_after))
+                    message = f"HTTP {response.status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                message = repr(exc)
+
+            if attempt < self.retries:
+                print(f"Attempt {attempt + 1} failed for {url} ({message}); retrying in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+        print(f"Giving up on {url} after {self.retries + 1} attempts.")
+        return None
+
+    async def get_json(self, url: str, params: dict = None):
+        text = await self.get_text(url, params)
+        if text is None:
+            return None
+        try:
+            return json.loads(text)
+        except ValueError:
+            return None
+
+
+def _pmid_from_href(href: str) -> str:
+    # e.g. '/studies/12345678/' or 'https://pubmed.ncbi.nlm.nih.gov/12345678/'
+    return href.rstrip("/").split("/")[-1]
+
+
+def parse_studies_json(payload: dict) -> list[dict]:
+    """
+    Rows of a neurosynth DataTables response: [title link HTML, authors, journal, loading].
+    """
+    rows = []
+    for cells in payload.get("data", []):
+        link = BeautifulSoup(str(cells[0]), "html.parser").find("a")
+        if link is None or len(cells) < 4:
+            continue
+        rows.append({
+            "Title": link.get_text(strip=True),
+            "Author": BeautifulSoup(str(cells[1]), "html.parser").get_text(strip=True),
+            "Journal": BeautifulSoup(str(cells[2]), "html.parser").get_text(strip=True),
+            "Loading": BeautifulSoup(str(cells[3]), "html.parser").get_text(strip=True),
+            "PMID": _pmid_from_href(link["href"]),
+        })
+    return rows
+
+
+def parse_studies_html(html: str, table_id: str = "analysis-studies-table") -> list[dict]:
+    """
+    Rows of a server-rendered studies table (same cells as fetch_study_items reads).
+    """
+    table = BeautifulSoup(html, "html.parser").find("table", {"id": table_id})
+    rows = []
+    if table is None:
+        return rows
+    for row in table.find_all("tr")[1:]:
+        cols = row.find_all("td")
+        link = cols[0].find("a") if cols else None
+        if link is None or len(cols) < 4:
+            continue
+        rows.append({
+            "Title": cols[0].get_text(strip=True),
+            "Author": cols[1].get_text(strip=True),
+            "Journal": cols[2].get_text(strip=True),
+            "Loading": cols[3].get_text(strip=True),
+            "PMID": _pmid_from_href(link["href"]),
+        })
+    return rows
+
+
+def parse_pubmed_doi(html: str):
+    """
+    DOI from a PubMed article page, or None.
+    """
+    doi_span = BeautifulSoup(html, "html.parser").find("span", class_="identifier doi")
+    if doi_span is not None and doi_span.find("a") is not None:
+        return doi_span.find("a").text.strip()
+    return None
+
+
+def parse_esummary_dois(payload: dict) -> dict:
+    """
+    {pmid: doi} from an esummary JSON response (PMIDs without a DOI are left out).
+    """
+    dois = {}
+    result = (payload or {}).get("result", {})
+    for pmid in result.get("uids", []):
+        for article_id in result.get(pmid, {}).get("articleids", []):
+            if article_id.get("idtype") == "doi" and article_id.get("value"):
+                dois[pmid] = article_id["value"]
+                break
+    return dois
+
+
+async def fetch_term_studies(fetcher: AsyncFetcher, term: str, base_url: str = NEUROSYNTH_URL) -> list[dict]:
+    """
+    Studies table of one neurosynth term: JSON endpoint first, HTML page as fallback.
+    """
+    payload = await fetcher.get_json(f"{base_url}/api/analyses/{quote(term)}/studies", {"dt": "1"})
+    if payload is not None and payload.get("data"):
+        return parse_studies_json(payload)
+    html = await fetcher.get_text(f"{base_url}/analyses/terms/{quote(term)}/")
+    return parse_studies_html(html) if html is not None else []
+
+
+async def fetch_doi_from_pubmed_page(fetcher: AsyncFetcher, pmid: str, pubmed_url: str = PUBMED_URL):
+    """
+    (page fetched, doi or None) for one PMID.
+    """
+    html = await fetcher.get_text(f"{pubmed_url}/{pmid}/")
+    return (html is not None), (parse_pubmed_doi(html) if html is not None else None)
+
+
+async def resolve_dois(
+    fetcher: AsyncFetcher,
+    pmids: list[str],
+    pubmed_url: str = PUBMED_URL,
+    eutils_url: str = EUTILS_URL,
+    cache: PmidCache = None
+) -> dict:
+    """
+    {pmid: doi or None} for `pmids`: the PMID cache first, then batched
+    esummary, then PubMed pages for the rest. New answers are written back to
+    the cache; PMIDs whose page could not be fetched are not negative-cached.
+    """
+    pmids = list(dict.fromkeys(str(p) for p in pmids))
+    dois = cache.get_many(pmids) if cache is not None else {}
+    pmids = [pmid for pmid in pmids if pmid not in dois]
+    if not pmids:
+        return dois
+
+    batches = [pmids[i:i + ESUMMARY_BATCH] for i in range(0, len(pmids), ESUMMARY_BATCH)]
+    payloads = await asyncio.gather(*[
+        fetcher.get_json(f"{eutils_url}/esummary.fcgi", {"db": "pubmed", "retmode": "json", "id": ",".join(batch)})
+        for batch in batches
+    ])
+    fetched = {}
+    for payload in payloads:
+        fetched.update(parse_esummary_dois(payload))
+    if cache is not None and fetched:
+        cache.put_many(fetched, source="esummary")
+
+    remaining = [pmid for pmid in pmids if pmid not in fetched]
+    pages = await asyncio.gather(*[fetch_doi_from_pubmed_page(fetcher, pmid, pubmed_url) for pmid in remaining])
+    from_pages = {pmid: doi for pmid, (ok, doi) in zip(remaining, pages) if ok}
+    if cache is not None and from_pages:
+        cache.put_many(from_pages, source="pubmed_page")
+
+    dois.update(fetched)
+    dois.update({pmid: doi for pmid, (ok, doi) in zip(remaining, pages)})
+    return dois
+
+
+async def fetch_term(
+    fetcher: AsyncFetcher,
+    term: str,
+    paper_count: int,
+    out_dir: str,
+    base_url: str = NEUROSYNTH_URL,
+    pubmed_url: str = PUBMED_URL,
+    eutils_url: str = EUTILS_URL,
+    cache: PmidCache = None
+) -> int:
+    """
+    Scrape one term and write '<out_dir>/<term>.csv'. Returns the number of rows written.
+    """
+    studies = (await fetch_term_studies(fetcher, term, base_url))[:paper_count]
+    if not studies:
+        print(f"No studies found for term: {term}")
+        return 0
+
+    dois = await resolve_dois(fetcher, [s["PMID"] for s in studies], pubmed_url, eutils_url, cache)
+    rows = []
+    for index, study in enumerate(studies, start=1):
+        rows.append({
+            "paper_name": f"{term}_{str(index).zfill(5)}",
+            "paper_url": f"https://pubmed.ncbi.nlm.nih.gov/{study['PMID']}/",
+            **study,
+            "Doi": dois.get(study["PMID"]) or -1,
+            "download_status": -1,
+        })
+
+    csv_filename = os.path.join(out_dir, f"{term}.csv")
+    pd.DataFrame(rows, columns=TERM_CSV_COLUMNS).to_csv(csv_filename, index=False)
+    print(f"{term}: {len(rows)} studies, {sum(bool(dois.get(s['PMID'])) for s in studies)} DOIs")
+    return len(rows)
+
+
+async def fetch_terms(
+    terms: list[tuple[str, int]],
+    out_dir: str,
+    max_terms: int = 8,
+    overwrite: bool = False,
+    fetcher_kwargs: dict = None,
+    urls: dict = None,
+    cache: PmidCache = None
+) -> dict:
+    """
+    Scrape many (term, paper_count) pairs, `max_terms` at a time, skipping
+    terms whose CSV already exists unless `overwrite`. DOIs are looked up in
+    `cache` (a PmidCache) before any request.
+
+    Returns:
+        dict: {term: rows written, or -1 on error}.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    urls = urls or {}
+    todo = [(t, n) for t, n in terms if overwrite or not os.path.isfile(os.path.join(out_dir, f"{t}.csv"))]
+    print(f"{len(terms) - len(todo)} terms already scraped; fetching {len(todo)}.")
+
+    slots = asyncio.Semaphore(max_terms)
+    results = {}
+    async with AsyncFetcher(**(fetcher_kwargs or {})) as fetcher:
+
+        async def run_one(term, paper_count):
+            async with slots:
+                try:
+                    results[term] = await fetch_term(fetcher, term, paper_count, out_dir, **urls, cache=cache)
+                except Exception as e:
+                    print(f"Error on term {term}: {e}")
+                    results[term] = -1
+
+        start = time.time()
+        await asyncio.gather(*[run_one(term, paper_count) for term, paper_count in todo])
+        print(f"Fetched {len(todo)} terms with {fetcher.n_requests} requests in {time.time() - start:.1f}s.")
+    if cache is not None:
+        cache.report()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fetch neurosynth term study tables and DOIs asynchronously (no browser)."
+    )
+    parser.add_argument("--items_csv", default="./data/items.csv",
+                        help="CSV with term name and paper count in the first two columns.")
+    parser.add_argument("--terms", nargs="*", default=None,
+                        help="Only these terms (paper count taken from --items_csv, else all rows).")
+    parser.add_argument("--out_dir", default="./proc/term_csv", help="Output folder for <term>.csv.")
+    parser.add_argument("--max_terms", type=int, default=8, help="Terms in flight at once. (default=8)")
+    parser.add_argument("--concurrency", type=int, default=16, help="Open connections. (default=16)")
+    parser.add_argument("--rate", type=float, default=5.0, help="Requests/s per host. (default=5)")
+    parser.add_argument("--pubmed_rate", type=float, default=3.0,
+                        help="Requests/s for the NCBI hosts. (default=3, NCBI's limit without an API key)")
+    parser.add_argument("--retries", type=int, default=4, help="Retries per request. (default=4)")
+    parser.add_argument("--overwrite", action="store_true", help="Re-fetch terms whose CSV exists.")
+    parser.add_argument("--cache_db", default=DEFAULT_CACHE_PATH, help="PMID -> DOI cache (see pmid_cache.py).")
+    parser.add_argument("--base_url", default=NEUROSYNTH_URL)
+    parser.add_argument("--pubmed_url", default=PUBMED_URL)
+    parser.add_argument("--eutils_url", default=EUTILS_URL)
+
+    args = parser.parse_args()
+
+    data = pd.read_csv(args.items_csv)
+    counts = {str(row.iloc[0]): int(row.iloc[1]) for _, row in data.iterrows()}
+    if args.terms:
+        terms = [(t, counts.get(t, 10 ** 6)) for t in args.terms]
+    else:
+        terms = list(counts.items())
+
+    host_rates = {
+        urlparse(args.pubmed_url).hostname: args.pubmed_rate,
+        urlparse(args.eutils_url).hostname: args.pubmed_rate,
+    }
+    fetcher_kwargs = {
+        "concurrency": args.concurrency,
+        "default_rate": args.rate,
+        "host_rates": host_rates,
+        "retries": args.retries,
+    }
+    urls = {"base_url": args.base_url, "pubmed_url": args.pubmed_url, "eutils_url": args.eutils_url}
+    cache = PmidCache(args.cache_db)
+    try:
+        asyncio.run(fetch_terms(terms, args.out_dir, args.max_terms, args.overwrite, fetcher_kwargs, urls, cache))
+    finally:
+        cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,9 @@ Scrapes study metadata from neurosynth.org term analysis pages,
 including PubMed PMIDs, and optionally fetches DOIs. 
 
 Output is saved to a CSV for each term listed in a local CSV file (Items.csv).
+
+async_fetcher.py produces the same CSVs without a browser, concurrently and
+rate-limited; this Selenium version is kept for reference.
 """
 
 import os
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Append-only journal of per-paper download state.
+
+pdf_download (files_download.py) used to rewrite the whole accumulated CSV
+after every page, and a crash lost everything since the last rewrite. Instead,
+each finished item is appended as one JSON line and flushed to disk:
+  - Appending one line is cheap however long the scrape runs, and a crash can
+    at most cut the last line short (such a line is ignored on reload).
+  - On restart the journal is replayed (last entry per key wins), so completed
+    PMIDs are skipped.
+  - compact() writes the current state to CSV or Parquet and can rewrite the
+    journal with one line per key.
+
+Usage (example, compact a journal into a CSV):
+  python download_journal.py --journal ./proc/paper_pdfs/download_journal.jsonl \
+    --out ./proc/paper_download_status.csv
+"""
+
+import os
+import json
+import time
+import argparse
+
+import pandas as pd
+
+
+# Value the scrapers record for a missing Doi / pdf_url / status
+MISSING = -1
+
+
+def tabular_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Make mixed-type columns writable to Parquet: in object columns the
+    scrapers' MISSING sentinel (-1) becomes None and every other value a string
+    (e.g. Doi is a DOI string or -1).
+    """
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        values = df[col]
+        missing = values.isna() | values.isin([MISSING, str(MISSING)])
+        df[col] = values.astype(str).where(~missing, None)
+    return df
+
+
+class DownloadJournal:
+    """
+    JSON-lines journal of {key: latest fields}. Use as a context manager.
+
+    Args:
+        path (str): Journal file (created if missing).
+        key (str): Field that identifies an item (default 'PMID').
+        fsync (bool): fsync after every entry, so the entry survives a node crash (default True).
+    """
+
+    def __init__(self, path: str, key: str = "PMID", fsync: bool = True):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.key = key
+        self.fsync = fsync
+        self.state = self._replay()
+        self.file = open(path, "a")
+        # Terminate a line cut short by a crash, so the next entry starts on its own line
+        if self.file.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self.file.write("\n")
+
+    def _replay(self) -> dict:
+        state = {}
+        if not os.path.isfile(self.path):
+            return state
+        with open(self.path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash mid-write
+                    continue
+                state.setdefault(str(entry[self.key]), {}).update(entry)
+        return state
+
+    def record(self, key, **fields) -> None:
+        """
+        Append one entry for `key` and flush it to disk.
+        """
+        entry = {self.key: str(key), **fields, "updated_at": time.time()}
+        self.file.write(json.dumps(entry, default=str) + "\n")
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.state.setdefault(str(key), {}).update(entry)
+
+    def get(self, key) -> dict:
+        return self.state.get(str(key), {})
+
+    def is_done(self, key, field: str = "download_status", done_value=1) -> bool:
+        return self.get(key).get(field) == done_value
+
+    def completed(self, field: str = "download_status", done_value=1) -> set:
+        return {key for key, entry in self.state.items() if entry.get(field) == done_value}
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(list(self.state.values()))
+
+    def compact(self, out_path: str = None, rewrite_journal: bool = False) -> pd.DataFrame:
+        """
+        Write the current state (one row per key) to `out_path` (.parquet or .csv),
+        and optionally replace the journal with one line per key.
+        """
+        df = self.to_frame()
+        if out_path is not None:
+            os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+            if out_path.endswith(".parquet"):
+                tabular_frame(df).to_parquet(out_path, index=False)
+            else:
+                df.to_csv(out_path, index=False)
+
+        if rewrite_journal:
+            self.file.close()
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                for entry in self.state.values():
+                    f.write(json.dumps(entry, default=str) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self.file = open(self.path, "a")
+        return df
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact a download journal into CSV/Parquet.")
+    parser.add_argument("--journal", required=True, help="JSON-lines journal file.")
+    parser.add_argument("--out", required=True, help="Output .csv or .parquet.")
+    parser.add_argument("--key", default="PMID", help="Key field. (default=PMID)")
+    parser.add_argument("--rewrite", action="store_true", help="Also rewrite the journal with one line per key.")
+
+    args = parser.parse_args()
+
+    with DownloadJournal(args.journal, args.key) as journal:
+        df = journal.compact(args.out, rewrite_journal=args.rewrite)
+    print(f"{len(df)} entries written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,12 +6,12 @@ A script to:
 3) Build a PubMed URL for each PMID, parse the resulting page for a DOI, 
 4) Attempt to download the PDF via Sci-Hub.
 
-The results are saved in a CSV file, while PDFs are stored locally if found.
+Progress is appended to a per-PMID journal (download_journal.py) and compacted
+into a CSV file at the end, while PDFs are stored locally if found.
 """
 
 import requests
 import time
-import pandas as pd
 from bs4 import BeautifulSoup
 from ipdb import set_trace
 
@@ -21,6 +21,9 @@ from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
 from webdriver_manager.chrome import ChromeDriverManager
 
+from pmid_cache import PmidCache, DEFAULT_CACHE_PATH
+from download_journal import DownloadJournal
+
 
 def get_pdf_from_doi(doi, pdf_name):
     """
@@ -75,13 +78,16 @@ def get_pdf_from_doi(doi, pdf_name):
         return -1, -1
 
 
-def extract_doi_from_pubmed(paper_url, pdf_name):
+def extract_doi_from_pubmed(paper_url, pdf_name, cache=None):
     """
     Given a PubMed page URL, parse for the DOI, then attempt to download the PDF via Sci-Hub.
+    If a PmidCache is given, it is checked before the PubMed page is requested,
+    and the parsed DOI (or its absence) is stored in it.
 
     Args:
         paper_url (str): The full PubMed URL (e.g., "https://pubmed.ncbi.nlm.nih.gov/<PMID>/").
         pdf_name (str): Filename prefix for saving the downloaded PDF.
+        cache (PmidCache, optional): PMID -> DOI cache (see pmid_cache.py).
 
     Returns:
         (doi, download_status, pdf_url):
@@ -89,6 +95,17 @@ def extract_doi_from_pubmed(paper_url, pdf_name):
             download_status (int): 1 if PDF downloaded, -1 otherwise
             pdf_url (str or int): Direct PDF link or -1 if not available
     """
+    pmid = paper_url.rstrip('/').split('/')[-1]
+    if cache is not None:
+        cached, doi_text = cache.get(pmid)
+        if cached and doi_text:
+            print("Cached DOI:", doi_text)
+            download_status, pdf_url = get_pdf_from_doi(doi_text, pdf_name)
+            return doi_text, download_status, pdf_url
+        if cached:
+            print("No DOI for this PMID (cached).")
+            return -1, -1, -1
+
     response = requests.get(paper_url)
     if response.status_code == 200:
         soup = BeautifulSoup(response.text, 'html.parser')
@@ -100,26 +117,37 @@ def extract_doi_from_pubmed(paper_url, pdf_name):
             if doi_anchor:
                 doi_text = doi_anchor.text.strip()
                 print("Found DOI:", doi_text)
+                if cache is not None:
+                    cache.put(pmid, doi_text, source="pubmed_page")
                 download_status, pdf_url = get_pdf_from_doi(doi_text, pdf_name)
                 return doi_text, download_status, pdf_url
 
         print("No DOI element found in PubMed page.")
+        if cache is not None:
+            cache.put(pmid, None, source="pubmed_page")
         return -1, -1, -1
     else:
         print(f"Failed to access PubMed page, status code: {response.status_code}")
         return -1, -1, -1
 
 
-def pdf_download(base_url, start_page, end_page):
+def pdf_download(base_url, start_page, end_page, journal, cache=None):
     """
     Scrape study data from a table at 'base_url' across multiple pages, 
     then parse each study's PMID to get its PubMed page. Next, attempt 
     to extract and download the PDF via Sci-Hub.
 
+    Each study is appended to `journal` as soon as it is processed, and studies
+    whose PDF the journal already records as downloaded are skipped, so an
+    interrupted scrape can be re-run to resume.
+
     Args:
         base_url (str): The initial URL containing the table of studies (e.g., neurosynth.org/studies/).
         start_page (int): The first page index to begin scraping.
         end_page (int): The maximum page index to scrape up to.
+        journal (DownloadJournal): Per-PMID progress journal (see download_journal.py);
+            the only record of the scraped studies, compact it to get the CSV.
+        cache (PmidCache, optional): PMID -> DOI cache checked before each PubMed request.
     """
     # Set Selenium to run in headless mode
     chrome_options = Options()
@@ -133,7 +161,6 @@ def pdf_download(base_url, start_page, end_page):
     driver.get(base_url)
     time.sleep(3)  # wait for page load
 
-    all_study_data = []
     current_page = 0
 
     while current_page < end_page:
@@ -173,26 +200,30 @@ def pdf_download(base_url, start_page, end_page):
                 if len(cells) > 0:
                     title = cells[0].get_text(strip=True)
                     author = cells[1].get_text(strip=True)
-                    journal = cells[2].get_text(strip=True)
+                    journal_name = cells[2].get_text(strip=True)
                     year = cells[3].get_text(strip=True)
                     pmid = cells[4].get_text(strip=True)
 
                     paper_url = "https://pubmed.ncbi.nlm.nih.gov/" + pmid + "/"
                     pdf_name = str(current_page * 10 + row_index).zfill(5)
 
-                    doi_val, status_val, pdf_url_val = extract_doi_from_pubmed(paper_url, pdf_name)
-                    all_study_data.append({
-                        "pdf_name": pdf_name,
-                        "pdf_url": pdf_url_val,
-                        "paper_url": paper_url,
-                        "Title": title,
-                        "Author": author,
-                        "Journal": journal,
-                        "Year": year,
-                        "PMID": pmid,
-                        "Doi": doi_val,
-                        "download_status": status_val
-                    })
+                    # Crash-resume: skip studies already downloaded in an earlier run
+                    if journal.is_done(pmid):
+                        continue
+
+                    doi_val, status_val, pdf_url_val = extract_doi_from_pubmed(paper_url, pdf_name, cache)
+                    journal.record(
+                        pmid,
+                        pdf_name=pdf_name,
+                        pdf_url=pdf_url_val,
+                        paper_url=paper_url,
+                        Title=title,
+                        Author=author,
+                        Journal=journal_name,
+                        Year=year,
+                        Doi=doi_val,
+                        download_status=status_val
+                    )
 
         # Step 3: move to the next page
         try:
@@ -215,11 +246,6 @@ def pdf_download(base_url, start_page, end_page):
             except:
                 break
 
-        # Save partial progress to CSV
-        df = pd.DataFrame(all_study_data)
-        csv_filename = f"D:\\study\\Python_code\\BrainVLM\\PDFs\\excels\\{str(end_page*10).zfill(5)}.csv"
-        df.to_csv(csv_filename, index=False)
-
     driver.quit()
 
 
@@ -230,7 +256,19 @@ def main():
     from page 1 through page 100.
     """
     base_url = "https://neurosynth.org/studies/"
-    pdf_download(base_url, start_page=1, end_page=100)
+    end_page = 100
+    journal_path = "D:\\study\\Python_code\\BrainVLM\\PDFs\\excels\\download_journal.jsonl"
+    csv_filename = f"D:\\study\\Python_code\\BrainVLM\\PDFs\\excels\\{str(end_page*10).zfill(5)}.csv"
+
+    cache = PmidCache(DEFAULT_CACHE_PATH)
+    with DownloadJournal(journal_path) as journal:
+        try:
+            pdf_download(base_url, start_page=1, end_page=end_page, journal=journal, cache=cache)
+        finally:
+            # Compact the journal into the CSV once, instead of rewriting it every page
+            journal.compact(csv_filename)
+            cache.report()
+            cache.close()
 
 
 if __name__ == "__main__":
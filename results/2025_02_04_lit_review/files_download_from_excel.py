@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 """
 A script to manage PDF downloads from direct URLs or Sci-Hub. 
-It reads CSV files listing PDFs to download, tries to fetch them, 
-and updates the CSV with the download status and final URL.
+It works from the deduplicated paper queue built by paper_index.py from the
+per-term CSVs, so each paper is fetched once, and saves PDFs as <PMID>.pdf.
 
 Author: [Your Name]
 Date: [Optional: YYYY-MM-DD]
@@ -12,10 +12,12 @@ import os
 import time
 import random
 import requests
-import pandas as pd
 from bs4 import BeautifulSoup
 from ipdb import set_trace
 
+from paper_index import PaperIndex, download_queue
+from download_journal import DownloadJournal
+
 
 def download_pdf(pdf_url: str, pdf_name: str) -> int:
     """
@@ -117,52 +119,44 @@ def download_pdf_scihub(page_url: str, pdf_name: str) -> tuple:
 def main():
     """
     Main workflow:
-    1. For each CSV in a given directory, load it into a DataFrame.
-    2. Filter rows with download_status == -1, indicating the PDF wasn't previously downloaded.
-    3. Try to download:
-       - If pdf_url != '-1', attempt direct download (download_pdf).
-       - Otherwise, parse Sci-Hub URL using the stored DOI and call download_pdf_scihub.
-    4. Update the CSV with the download status and final URL.
+    1. Load the deduplicated paper index (paper_index.py), building it from
+       ./proc/term_csv if it does not exist yet.
+    2. Walk the unique-paper queue (one row per PMID with a DOI), so a paper
+       listed under many terms is downloaded once.
+    3. Skip papers whose <PMID>.pdf is already in ./proc/paper_pdfs or that the
+       download journal records as done; otherwise build the Sci-Hub URL from
+       the DOI and call download_pdf_scihub.
+    4. Append each outcome to the journal, and compact it into
+       ./proc/paper_download_status.csv at the end (also after a crash or Ctrl-C).
     """
-    path = "./proc/term_csv"
-    excels = os.listdir(path)
-
-    for excel_file in excels:
-        print(f"Processing: {excel_file}")
-        # Skip certain files if needed
-        if excel_file == "01000.csv":
-            continue
-
-        csv_path = os.path.join(path, excel_file)
-        data = pd.read_csv(csv_path)
-        data_copy = data.copy()
-
-        # Filter entries where download_status == -1
-        entries_to_download = data[data["download_status"] == -1]
-
-        for i in range(len(entries_to_download)):
-            pdf_name = str(entries_to_download.iloc[i][0]).zfill(5)
-            pdf_url_candidate = entries_to_download.iloc[i][1]
-
-            if pdf_url_candidate == "-1":
-                # Means we do not have a direct PDF link, so we must use Sci-Hub
-                doi_val = entries_to_download.iloc[i][8]
-                scihub_base_url = "https://sci-hub.st/"
-                page_url = scihub_base_url + doi_val.lower()
-
-                download_status, final_pdf_url = download_pdf_scihub(page_url, pdf_name)
-            else:
-                # We have a direct PDF link
-                download_status = download_pdf(pdf_url_candidate, pdf_name)
-                final_pdf_url = pdf_url_candidate
-
-            # # Update the DataFrame
-            # row_index = (int(entries_to_download.iloc[i][0]) % 1000) - 1
-            # data_copy.iloc[row_index, -1] = download_status  # update download_status column
-            # data_copy.iloc[row_index, 1] = final_pdf_url     # update pdf_url column
-
-        # Save the updated DataFrame
-        # data_copy.to_csv(csv_path, index=False)
+    index_dir = "./proc/paper_index"
+    output_dir = "./proc/paper_pdfs"
+    journal_path = os.path.join(output_dir, "download_journal.jsonl")
+    status_csv = "./proc/paper_download_status.csv"
+    scihub_base_url = "https://sci-hub.st/"
+    os.makedirs(output_dir, exist_ok=True)
+
+    if os.path.isfile(os.path.join(index_dir, "papers.parquet")):
+        index = PaperIndex.load(index_dir)
+    else:
+        index = PaperIndex.build("./proc/term_csv")
+        index.save(index_dir)
+    queue = download_queue(index)
+
+    with DownloadJournal(journal_path) as journal:
+        done = journal.completed()
+        print(f"{len(done)} of {len(queue)} papers already downloaded according to {journal_path}")
+        try:
+            for i, (pmid, paper) in enumerate(queue.iterrows(), start=1):
+                if pmid in done or os.path.isfile(os.path.join(output_dir, f"{pmid}.pdf")):
+                    continue
+                print(f"Processing [{i}/{len(queue)}]: PMID {pmid} ({paper['n_terms']} terms)")
+
+                page_url = scihub_base_url + paper["Doi"].lower()
+                download_status, final_pdf_url = download_pdf_scihub(page_url, pmid)
+                journal.record(pmid, Doi=paper["Doi"], pdf_url=final_pdf_url, download_status=download_status)
+        finally:
+            journal.compact(status_csv)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Cross-term, deduplicated index of the papers in proc/term_csv.
+
+The per-term CSVs list the same paper under many terms (and many paper_names),
+so downloading term by term fetches it many times. This script:
+1) Reads every term CSV (in parallel threads) into one long (term, PMID, Loading) table.
+2) Keeps one row per PMID in a columnar table (papers.parquet): Title, Author,
+   Journal, Doi and the number of terms the paper appears under.
+3) Stores the Loading scores as a sparse term x paper matrix
+   (term_paper_loadings.npz, rows in terms.txt order, columns in papers.parquet order).
+4) Answers "top-k papers for a standardized term" by mapping the standardized
+   term to its raw terms through categorized_terms.csv and ranking the papers
+   by their Loading over those rows.
+
+files_download_from_excel.py downloads from the unique-paper queue (download_queue()).
+
+Usage (example):
+  python paper_index.py --build
+  python paper_index.py --query "Alzheimer's Disease" --k 20
+"""
+
+import os
+import glob
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+TERM_CSV_DIR = "./proc/term_csv"
+INDEX_DIR = "./proc/paper_index"
+CATEGORIES_CSV = "./proc/categorized_terms.csv"
+
+PAPER_COLUMNS = ["PMID", "Title", "Author", "Journal", "Doi"]
+
+
+def _has_doi(doi: pd.Series) -> pd.Series:
+    # The scrapers write -1 when no DOI was found
+    return doi.notna() & (doi != "-1")
+
+
+def _read_term_csv(csv_path: str) -> pd.DataFrame:
+    try:
+        df = pd.read_csv(csv_path, usecols=PAPER_COLUMNS + ["Loading"], dtype={"PMID": str, "Doi": str})
+    except (ValueError, pd.errors.EmptyDataError):
+        return pd.DataFrame(columns=PAPER_COLUMNS + ["Loading", "term"])
+    df["term"] = os.path.basename(csv_path)[:-len(".csv")]
+    return df
+
+
+class PaperIndex:
+    """
+    Unique papers plus a sparse term x paper Loading matrix.
+
+    Attributes:
+        papers (pd.DataFrame): One row per PMID (index), columns Title, Author,
+            Journal, Doi, n_terms.
+        terms (List[str]): Row labels of `loadings`.
+        loadings (scipy.sparse.csr_matrix): float32 (n_terms, n_papers) Loading scores.
+    """
+
+    def __init__(self, papers: pd.DataFrame, terms: list[str], loadings: sparse.csr_matrix):
+        self.papers = papers
+        self.terms = terms
+        self.loadings = loadings.tocsr()
+        self.term_rows = {term: i for i, term in enumerate(terms)}
+
+    @classmethod
+    def build(cls, term_csv_dir: str = TERM_CSV_DIR, num_workers: int = 8) -> "PaperIndex":
+        """
+        Ingest every '<term_csv_dir>/*.csv'.
+        """
+        csv_paths = sorted(glob.glob(os.path.join(term_csv_dir, "*.csv")))
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            frames = list(executor.map(_read_term_csv, csv_paths))
+        long_df = pd.concat(frames, ignore_index=True).dropna(subset=["PMID"])
+        long_df["Loading"] = pd.to_numeric(long_df["Loading"], errors="coerce").fillna(0.0)
+
+        # Prefer a row with a DOI when the same paper was scraped with and without one
+        long_df["has_doi"] = _has_doi(long_df["Doi"])
+        papers = (
+            long_df.sort_values("has_doi", ascending=False)
+            .drop_duplicates("PMID")
+            .set_index("PMID")[PAPER_COLUMNS[1:]]
+            .sort_index()
+        )
+        papers["n_terms"] = long_df.groupby("PMID")["term"].nunique().reindex(papers.index).astype(int)
+
+        terms = sorted(long_df["term"].unique())
+        rows = pd.Categorical(long_df["term"], categories=terms).codes
+        cols = pd.Categorical(long_df["PMID"], categories=papers.index).codes
+        # A paper listed twice under one term keeps its highest Loading
+        loadings = sparse.coo_matrix(
+            (long_df["Loading"].to_numpy(np.float32), (rows, cols)), shape=(len(terms), len(papers))
+        )
+        loadings = _max_duplicates(loadings)
+
+        print(f"Indexed {len(long_df)} term rows from {len(csv_paths)} CSVs: "
+              f"{len(papers)} unique papers, {int(_has_doi(papers['Doi']).sum())} with a DOI.")
+        return cls(papers, terms, loadings)
+
+    def save(self, index_dir: str = INDEX_DIR) -> None:
+        os.makedirs(index_dir, exist_ok=True)
+        self.papers.to_parquet(os.path.join(index_dir, "papers.parquet"))
+        sparse.save_npz(os.path.join(index_dir, "term_paper_loadings.npz"), self.loadings)
+        with open(os.path.join(index_dir, "terms.txt"), "w") as f:
+            f.write("\n".join(self.terms) + "\n")
+
+    @classmethod
+    def load(cls, index_dir: str = INDEX_DIR) -> "PaperIndex":
+        papers = pd.read_parquet(os.path.join(index_dir, "papers.parquet"))
+        loadings = sparse.load_npz(os.path.join(index_dir, "term_paper_loadings.npz"))
+        with open(os.path.join(index_dir, "terms.txt")) as f:
+            terms = [line.rstrip("\n") for line in f if line.strip()]
+        return cls(papers, terms, loadings)
+
+    def top_k(self, terms: list[str], k: int = 20, agg: str = "max") -> pd.DataFrame:
+        """
+        The `k` papers with the highest Loading over `terms` ('max' or 'sum' across terms).
+        """
+        rows = [self.term_rows[t] for t in terms if t in self.term_rows]
+        if not rows:
+            return self.papers.iloc[:0].assign(score=[])
+        block = self.loadings[rows]
+        scores = np.asarray(block.max(axis=0).todense() if agg == "max" else block.sum(axis=0)).ravel()
+
+        n_scored = int((scores > 0).sum())
+        k = min(k, n_scored)
+        top = np.argpartition(-scores, k - 1)[:k] if k > 0 else np.array([], dtype=int)
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return self.papers.iloc[top].assign(score=scores[top])
+
+
+def _max_duplicates(coo: sparse.coo_matrix) -> sparse.csr_matrix:
+    # sparse sums duplicate (row, col) entries; keep the maximum instead
+    order = np.lexsort((-coo.data, coo.col, coo.row))
+    row, col, data = coo.row[order], coo.col[order], coo.data[order]
+    first = np.ones(len(row), dtype=bool)
+    first[1:] = (row[1:] != row[:-1]) | (col[1:] != col[:-1])
+    return sparse.csr_matrix((data[first], (row[first], col[first])), shape=coo.shape)
+
+
+def standardized_terms(categories_csv: str = CATEGORIES_CSV) -> dict:
+    """
+    {Standardized Term: [raw terms]} from categorized_terms.csv.
+    """
+    categories = pd.read_csv(categories_csv)
+    return categories.groupby("Standardized Term")["Term"].apply(list).to_dict()
+
+
+def query(index: PaperIndex, name: str, k: int = 20, categories_csv: str = CATEGORIES_CSV) -> pd.DataFrame:
+    """
+    Top-k papers for a standardized term (or, if it is not one, a raw term).
+    """
+    groups = standardized_terms(categories_csv) if os.path.isfile(categories_csv) else {}
+    return index.top_k(groups.get(name, [name]), k)
+
+
+def download_queue(index: PaperIndex) -> pd.DataFrame:
+    """
+    One row per unique paper that has a DOI, most widely listed papers first.
+    """
+    papers = index.papers[_has_doi(index.papers["Doi"])]
+    return papers.sort_values("n_terms", ascending=False, kind="stable")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the deduplicated lit-review paper index.")
+    parser.add_argument("--build", action="store_true", help="(Re)build the index from --term_csv_dir.")
+    parser.add_argument("--term_csv_dir", default=TERM_CSV_DIR, help="Folder of per-term CSVs.")
+    parser.add_argument("--index_dir", default=INDEX_DIR, help="Where the index is stored.")
+    parser.add_argument("--categories_csv", default=CATEGORIES_CSV, help="categorized_terms.csv")
+    parser.add_argument("--query", default=None, help="Standardized term (or raw term) to rank papers for.")
+    parser.add_argument("--k", type=int, default=20, help="Number of papers returned by --query. (default=20)")
+
+    args = parser.parse_args()
+
+    if args.build or not os.path.isfile(os.path.join(args.index_dir, "papers.parquet")):
+        index = PaperIndex.build(args.term_csv_dir)
+        index.save(args.index_dir)
+        print(f"Index saved to {args.index_dir}")
+    else:
+        index = PaperIndex.load(args.index_dir)
+
+    if args.query is not None:
+        result = query(index, args.query, args.k, args.categories_csv)
+        with pd.option_context("display.max_colwidth", 80, "display.width", 200):
+            print(result[["Title", "Journal", "Doi", "n_terms", "score"]])
+
+
+if __name__ == "__main__":
+    main()
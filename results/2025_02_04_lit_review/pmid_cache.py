@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Persistent PMID -> DOI cache shared by the lit-review scrapers.
+
+Overlapping terms ("obsessive" / "obsessive compulsive", "monetary" /
+"monetary incentive", ...) list the same papers, so the same PubMed page used
+to be fetched and parsed once per term. Lookups now go through a SQLite table:
+  - Found DOIs are kept for `ttl_days` (default 365).
+  - PMIDs without a DOI are cached as negative entries for `negative_ttl_days`
+    (default 7), so they are retried later but not on every term.
+  - Hits, negative hits, misses and expired entries are counted per run and
+    printed by report().
+
+The cache can be seeded from the existing proc/term_csv files, so re-running or
+extending the lit review only pays for papers that are genuinely new.
+
+Usage (example):
+  python pmid_cache.py --seed_dir ./proc/term_csv     # seed from existing CSVs
+  python pmid_cache.py --lookup 22565203 24069414     # inspect entries
+"""
+
+import os
+import glob
+import json
+import time
+import sqlite3
+import argparse
+
+import pandas as pd
+
+
+DEFAULT_CACHE_PATH = "./proc/pmid_doi_cache.sqlite"
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pmid_doi (
+    pmid TEXT PRIMARY KEY,
+    doi TEXT,
+    metadata TEXT,
+    source TEXT,
+    fetched_at REAL NOT NULL
+);
+"""
+
+
+class PmidCache:
+    """
+    SQLite-backed PMID -> DOI cache with negative caching and expiry.
+
+    Args:
+        db_path (str): SQLite file (created if missing).
+        ttl_days (float): Lifetime of entries with a DOI.
+        negative_ttl_days (float): Lifetime of entries without a DOI.
+    """
+
+    def __init__(self, db_path: str = DEFAULT_CACHE_PATH, ttl_days: float = 365, negative_ttl_days: float = 7):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db_path = db_path
+        self.ttl = ttl_days * SECONDS_PER_DAY
+        self.negative_ttl = negative_ttl_days * SECONDS_PER_DAY
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.stats = {"hits": 0, "negative_hits": 0, "misses": 0, "expired": 0, "stored": 0}
+
+    def _is_fresh(self, doi, fetched_at: float, now: float) -> bool:
+        return now - fetched_at < (self.ttl if doi else self.negative_ttl)
+
+    def get_many(self, pmids: list[str]) -> dict:
+        """
+        Cached entries for `pmids` as {pmid: doi}, where doi is None for a
+        (fresh) negative entry. PMIDs that are missing or expired are left out.
+        """
+        pmids = [str(p) for p in dict.fromkeys(pmids)]
+        found, now = {}, time.time()
+        # Stay below SQLite's host-parameter limit
+        for i in range(0, len(pmids), 500):
+            batch = pmids[i:i + 500]
+            rows = self.conn.execute(
+                f"SELECT pmid, doi, fetched_at FROM pmid_doi WHERE pmid IN ({','.join('?' * len(batch))})", batch
+            ).fetchall()
+            for pmid, doi, fetched_at in rows:
+                if self._is_fresh(doi, fetched_at, now):
+                    found[pmid] = doi
+                else:
+                    self.stats["expired"] += 1
+
+        for doi in found.values():
+            self.stats["hits" if doi else "negative_hits"] += 1
+        self.stats["misses"] += len(pmids) - len(found)
+        return found
+
+    def get(self, pmid: str):
+        """
+        (True, doi or None) on a fresh hit, (False, None) on a miss.
+        """
+        found = self.get_many([pmid])
+        return (True, found[str(pmid)]) if str(pmid) in found else (False, None)
+
+    def put_many(self, entries: dict, source: str = "", metadata: dict = None) -> None:
+        """
+        Store {pmid: doi or None}; None is stored as a negative entry.
+        `metadata` is an optional {pmid: dict} saved as JSON.
+        """
+        now = time.time()
+        metadata = metadata or {}
+        rows = [
+            (str(pmid), doi or None, json.dumps(metadata[pmid]) if pmid in metadata else None, source, now)
+            for pmid, doi in entries.items()
+        ]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO pmid_doi (pmid, doi, metadata, source, fetched_at) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+        self.stats["stored"] += len(rows)
+
+    def put(self, pmid: str, doi, source: str = "", metadata: dict = None) -> None:
+        self.put_many({str(pmid): doi}, source, {str(pmid): metadata} if metadata else None)
+
+    def report(self) -> str:
+        """
+        Print and return this run's hit/miss counts.
+        """
+        lookups = self.stats["hits"] + self.stats["negative_hits"] + self.stats["misses"]
+        hit_rate = (lookups - self.stats["misses"]) / lookups if lookups else 0.0
+        line = (f"PMID cache: {lookups} lookups, {self.stats['hits']} hits, "
+                f"{self.stats['negative_hits']} negative hits, {self.stats['misses']} misses "
+                f"({self.stats['expired']} expired), {self.stats['stored']} stored, hit rate {hit_rate:.1%}")
+        print(line)
+        return line
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def seed_from_term_csvs(cache: PmidCache, term_csv_dir: str) -> int:
+    """
+    Add every PMID with a DOI in '<term_csv_dir>/*.csv' that is not cached yet.
+    Rows with Doi == -1 are not seeded, since they may predate a fix in the scraper.
+
+    Returns:
+        int: Number of PMIDs added.
+    """
+    dois = {}
+    for csv_path in sorted(glob.glob(os.path.join(term_csv_dir, "*.csv"))):
+        try:
+            df = pd.read_csv(csv_path, usecols=["PMID", "Doi"], dtype=str)
+        except (ValueError, pd.errors.EmptyDataError):
+            continue
+        df = df.dropna()
+        df = df[df["Doi"] != "-1"]
+        dois.update(zip(df["PMID"], df["Doi"]))
+
+    existing = {row[0] for row in cache.conn.execute("SELECT pmid FROM pmid_doi")}
+    new = {pmid: doi for pmid, doi in dois.items() if pmid not in existing}
+    cache.put_many(new, source="term_csv")
+    return len(new)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed or inspect the PMID -> DOI cache.")
+    parser.add_argument("--cache_db", default=DEFAULT_CACHE_PATH, help="SQLite cache file.")
+    parser.add_argument("--seed_dir", default=None, help="Seed from the term CSVs in this folder.")
+    parser.add_argument("--lookup", nargs="*", default=None, help="PMIDs to look up.")
+
+    args = parser.parse_args()
+
+    cache = PmidCache(args.cache_db)
+    if args.seed_dir is not None:
+        n_added = seed_from_term_csvs(cache, args.seed_dir)
+        print(f"Seeded {n_added} PMIDs from {args.seed_dir}")
+    if args.lookup:
+        found = cache.get_many(args.lookup)
+        for pmid in args.lookup:
+            print(pmid, found[pmid] if pmid in found else "<not cached>")
+    n_rows = cache.conn.execute("SELECT COUNT(*), COUNT(doi) FROM pmid_doi").fetchone()
+    print(f"{args.cache_db}: {n_rows[0]} PMIDs, {n_rows[1]} with a DOI")
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
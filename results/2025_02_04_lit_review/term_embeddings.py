@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Cached term embeddings and scalable clustering for term_grouping.ipynb.
+
+The notebook retrained Word2Vec on the term list on every run, averaged word
+vectors per phrase in a Python loop, and ran full-batch KMeans with a fixed
+k=30 on both the Word2Vec and the TF-IDF vectors. Here:
+  1) Terms are tokenized once (lowercased, NLTK word tokenizer) into a flat
+     token-id array with per-phrase offsets.
+  2) Word vectors are cached under ./proc/term_embeddings/<key>.npz, keyed by
+     the model and its version/parameters and the term list, so a rerun only
+     loads a small array; Word2Vec is trained only on a cache miss.
+  3) Phrase vectors are the mean of their word vectors, computed with one
+     token-id gather and np.add.reduceat.
+  4) MiniBatchKMeans is fit for every k of a sweep in parallel processes and
+     scored by silhouette and inertia; the best k (or a fixed one) labels the terms.
+  5) Terms are regrouped into the categories of ./proc/categorized_terms.csv:
+     every term goes to the category whose centroid (mean vector of the
+     category's listed terms) is most cosine-similar, or stays unassigned
+     (NaN) when that similarity is below --min_similarity.
+
+Usage (example):
+  python term_embeddings.py --model word2vec --ks 10 20 30 40 50 --out ./proc/term_clusters.csv
+  python term_embeddings.py --model tfidf --k 30 --out ./proc/term_clusters_tfidf.csv
+"""
+
+import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import gensim
+from gensim.models import Word2Vec
+from nltk.tokenize import NLTKWordTokenizer
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics import silhouette_score
+from sklearn.preprocessing import StandardScaler
+
+
+ITEMS_CSV = "./data/items.csv"
+CATEGORIES_CSV = "./proc/categorized_terms.csv"
+EMBED_DIR = "./proc/term_embeddings"
+
+# Word2Vec settings of term_grouping.ipynb
+WORD2VEC_PARAMS = {"vector_size": 100, "window": 5, "min_count": 1, "epochs": 10, "seed": 42}
+
+DEFAULT_KS = (10, 20, 30, 40, 50)
+
+# Cosine similarity to the nearest category centroid below which a term is left unassigned
+DEFAULT_MIN_SIMILARITY = 0.2
+
+
+def load_terms(items_csv: str = ITEMS_CSV) -> list[str]:
+    """
+    The Neurosynth term names (column 'name' of data/items.csv).
+    """
+    return pd.read_csv(items_csv)["name"].astype(str).tolist()
+
+
+def tokenize_terms(terms: list[str]) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """
+    Tokenize every term (lowercased) into a shared vocabulary.
+
+    The tokenizer is the one nltk.word_tokenize applies per sentence, so
+    single-phrase terms tokenize the same without the punkt download.
+
+    Returns:
+        (List[str], np.ndarray, np.ndarray): vocabulary, flat token ids of all
+            terms, and the offset of each term's first token (len(terms) + 1 entries).
+    """
+    tokenizer = NLTKWordTokenizer()
+    tokenized = [tokenizer.tokenize(term.lower()) for term in terms]
+    vocabulary = sorted({token for tokens in tokenized for token in tokens})
+    lookup = {token: i for i, token in enumerate(vocabulary)}
+    token_ids = np.array([lookup[token] for tokens in tokenized for token in tokens], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum([len(tokens) for tokens in tokenized])])
+    return vocabulary, token_ids, offsets
+
+
+def cache_key(model: str, params: dict, terms: list[str]) -> str:
+    """
+    Cache key of a model (name, library version, parameters) and term list.
+    """
+    version = gensim.__version__ if model == "word2vec" else ""
+    payload = json.dumps({"model": model, "version": version, "params": params, "terms": terms}, sort_keys=True)
+    return f"{model}_{hashlib.sha1(payload.encode()).hexdigest()[:16]}"
+
+
+def train_word_vectors(vocabulary: list[str], token_ids: np.ndarray, offsets: np.ndarray, params: dict, workers: int = 4) -> np.ndarray:
+    """
+    Train Word2Vec on the tokenized terms (as term_grouping.ipynb) and return
+    the (len(vocabulary), vector_size) word vectors in vocabulary order.
+    """
+    sentences = [[vocabulary[i] for i in token_ids[start:stop]] for start, stop in zip(offsets[:-1], offsets[1:])]
+    params = dict(params)
+    epochs = params.pop("epochs")
+    model = Word2Vec(sentences=sentences, workers=workers, epochs=epochs, **params)
+    return np.stack([model.wv[token] for token in vocabulary]).astype(np.float32)
+
+
+def load_word_vectors(
+    terms: list[str],
+    params: dict = None,
+    cache_dir: str = EMBED_DIR,
+    recompute: bool = False
+) -> tuple[list[str], np.ndarray, np.ndarray, np.ndarray]:
+    """
+    (vocabulary, token ids, offsets, word vectors) of the terms, from the cache
+    if present, else trained and written (atomically) to the cache.
+    """
+    params = dict(WORD2VEC_PARAMS if params is None else params)
+    vocabulary, token_ids, offsets = tokenize_terms(terms)
+    cache_path = os.path.join(cache_dir, cache_key("word2vec", params, terms) + ".npz")
+    if os.path.exists(cache_path) and not recompute:
+        with np.load(cache_path) as cached:
+            if list(cached["vocabulary"]) == vocabulary:
+                print(f"Word vectors loaded from {cache_path}")
+                return vocabulary, token_ids, offsets, cached["vectors"]
+
+    word_vectors = train_word_vectors(vocabulary, token_ids, offsets, params)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = cache_path + ".part.npz"
+    np.savez(tmp_path, vocabulary=np.array(vocabulary), vectors=word_vectors)
+    os.replace(tmp_path, cache_path)
+    print(f"Word vectors trained and cached to {cache_path}")
+    return vocabulary, token_ids, offsets, word_vectors
+
+
+def phrase_vectors(token_ids: np.ndarray, offsets: np.ndarray, word_vectors: np.ndarray) -> np.ndarray:
+    """
+    Mean word vector of every phrase (zero for phrases without tokens), with a
+    single gather and np.add.reduceat over the flat token-id array.
+    """
+    n_phrases = len(offsets) - 1
+    lengths = np.diff(offsets)
+    out = np.zeros((n_phrases, word_vectors.shape[1]), dtype=np.float64)
+    nonempty = lengths > 0
+    if token_ids.size:
+        sums = np.add.reduceat(word_vectors[token_ids].astype(np.float64), offsets[:-1][nonempty], axis=0)
+        out[nonempty] = sums / lengths[nonempty, None]
+    return out
+
+
+def embed_terms(terms: list[str], model: str = "word2vec", cache_dir: str = EMBED_DIR, recompute: bool = False):
+    """
+    Feature matrix of the terms: standardized mean Word2Vec vectors (dense) or
+    TF-IDF vectors (sparse), as the two paths of term_grouping.ipynb.
+    """
+    if model == "word2vec":
+        _, token_ids, offsets, word_vectors = load_word_vectors(terms, cache_dir=cache_dir, recompute=recompute)
+        return StandardScaler().fit_transform(phrase_vectors(token_ids, offsets, word_vectors))
+    if model == "tfidf":
+        return TfidfVectorizer(stop_words="english").fit_transform([term.strip() for term in terms])
+    raise ValueError(f"Unknown model '{model}', expected 'word2vec' or 'tfidf'")
+
+
+def _fit_k(args):
+    features, k, seed, batch_size, sample_size = args
+    kmeans = MiniBatchKMeans(n_clusters=k, random_state=seed, batch_size=batch_size, n_init=3)
+    labels = kmeans.fit_predict(features)
+    silhouette = silhouette_score(features, labels, sample_size=sample_size, random_state=seed) if k > 1 else np.nan
+    return k, labels, float(kmeans.inertia_), float(silhouette)
+
+
+def sweep_kmeans(
+    features,
+    ks: tuple = DEFAULT_KS,
+    seed: int = 42,
+    batch_size: int = 256,
+    sample_size: int = 2000,
+    num_workers: int = None
+) -> tuple[pd.DataFrame, dict]:
+    """
+    Fit MiniBatchKMeans for every k in parallel processes.
+
+    Returns:
+        (pd.DataFrame, dict): k, inertia, silhouette per k (sorted by k) and {k: labels}.
+    """
+    ks = [k for k in ks if 1 <= k < features.shape[0]]
+    jobs = [(features, k, seed, batch_size, min(sample_size, features.shape[0])) for k in ks]
+    if num_workers == 1 or len(jobs) == 1:
+        results = [_fit_k(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers or min(len(jobs), os.cpu_count())) as executor:
+            results = list(executor.map(_fit_k, jobs))
+    scores = pd.DataFrame(
+        [(k, inertia, silhouette) for k, _, inertia, silhouette in results],
+        columns=["k", "inertia", "silhouette"]
+    ).sort_values("k").reset_index(drop=True)
+    return scores, {k: labels for k, labels, _, _ in results}
+
+
+def regroup_terms(
+    terms: list[str],
+    features,
+    categories_csv: str = CATEGORIES_CSV,
+    min_similarity: float = DEFAULT_MIN_SIMILARITY
+) -> pd.DataFrame:
+    """
+    Assign every term to the category of categorized_terms.csv whose centroid
+    (mean feature vector of its listed terms) is most cosine-similar. Terms
+    whose best similarity is below `min_similarity` (e.g. TF-IDF vectors that
+    share no word with any category) get a NaN category.
+
+    Returns:
+        pd.DataFrame: term, category, similarity, is_listed (term already in the CSV).
+    """
+    categories = pd.read_csv(categories_csv)
+    positions = {term.lower(): i for i, term in enumerate(terms)}
+    listed = categories[categories["Term"].str.lower().isin(positions)]
+    names, codes = np.unique(listed["Category"].to_numpy(), return_inverse=True)
+    rows = np.array([positions[term.lower()] for term in listed["Term"]])
+
+    dense = features.toarray() if hasattr(features, "toarray") else np.asarray(features)
+    # Category centroids as one (categories x listed terms) averaging matmul
+    membership = np.zeros((len(names), len(rows)))
+    membership[codes, np.arange(len(rows))] = 1.0
+    centroids = (membership / membership.sum(axis=1, keepdims=True)) @ dense[rows]
+
+    def unit(x):
+        norms = np.linalg.norm(x, axis=1, keepdims=True)
+        return x / np.where(norms > 0, norms, 1.0)
+
+    similarity = unit(dense) @ unit(centroids).T
+    best = similarity.argmax(axis=1)
+    best_similarity = similarity[np.arange(len(terms)), best]
+    return pd.DataFrame({
+        "term": terms,
+        "category": np.where(best_similarity >= min_similarity, names[best].astype(object), np.nan),
+        "similarity": best_similarity,
+        "is_listed": np.isin([term.lower() for term in terms], listed["Term"].str.lower().to_numpy()),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cluster and regroup Neurosynth terms with cached embeddings.")
+    parser.add_argument("--items", default=ITEMS_CSV, help=f"Term list CSV. (default={ITEMS_CSV})")
+    parser.add_argument("--model", choices=["word2vec", "tfidf"], default="word2vec", help="(default=word2vec)")
+    parser.add_argument("--ks", nargs="+", type=int, default=list(DEFAULT_KS), help="k values of the sweep. (default=10 20 30 40 50)")
+    parser.add_argument("--k", type=int, default=None, help="Use this k for the labels instead of the best silhouette.")
+    parser.add_argument("--categories", default=CATEGORIES_CSV, help=f"Category CSV to regroup into. (default={CATEGORIES_CSV})")
+    parser.add_argument("--min_similarity", type=float, default=DEFAULT_MIN_SIMILARITY,
+                        help=f"Leave terms less similar than this to every category unassigned. (default={DEFAULT_MIN_SIMILARITY})")
+    parser.add_argument("--num_workers", type=int, default=None, help="Processes for the k sweep (default: one per k).")
+    parser.add_argument("--recompute", action="store_true", help="Ignore the embedding cache.")
+    parser.add_argument("--out", default="./proc/term_clusters.csv", help="Output CSV. (default=./proc/term_clusters.csv)")
+
+    args = parser.parse_args()
+
+    terms = load_terms(args.items)
+    features = embed_terms(terms, args.model, recompute=args.recompute)
+    ks = sorted(set(args.ks) | ({args.k} if args.k else set()))
+    scores, labels = sweep_kmeans(features, tuple(ks), num_workers=args.num_workers)
+    print(scores.to_string(index=False))
+    k = args.k or int(scores.loc[scores["silhouette"].idxmax(), "k"])
+    print(f"Using k={k}")
+
+    out = regroup_terms(terms, features, args.categories, args.min_similarity)
+    print(out["category"].value_counts(dropna=False).rename(index={np.nan: "(unassigned)"}).to_string())
+    out.insert(1, "cluster", labels[k])
+    out.sort_values(["cluster", "term"]).to_csv(args.out, index=False)
+    print(f"{len(out)} terms written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,107 @@
-import pandas as pd
+#!/usr/bin/env python3
+"""
+Download ABIDE Preprocessed derivatives (default: C-PAC filt_noglobal func_preproc)
+for every FILE_ID in the phenotype spreadsheet.
+
+Files are fetched concurrently over a pooled session, resumed from '.part' files
+after an interruption, verified against size/ETag and recorded in a manifest, so
+re-running the script only fetches what is missing (see src/download_manager.py).
+
+Usage (example):
+  python abide_download.py \
+    --output_dir /blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/ABIDE_preprocessed \
+    --num_workers 16
+
+  # Against a local stand-in of the bucket (e.g. a test HTTP server)
+  python abide_download.py --base_url http://localhost:8000 --phenotype_csv Phenotypic_V1_0b.csv --output_dir ./out
+"""
+
 import os
-import requests
-
-# Load the summary spreadsheet
-spreadsheet_url = "https://s3.amazonaws.com/fcp-indi/data/Projects/ABIDE_Initiative/Phenotypic_V1_0b.csv"
-df = pd.read_csv(spreadsheet_url)
-
-# Select subject IDs
-subject_ids = df["FILE_ID"].dropna().astype(str).tolist()
-
-# Define parameters
-pipeline = "cpac"
-strategy = "filt_noglobal"
-derivative = "func_preproc"
-output_dir = "/blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/ABIDE_preprocessed"
-
-# Ensure output directory exists
-os.makedirs(output_dir, exist_ok=True)
-
-# Download fMRI files
-for index, subject_id in enumerate(subject_ids):  # Modify this number for more subjects
-    print("Progress: {}/{}".format(index, len(subject_ids)))
-    file_url = f"https://s3.amazonaws.com/fcp-indi/data/Projects/ABIDE_Initiative/Outputs/{pipeline}/{strategy}/{derivative}/{subject_id}_{derivative}.nii.gz"
-    file_path = os.path.join(output_dir, f"{subject_id}_{derivative}.nii.gz")
-
-    response = requests.get(file_url, stream=True)
-    if response.status_code == 200:
-        with open(file_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        print(f"Downloaded: {file_path}")
-    else:
-        print(f"Failed to download: {file_url}")
+import sys
+import argparse
+
+import pandas as pd
+
+# Shared download code lives in <repo>/src
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..", "src")))
+from download_manager import DownloadTask, download_many
+
+
+BASE_URL = "https://s3.amazonaws.com/fcp-indi/data/Projects/ABIDE_Initiative"
+
+
+def build_tasks(
+    subject_ids: list[str],
+    output_dir: str,
+    base_url: str = BASE_URL,
+    pipeline: str = "cpac",
+    strategy: str = "filt_noglobal",
+    derivative: str = "func_preproc"
+) -> list[DownloadTask]:
+    """
+    One DownloadTask per subject: '<base_url>/Outputs/<pipeline>/<strategy>/<derivative>/<id>_<derivative>.nii.gz'.
+    """
+    tasks = []
+    for subject_id in subject_ids:
+        file_url = f"{base_url}/Outputs/{pipeline}/{strategy}/{derivative}/{subject_id}_{derivative}.nii.gz"
+        file_path = os.path.join(output_dir, f"{subject_id}_{derivative}.nii.gz")
+        tasks.append(DownloadTask(file_url, file_path))
+    return tasks
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Concurrent, resumable download of ABIDE Preprocessed derivatives."
+    )
+    parser.add_argument(
+        "--base_url", default=BASE_URL,
+        help="ABIDE_Initiative root URL (default: the fcp-indi S3 bucket)."
+    )
+    parser.add_argument(
+        "--phenotype_csv", default=None,
+        help="Phenotype spreadsheet with FILE_ID (default: <base_url>/Phenotypic_V1_0b.csv)."
+    )
+    parser.add_argument("--pipeline", default="cpac", help="Preprocessing pipeline. (default=cpac)")
+    parser.add_argument("--strategy", default="filt_noglobal", help="Noise strategy. (default=filt_noglobal)")
+    parser.add_argument("--derivative", default="func_preproc", help="Derivative. (default=func_preproc)")
+    parser.add_argument(
+        "--output_dir", default="/blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/ABIDE_preprocessed",
+        help="Where the .nii.gz files are written."
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=8,
+        help="Concurrent downloads. (default=8)"
+    )
+    parser.add_argument(
+        "--manifest", default=None,
+        help="Progress manifest (default: <output_dir>/download_manifest.jsonl)."
+    )
+    parser.add_argument(
+        "--limit", type=int, default=None,
+        help="Only download the first N subjects."
+    )
+
+    args = parser.parse_args()
+
+    # Load the summary spreadsheet
+    phenotype_csv = args.phenotype_csv or f"{args.base_url}/Phenotypic_V1_0b.csv"
+    df = pd.read_csv(phenotype_csv)
+
+    # Select subject IDs ('no_filename' marks subjects without preprocessed data)
+    subject_ids = [s for s in df["FILE_ID"].dropna().astype(str).tolist() if s != "no_filename"]
+    if args.limit is not None:
+        subject_ids = subject_ids[:args.limit]
+
+    tasks = build_tasks(subject_ids, args.output_dir, args.base_url, args.pipeline, args.strategy, args.derivative)
+    manifest = args.manifest or os.path.join(args.output_dir, "download_manifest.jsonl")
+    results = download_many(tasks, num_workers=args.num_workers, manifest_path=manifest)
+
+    failed = [r for r in results if r.status == "failed"]
+    for result in failed:
+        print(f"Failed to download: {result.url} ({result.message})")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
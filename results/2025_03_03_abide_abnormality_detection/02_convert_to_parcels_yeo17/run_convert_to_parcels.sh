@@ -34,12 +34,16 @@ set -e  # stop on error
 IN_LIST="file_list.txt"
 
 # Atlas info for the python script
-ATLAS_PATH="/blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/Yeo2011_17Networks_N1000.split_components.FSL_MNI152_2mm.nii.gz"
+ATLAS="yeo17"  # name in src/atlas_registry.py
+# Kept so the .dat files keep the layout of the existing outputs (default: largest atlas label)
 N_PARCELS="17"
 
 # Directory for final .dat outputs after segmentation
 PARCEL_OUT_DIR="/blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/ABIDE_parcelled_yeo17"
 
+# Cohort QC table (one JSON line per scan, see src/scan_qc.py)
+QC_TABLE="${PARCEL_OUT_DIR}/qc.jsonl"
+
 # Get the input file from file_list
 in_file=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" "${IN_LIST}")
 if [[ ! -f "$in_file" ]]; then
@@ -56,9 +60,10 @@ echo "Input file     = ${in_file}"
 
 python segment_single_fMRI.py \
     --fmri_file "${in_file}" \
-    --atlas_path "${ATLAS_PATH}" \
+    --atlas "${ATLAS}" \
     --n_parcels "${N_PARCELS}" \
-    --out_dir "${PARCEL_OUT_DIR}"
+    --out_dir "${PARCEL_OUT_DIR}" \
+    --qc_table "${QC_TABLE}"
 
 echo "Parcellation done. Output is in: ${PARCEL_OUT_DIR}"
 echo "-------------------------------------------------"
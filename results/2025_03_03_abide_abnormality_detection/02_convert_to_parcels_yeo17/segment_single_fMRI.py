@@ -7,77 +7,32 @@ into parcel-based time series using a specified atlas.
 Usage (example):
   python segment_single_fMRI.py \
     --fmri_file /path/to/some_fMRI.nii.gz \
-    --atlas_path /path/to/AAL3.nii.gz \
-    --n_parcels 170 \
+    --atlas aal3 \
     --out_dir /path/to/output_folder
 
 Steps:
-  1) Load the NIfTI atlas, flatten into label_data.
-  2) Load the single 4D fMRI file.
-  3) For each of the n_parcels, compute the mean time series over that region.
+  1) Load the compiled atlas (registered name or NIfTI path, see src/atlas_registry.py);
+     its label set gives n_parcels unless --n_parcels is passed, and its grid is
+     checked against the fMRI header.
+  2) Stream the single 4D fMRI file in chunks of volumes.
+  3) For each of the n_parcels, compute the mean time series over that region
+     (see src/parcellation.py).
   4) Write the resulting time series array to a .dat file in the chosen output directory
      (default: same folder as the fMRI file).
+  5) With --qc_table, the same pass also computes scan QC (tSNR, DVARS, global
+     signal, parcel coverage / NaN fraction, see src/scan_qc.py): the summary is
+     appended to the cohort QC table and the per-parcel arrays go to <name>.qc.npz.
 """
 
 import os
 import sys
 import argparse
-import numpy as np
-import nibabel as nib
-
-
-def load_atlas(atlas_path: str) -> np.ndarray:
-    """
-    Load a NIfTI atlas from `atlas_path` and return it as a flattened NumPy array.
-    """
-    try:
-        atlas_img = nib.load(atlas_path)
-        atlas_data = atlas_img.get_fdata()
-        return atlas_data.flatten()
-    except Exception as e:
-        raise IOError(f"Failed to load atlas at {atlas_path}: {str(e)}")
-
-
-def extract_parcel_timeseries(
-    fmri_path: str,
-    label_data: np.ndarray,
-    n_parcels: int
-) -> np.ndarray:
-    """
-    Load a 4D fMRI volume from `fmri_path`, reshape it to (timepoints, voxels),
-    and compute mean time series for each of the `n_parcels` in `label_data`.
-    Assumes labels 1..n_parcels. Returns a 2D array of shape (timepoints, parcels).
-    """
-    fmri_img = nib.load(fmri_path)
-    fmri_data = fmri_img.get_fdata()
-    
-    # Flatten spatial dims, transpose => shape: (timepoints, voxels)
-    flattened = fmri_data.reshape((-1, fmri_data.shape[-1])).T
-    n_timepoints = flattened.shape[0]
-
-    pmTS = np.zeros((n_timepoints, n_parcels))
-
-    for i in range(1, n_parcels + 1):
-        parcel_mask = (label_data == i)
-        num_voxels  = np.sum(parcel_mask)
-
-        if num_voxels == 0:
-            # If no voxels in this parcel, fill with 0.0
-            pmTS[:, i - 1] = 0.0
-        else:
-            y = flattened[:, parcel_mask]  # shape: (timepoints, #voxels_in_parcel)
-            pmTS[:, i - 1] = np.nanmean(y, axis=1)
-
-    # Replace any remaining NaNs with 0
-    pmTS[np.isnan(pmTS)] = 0
-    return pmTS
-
-
-def save_timeseries(pmTS: np.ndarray, out_file: str):
-    """
-    Save time series (2D NumPy array) to a .dat file using tab delimiters.
-    """
-    np.savetxt(out_file, pmTS, delimiter='\t')
+
+# Shared parcellation code lives in <repo>/src
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..", "src")))
+from parcellation import extract_parcel_timeseries, save_timeseries
+from atlas_registry import ATLASES, get_atlas
+from scan_qc import append_qc_row
 
 
 def main():
@@ -89,29 +44,38 @@ def main():
         help="Path to the single 4D fMRI .nii.gz file."
     )
     parser.add_argument(
-        "--atlas_path", required=True,
-        help="Path to the NIfTI atlas file, e.g. AAL3.nii.gz"
+        "--atlas", "--atlas_path", dest="atlas", required=True,
+        help=f"Registered atlas name ({', '.join(sorted(ATLASES))}) or path to a NIfTI atlas, e.g. AAL3.nii.gz"
     )
     parser.add_argument(
-        "--n_parcels", type=int, default=170,
-        help="Number of parcels expected in the atlas. (default=170)"
+        "--n_parcels", type=int, default=None,
+        help="Parcels 1..n_parcels are extracted. (default=largest label in the atlas)"
     )
     parser.add_argument(
         "--out_dir", default=None,
         help="Optional output directory (default: same folder as --fmri_file)."
     )
+    parser.add_argument(
+        "--qc_table", default=None,
+        help="Optional cohort QC table (JSON lines) to append this scan's QC summary to."
+    )
 
     args = parser.parse_args()
 
-    # 1) Load the atlas
-    label_data = load_atlas(args.atlas_path)
+    # 1) Load the atlas (compiled once, then memory-mapped)
+    atlas = get_atlas(args.atlas)
+    if args.n_parcels is not None and args.n_parcels < atlas.n_parcels:
+        dropped = [int(label) for label in atlas.labels if label > args.n_parcels]
+        print(f"Note: --n_parcels {args.n_parcels} leaves out atlas labels {dropped}")
 
     # 2) Extract time series from the single fMRI file
-    pmTS = extract_parcel_timeseries(
+    result = extract_parcel_timeseries(
         fmri_path=args.fmri_file,
-        label_data=label_data,
-        n_parcels=args.n_parcels
+        label_data=atlas,
+        n_parcels=args.n_parcels,
+        qc=args.qc_table is not None
     )
+    pmTS, qc = result if args.qc_table is not None else (result, None)
 
     # Decide output directory
     if args.out_dir is not None:
@@ -132,6 +96,16 @@ def main():
     save_timeseries(pmTS, out_file)
     print(f"Parcel-based time series saved to: {out_file}")
 
+    # 5) Record the scan QC
+    if qc is not None:
+        qc.save(os.path.join(out_dir, f"{base_name}.qc.npz"))
+        append_qc_row(args.qc_table, base_name, qc, fmri_file=args.fmri_file, atlas=args.atlas)
+        print(
+            f"QC: median tSNR {qc.summary['tsnr_median']:.1f}, "
+            f"mean DVARS {qc.summary['dvars_pct_mean']:.2f}%, "
+            f"{qc.summary['n_empty_in_data']} empty parcels -> {args.qc_table}"
+        )
+
 
 if __name__ == "__main__":
     main()
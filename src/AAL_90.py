@@ -25,12 +25,14 @@ import glob
 import pickle
 
 import numpy as np
-import nibabel as nib
-from nilearn import plotting
 import matplotlib.pyplot as plt
 
 from ipdb import set_trace
 
+from atlas_viz import show_atlas
+from atlas_registry import ATLASES, get_atlas
+from parcellation import extract_parcel_timeseries
+
 
 def convert_fMRIvols_to_AAL3(data_path, output_path):
     """
@@ -38,9 +40,9 @@ def convert_fMRIvols_to_AAL3(data_path, output_path):
 
     This function:
       1) Scans a given directory (data_path) for .nii.gz files.
-      2) For each matching file, it loads an AAL3 atlas (hardcoded path) and the fMRI data.
-      3) Reshapes the 4D fMRI volume into [n_voxels, n_timepoints], then extracts
-         average time-series data for each AAL3 parcel (1 to 170).
+      2) Loads the registered AAL3 atlas once ('aal3_fsl' in atlas_registry.py).
+      3) For each matching file, checks its grid against the atlas and extracts
+         average time-series data for each AAL3 parcel (1 to 170), streaming the volume.
       4) Saves the resulting time-series as a .dat file in 'output_path'.
 
     Args:
@@ -48,8 +50,7 @@ def convert_fMRIvols_to_AAL3(data_path, output_path):
         output_path (str): Directory where the parcellated time-series (.dat) files are saved.
 
     Notes:
-        - The path for the AAL3 atlas is currently hardcoded as:
-            '/orange/ruogu.fang/zeyun.zhao/FSL/bb_FSL/data/standard/AAL/AAL3.nii.gz'
+        - The AAL3 atlas path is registered as 'aal3_fsl' in atlas_registry.ATLASES.
         - The function is set to skip files unless they match a specific substring
           ("1000023_20227_2_0_fMRI_in_MNI_space.nii.gz") in this example code; adapt as needed.
         - Each .dat file is named after the original fMRI filename with '.nii.gz' removed.
@@ -61,15 +62,13 @@ def convert_fMRIvols_to_AAL3(data_path, output_path):
     print("fMRI data path specified:", data_path)
     print("Number of fMRI files found:", len(paths))
 
-    # Hardcoded AAL3 atlas path
-    aal_path = '/orange/ruogu.fang/zeyun.zhao/FSL/bb_FSL/data/standard/AAL/AAL3.nii.gz'
+    # Registered AAL3 atlas (compiled once, then memory-mapped; see atlas_registry.py)
+    aal_path = ATLASES["aal3_fsl"].path
     print("Atlas file:", aal_path)
 
     # Load the atlas
     try:
-        label_img = nib.load(aal_path)
-        label_data = label_img.get_fdata()
-        label_data = label_data.flatten()  # Flatten into 1D
+        atlas = get_atlas("aal3_fsl")
         print("Atlas successfully loaded.")
     except Exception as e:
         print(f'Error loading AAL3 atlas at {aal_path}: {str(e)}')
@@ -86,33 +85,11 @@ def convert_fMRIvols_to_AAL3(data_path, output_path):
         # Process only .nii.gz files
         if ".nii.gz" in f:
             print(f'Loading 4D image from {file_path}')
-            try:
-                dts_img = nib.load(file_path)
-                dts_data = dts_img.get_fdata()
-                print("Loaded fMRI data.")
-            except Exception as e:
-                print(f'Error loading 4D fMRI file "{f}": {str(e)}')
-                continue
-
             try:
                 print(f"Extracting AAL3 parcels for {f}...")
-                # Reshape from (X, Y, Z, T) to (T, X*Y*Z)
-                flattened = dts_data.reshape((-1, dts_data.shape[-1])).T
-                n_timepoints = flattened.shape[0]
-
-                # AAL3 has 170 parcels (labeled 1 through 170)
-                n_parcels = 170
-                pmTS = np.zeros((n_timepoints, n_parcels))
-
-                # Compute mean signal for each parcel i
-                # The label_data is also flattened (same shape in spatial dims).
-                for i in range(1, n_parcels + 1):
-                    parcel_mask = (label_data == i)
-                    y = flattened[:, parcel_mask]
-                    pmTS[:, i - 1] = np.nanmean(y, axis=1)
-
-                # Replace NaNs with 0
-                pmTS[np.isnan(pmTS)] = 0
+                # AAL3 has 170 parcels (labeled 1 through 170); the fMRI grid is
+                # checked against the atlas and the volume is read in chunks
+                pmTS = extract_parcel_timeseries(file_path, atlas, n_parcels=170)
 
                 # Save time series as .dat
                 save_name = f.split('.nii.gz')[0]
@@ -127,51 +104,31 @@ def convert_fMRIvols_to_AAL3(data_path, output_path):
             print(f"Skipping non-NIfTI file: {f}")
 
 
-def show_AAL3(aal_template_path, save_dir):
+def show_AAL3(aal_template_path, save_dir, mode="pngs", num_workers=None):
     """
     Visualize each region in the AAL3 atlas by generating separate PNGs.
 
-    This function:
-      - Loads the AAL3 template.
-      - Iterates over all possible region indices (0 to 169 in this script).
-      - For each region, creates a binary mask image, then uses nilearn.plotting.plot_roi
-        to produce an orthographic display, saved as a PNG.
+    This function (see atlas_viz.py):
+      - Loads the AAL3 template (any grid; a trailing singleton axis is dropped).
+      - Computes every region's bounding box and center of mass in one pass and
+        saves them as roi_geometry.csv.
+      - Renders one PNG per region present in the atlas ('<label>.png', three
+        orthogonal slices through its center of mass) across a process pool,
+        or a single contact-sheet montage with mode='montage'.
 
     Args:
         aal_template_path (str): Path to the AAL3 atlas NIfTI file (e.g., AAL3.nii.gz).
         save_dir (str): Directory where the visualization PNG files are saved.
+        mode (str): 'pngs', 'montage' or 'both' (default 'pngs').
+        num_workers (int): Number of rendering processes (default: all cores).
 
     Returns:
         None
     """
-    output_image_path = os.path.join(save_dir, "AAL.jpg")
-
     try:
-        label_img = nib.load(aal_template_path)
-        label_data = label_img.get_fdata().reshape(91, 109, 91, 1)
+        show_atlas(aal_template_path, save_dir, mode=mode, num_workers=num_workers)
     except Exception as e:
-        print(f"Error loading AAL3 atlas at {aal_template_path}: {str(e)}")
-        return
-
-    set_trace()  # Debug if needed
-
-    # AAL3 has 170 regions by default; adjust if needed
-    for roi_index in range(170):
-        # Create a binary mask for the current ROI
-        roi_mask_data = (label_data == roi_index).astype(np.int16)
-        roi_mask_img = nib.Nifti1Image(roi_mask_data, affine=label_img.affine)
-
-        # Show ROI in an orthographic view
-        display = plotting.plot_roi(
-            roi_mask_img,
-            title=f"ROI Index {roi_index}",
-            display_mode='ortho',
-            colorbar=True
-        )
-        # Save figure
-        output_path = os.path.join(save_dir, f"{roi_index}.png")
-        display.savefig(output_path)
-        display.close()
+        print(f"Error visualizing AAL3 atlas at {aal_template_path}: {str(e)}")
 
 
 def generate_subsequences(fmri_data, subsequence_length=200, segment_length=20, num_segments=10):
@@ -224,7 +181,7 @@ def main():
     3) Optionally calls the convert_fMRIvols_to_AAL3() function to parcellate .nii.gz data into .dat files.
     4) Demonstrates how to generate random subsequences from artificially-created fMRI data (490 timepoints, 90 regions).
     """
-    aal_template_path = '/orange/ruogu.fang/zeyun.zhao/FSL/bb_FSL/data/standard/AAL/AAL3.nii.gz'  
+    aal_template_path = ATLASES["aal3_fsl"].path
     output_path = "/orange/ruogu.fang/zeyun.zhao/DATA/UKB_sub/rsfMRI_processed_nii/imgs"
     fmri_data_path = '/orange/ruogu.fang/zeyun.zhao/DATA/UKB_sub/rsfMRI_processed_nii/Affined'
 
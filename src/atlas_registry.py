@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Registry of the label atlases used for parcellation, with a compiled,
+memory-mappable form of each atlas.
+
+The atlas paths used to be hardcoded per script, the NIfTI was re-read and
+re-flattened for every subject, and the number of parcels (166 vs 170 for
+AAL3) was passed by hand. Here:
+  1) ATLASES maps a short name ('aal3', 'yeo17', ...) to its NIfTI file; any
+     other path works too. TEMPLATES does the same for registration
+     references ('mni152_2mm').
+  2) On first use an atlas is compiled into '<atlas>.compiled/' next to it:
+       voxel_index.npy  flat (C order) voxel indices of labels >= 1, sorted by label
+       labels.npy       labels present in the atlas
+       starts.npy       offset of each label's voxels in voxel_index
+       counts.npy       voxel count per label
+       meta.json        shape, affine, grid fingerprint, label names, source size/mtime
+     The folder is rebuilt when the atlas file changes. If the atlas folder is
+     not writable, ~/.cache/fmri_vlm/atlases is used.
+  3) Every process memory-maps the compiled arrays (np.load(mmap_mode='r'));
+     get_atlas() keeps one instance per atlas per process.
+  4) CompiledAtlas.check_image() compares the grid (shape and affine) with an
+     fMRI header before parcellating, so a subject on another grid fails loudly
+     instead of silently producing wrong parcels.
+
+Label names are read from a FSL/AAL style text file next to the atlas
+('<atlas>.txt' or '<atlas>.nii.txt', lines '<index> <name> ...') if present.
+
+Usage (example):
+  python atlas_registry.py --atlas aal3            # compile and summarize
+  python atlas_registry.py --atlas /path/to/atlas.nii.gz --check /path/to/fmri.nii.gz
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import argparse
+from dataclasses import dataclass
+
+import numpy as np
+import nibabel as nib
+
+
+@dataclass
+class AtlasEntry:
+    path: str
+    description: str = ""
+
+
+ATLASES = {
+    "aal3": AtlasEntry(
+        "/blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/AAL3.nii.gz",
+        "AAL3, MNI152 2 mm (ABIDE parcellation)"
+    ),
+    "aal3_fsl": AtlasEntry(
+        "/orange/ruogu.fang/zeyun.zhao/FSL/bb_FSL/data/standard/AAL/AAL3.nii.gz",
+        "AAL3 shipped with the UKB FSL pipeline"
+    ),
+    "yeo17": AtlasEntry(
+        "/blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/Yeo2011_17Networks_N1000.split_components.FSL_MNI152_2mm.nii.gz",
+        "Yeo 2011 17 networks, split components, MNI152 2 mm"
+    ),
+}
+
+TEMPLATES = {
+    "mni152_2mm": AtlasEntry(
+        "/blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/tpl-MNI152NLin6Asym_res-02_T1w.nii.gz",
+        "MNI152NLin6Asym T1w, 2 mm (registration reference of the AAL3 / Yeo17 grids)"
+    ),
+}
+
+COMPILED_SUFFIX = ".compiled"
+COMPILED_VERSION = 1
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "fmri_vlm", "atlases")
+
+# Affines are compared (and fingerprinted) to this many decimals (mm)
+AFFINE_DECIMALS = 4
+
+# One CompiledAtlas per atlas path per process
+_LOADED = {}
+
+
+def resolve_atlas_path(name_or_path: str) -> str:
+    """
+    The NIfTI path of a registered atlas name, or `name_or_path` itself.
+    """
+    if name_or_path in ATLASES:
+        return ATLASES[name_or_path].path
+    if os.path.isfile(name_or_path):
+        return name_or_path
+    raise ValueError(f"Unknown atlas '{name_or_path}': not a file nor one of {sorted(ATLASES)}")
+
+
+def resolve_template_path(name_or_path: str) -> str:
+    """
+    The NIfTI path of a registered registration template, or `name_or_path` itself.
+    """
+    if name_or_path in TEMPLATES:
+        return TEMPLATES[name_or_path].path
+    if os.path.isfile(name_or_path):
+        return name_or_path
+    raise ValueError(f"Unknown template '{name_or_path}': not a file nor one of {sorted(TEMPLATES)}")
+
+
+def grid_fingerprint(shape: tuple, affine: np.ndarray) -> str:
+    """
+    Short hash of a 3D grid (shape and rounded affine).
+    """
+    key = json.dumps([list(map(int, shape[:3])), np.round(np.asarray(affine, dtype=float), AFFINE_DECIMALS).tolist()])
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def read_label_names(atlas_path: str) -> dict:
+    """
+    {label: name} from '<atlas>.txt' or '<atlas>.nii.txt' next to the atlas, or {}.
+    """
+    stem = atlas_path[:-len(".nii.gz")] if atlas_path.endswith(".nii.gz") else os.path.splitext(atlas_path)[0]
+    for candidate in (f"{stem}.txt", f"{stem}.nii.txt"):
+        if not os.path.isfile(candidate):
+            continue
+        names = {}
+        with open(candidate, "r") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].isdigit():
+                    names[int(parts[0])] = parts[1]
+        return names
+    return {}
+
+
+def compiled_dir(atlas_path: str) -> str:
+    """
+    Where the compiled form of `atlas_path` lives: next to the atlas if that
+    folder is writable, else under CACHE_DIR.
+    """
+    atlas_path = os.path.abspath(atlas_path)
+    local = f"{atlas_path}{COMPILED_SUFFIX}"
+    if os.path.isdir(local) or os.access(os.path.dirname(atlas_path), os.W_OK):
+        return local
+    digest = hashlib.sha1(atlas_path.encode()).hexdigest()[:12]
+    return os.path.join(CACHE_DIR, f"{os.path.basename(atlas_path)}.{digest}{COMPILED_SUFFIX}")
+
+
+def compile_atlas(atlas_path: str, out_dir: str = None) -> str:
+    """
+    Build the compiled form of an atlas (see module docstring) and return its folder.
+    The folder is written under a temporary name and renamed into place; an
+    existing folder (stale, or current when recompiling) is moved aside first.
+    """
+    out_dir = out_dir or compiled_dir(atlas_path)
+    img = nib.load(atlas_path)
+    data = np.asanyarray(img.dataobj)
+    if data.ndim == 4 and data.shape[-1] == 1:
+        data = data[..., 0]
+    if data.ndim != 3:
+        raise ValueError(f"Expected a 3D label volume, got shape {data.shape} for {atlas_path}")
+
+    flat = np.rint(data).astype(np.int64).ravel()
+    in_atlas = np.flatnonzero(flat >= 1)
+    voxel_index = in_atlas[np.argsort(flat[in_atlas], kind="stable")]
+    sorted_labels = flat[voxel_index]
+    labels, starts, counts = np.unique(sorted_labels, return_index=True, return_counts=True)
+
+    stat = os.stat(atlas_path)
+    names = read_label_names(atlas_path)
+    meta = {
+        "version": COMPILED_VERSION,
+        "source": os.path.abspath(atlas_path),
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "shape": list(map(int, data.shape)),
+        "affine": np.asarray(img.affine, dtype=float).tolist(),
+        "fingerprint": grid_fingerprint(data.shape, img.affine),
+        "n_parcels": int(labels.max()) if len(labels) else 0,
+        "names": {str(int(label)): names[int(label)] for label in labels if int(label) in names},
+    }
+
+    os.makedirs(os.path.dirname(out_dir), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".atlas_", dir=os.path.dirname(out_dir))
+    os.chmod(tmp_dir, 0o755)
+    try:
+        index_dtype = np.int32 if flat.size < np.iinfo(np.int32).max else np.int64
+        np.save(os.path.join(tmp_dir, "voxel_index.npy"), voxel_index.astype(index_dtype))
+        np.save(os.path.join(tmp_dir, "labels.npy"), labels.astype(np.int32))
+        np.save(os.path.join(tmp_dir, "starts.npy"), starts.astype(np.int64))
+        np.save(os.path.join(tmp_dir, "counts.npy"), counts.astype(np.int64))
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        old_dir = None
+        if os.path.isdir(out_dir):
+            # Rename, not rmtree, so processes that memory-map the old arrays keep working
+            old_dir = tempfile.mkdtemp(prefix=".atlas_old_", dir=os.path.dirname(out_dir))
+            try:
+                os.replace(out_dir, os.path.join(old_dir, "compiled"))
+            except FileNotFoundError:
+                # Another process moved it aside first
+                pass
+        try:
+            os.replace(tmp_dir, out_dir)
+        except OSError:
+            # Another process (e.g. a parallel SLURM task) put a fresh folder in place first
+            if not _is_current(out_dir, atlas_path):
+                raise
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        finally:
+            if old_dir is not None:
+                shutil.rmtree(old_dir, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    print(f"Compiled {atlas_path}: {len(labels)} labels (max {meta['n_parcels']}), "
+          f"{len(voxel_index)} voxels -> {out_dir}")
+    return out_dir
+
+
+def _is_current(out_dir: str, atlas_path: str) -> bool:
+    meta_path = os.path.join(out_dir, "meta.json")
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path, "r") as f:
+        meta = json.load(f)
+    stat = os.stat(atlas_path)
+    return (meta.get("version") == COMPILED_VERSION
+            and meta.get("source_size") == stat.st_size
+            and meta.get("source_mtime_ns") == stat.st_mtime_ns)
+
+
+class CompiledAtlas:
+    """
+    Memory-mapped compiled atlas.
+
+    Attributes:
+        path (str): Source NIfTI.
+        shape (tuple): 3D grid shape.
+        affine (np.ndarray): Voxel -> mm affine.
+        fingerprint (str): grid_fingerprint(shape, affine).
+        labels (np.ndarray): Labels present (sorted).
+        counts (np.ndarray): Voxels per label.
+        starts (np.ndarray): Offset of each label in voxel_index.
+        voxel_index (np.ndarray): Flat voxel indices of labels >= 1, sorted by label.
+        n_parcels (int): Largest label (parcel columns are labels 1..n_parcels).
+        names (dict): {label: name}, possibly empty.
+    """
+
+    def __init__(self, out_dir: str):
+        with open(os.path.join(out_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.path = meta["source"]
+        self.shape = tuple(meta["shape"])
+        self.affine = np.array(meta["affine"])
+        self.fingerprint = meta["fingerprint"]
+        self.n_parcels = meta["n_parcels"]
+        self.names = {int(label): name for label, name in meta["names"].items()}
+        self.labels = np.load(os.path.join(out_dir, "labels.npy"), mmap_mode="r")
+        self.counts = np.load(os.path.join(out_dir, "counts.npy"), mmap_mode="r")
+        self.starts = np.load(os.path.join(out_dir, "starts.npy"), mmap_mode="r")
+        self.voxel_index = np.load(os.path.join(out_dir, "voxel_index.npy"), mmap_mode="r")
+
+    @property
+    def n_voxels(self) -> int:
+        return int(np.prod(self.shape))
+
+    def label_voxels(self, label: int) -> np.ndarray:
+        """
+        Flat voxel indices of one label (empty if the label is absent).
+        """
+        pos = int(np.searchsorted(self.labels, label))
+        if pos == len(self.labels) or self.labels[pos] != label:
+            return np.empty(0, dtype=self.voxel_index.dtype)
+        return self.voxel_index[self.starts[pos]:self.starts[pos] + self.counts[pos]]
+
+    def label_data(self) -> np.ndarray:
+        """
+        Flattened label array (same layout as parcellation.load_atlas).
+        """
+        flat = np.zeros(self.n_voxels, dtype=np.float64)
+        flat[self.voxel_index] = np.repeat(self.labels, self.counts)
+        return flat
+
+    def check_image(self, fmri_img, fmri_path: str = "") -> None:
+        """
+        Raise ValueError if an image's grid (shape and affine) differs from the atlas.
+        """
+        self.check_grid(fmri_img.shape, fmri_img.affine, fmri_path)
+
+    def check_grid(self, shape: tuple, affine: np.ndarray, source: str = "") -> None:
+        """
+        Raise ValueError if a grid (shape and affine) differs from the atlas.
+        """
+        shape = tuple(shape[:3])
+        if shape != self.shape:
+            raise ValueError(
+                f"Atlas {self.path} has grid {self.shape} but {source or 'the fMRI data'} has "
+                f"{shape}; the atlas and data must share a grid."
+            )
+        if grid_fingerprint(shape, affine) != self.fingerprint:
+            raise ValueError(
+                f"Atlas {self.path} and {source or 'the fMRI data'} have the same shape {shape} "
+                f"but different affines:\n{np.round(self.affine, 3)}\nvs\n{np.round(affine, 3)}"
+            )
+
+    def point_labels(self, n_parcels: int = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        (flat voxel indices, labels) of the voxels of labels 1..n_parcels
+        (default: all), sorted by label.
+        """
+        n_parcels = self.n_parcels if n_parcels is None else n_parcels
+        keep = np.asarray(self.labels) <= n_parcels
+        n_kept = int(np.sum(self.counts[keep]))
+        return np.asarray(self.voxel_index[:n_kept]), np.repeat(np.asarray(self.labels)[keep], self.counts[keep])
+
+
+def get_atlas(name_or_path: str, recompile: bool = False) -> CompiledAtlas:
+    """
+    The compiled atlas for a registered name or NIfTI path, compiling it on
+    first use (or when the source changed). Cached per process.
+    """
+    atlas_path = os.path.abspath(resolve_atlas_path(name_or_path))
+    if atlas_path in _LOADED and not recompile:
+        return _LOADED[atlas_path]
+    out_dir = compiled_dir(atlas_path)
+    if recompile or not _is_current(out_dir, atlas_path):
+        compile_atlas(atlas_path, out_dir)
+    _LOADED[atlas_path] = CompiledAtlas(out_dir)
+    return _LOADED[atlas_path]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile a label atlas and optionally check an fMRI grid against it.")
+    parser.add_argument("--atlas", required=True, help=f"Registered name ({', '.join(sorted(ATLASES))}) or NIfTI path.")
+    parser.add_argument("--check", nargs="*", default=None, help="fMRI files whose grid is checked against the atlas.")
+    parser.add_argument("--recompile", action="store_true", help="Rebuild the compiled form.")
+
+    args = parser.parse_args()
+
+    atlas = get_atlas(args.atlas, recompile=args.recompile)
+    missing = sorted(set(range(1, atlas.n_parcels + 1)) - set(atlas.labels.tolist()))
+    print(f"{atlas.path}: grid {atlas.shape}, fingerprint {atlas.fingerprint}, "
+          f"{len(atlas.labels)} labels, n_parcels {atlas.n_parcels}, labels absent: {missing}")
+    for fmri_path in args.check or []:
+        try:
+            atlas.check_image(nib.load(fmri_path), fmri_path)
+            print(f"OK  {fmri_path}")
+        except ValueError as e:
+            print(f"BAD {e}")
+
+
+if __name__ == "__main__":
+    main()
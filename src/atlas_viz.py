@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+QC images of every ROI of a label atlas (AAL3, Yeo17, Neuromark, ...).
+
+show_AAL3 (AAL_90.py) built a full Nifti1Image and ran nilearn's plot_roi for
+each of the 170 labels, one after another. Here:
+  1) One pass over the label array (scipy.ndimage.find_objects /
+     center_of_mass) gives every ROI's bounding box, voxel count and center of
+     mass, saved as '<save_dir>/roi_geometry.csv'.
+  2) ROI PNGs (three orthogonal slices through the center of mass, ROI over the
+     atlas silhouette) are drawn with the non-interactive Agg backend across a
+     process pool; each worker loads the atlas once.
+  3) Alternatively, a single contact-sheet montage shows every ROI as one tile
+     (axial slice through its center of mass, cropped to its bounding box).
+
+Usage (example):
+  python atlas_viz.py \
+    --atlas /orange/ruogu.fang/zeyun.zhao/FSL/bb_FSL/data/standard/AAL/AAL3.nii.gz \
+    --save_dir /orange/ruogu.fang/zeyun.zhao/DATA/UKB_sub/rsfMRI_processed_nii/imgs \
+    --mode montage
+"""
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy import ndimage
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+
+# Set in each worker process by _init_worker
+_WORKER_LABELS = None
+
+
+def load_label_volume(atlas_path: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (3D integer label array, affine) of an atlas; a trailing singleton 4th axis is dropped.
+    """
+    img = nib.load(atlas_path)
+    data = np.asanyarray(img.dataobj)
+    if data.ndim == 4 and data.shape[-1] == 1:
+        data = data[..., 0]
+    if data.ndim != 3:
+        raise ValueError(f"Expected a 3D label volume, got shape {data.shape} for {atlas_path}")
+    return np.rint(data).astype(np.int32), img.affine
+
+
+def roi_geometry(label_data: np.ndarray, affine: np.ndarray = None, labels: list[int] = None) -> pd.DataFrame:
+    """
+    Bounding box, voxel count and center of mass of every ROI in one pass.
+
+    Args:
+        label_data (np.ndarray): 3D integer labels (0 = background).
+        affine (np.ndarray, optional): Voxel -> mm affine, adds com_x/y/z_mm.
+        labels (List[int], optional): Labels to report (default: all non-zero labels present).
+
+    Returns:
+        pd.DataFrame: One row per label (index), columns n_voxels, com_i/j/k,
+            bbox_i0/i1/j0/j1/k0/k1 (half-open) and, with an affine, com_x/y/z_mm.
+    """
+    counts = np.bincount(label_data.ravel().clip(min=0))
+    if labels is None:
+        labels = [int(label) for label in np.flatnonzero(counts) if label > 0]
+    labels = [label for label in labels if label < len(counts) and counts[label] > 0]
+
+    boxes = ndimage.find_objects(label_data.clip(min=0), max_label=max(labels, default=0))
+    coms = ndimage.center_of_mass(np.ones(label_data.shape, dtype=np.uint8), label_data, labels)
+
+    rows = []
+    for label, com in zip(labels, coms):
+        box = boxes[label - 1]
+        rows.append({
+            "label": label,
+            "n_voxels": int(counts[label]),
+            "com_i": com[0], "com_j": com[1], "com_k": com[2],
+            "bbox_i0": box[0].start, "bbox_i1": box[0].stop,
+            "bbox_j0": box[1].start, "bbox_j1": box[1].stop,
+            "bbox_k0": box[2].start, "bbox_k1": box[2].stop,
+        })
+    geometry = pd.DataFrame(rows, columns=[
+        "label", "n_voxels", "com_i", "com_j", "com_k",
+        "bbox_i0", "bbox_i1", "bbox_j0", "bbox_j1", "bbox_k0", "bbox_k1"
+    ]).set_index("label")
+
+    if affine is not None and len(geometry):
+        ijk = geometry[["com_i", "com_j", "com_k"]].to_numpy()
+        xyz = nib.affines.apply_affine(affine, ijk)
+        geometry[["com_x_mm", "com_y_mm", "com_z_mm"]] = xyz
+    return geometry
+
+
+def _init_worker(atlas_path: str) -> None:
+    global _WORKER_LABELS
+    _WORKER_LABELS, _ = load_label_volume(atlas_path)
+
+
+def _ortho_slices(label_data: np.ndarray, label: int, center: tuple) -> list:
+    i, j, k = (int(round(c)) for c in center)
+    views = [label_data[i, :, :], label_data[:, j, :], label_data[:, :, k]]
+    return [(view > 0, view == label) for view in views]
+
+
+def render_roi(label_data: np.ndarray, label: int, center: tuple, out_path: str, title: str = None) -> str:
+    """
+    Save a PNG of one ROI: sagittal, coronal and axial slices through `center`.
+    """
+    fig, axes = plt.subplots(1, 3, figsize=(9, 3.2))
+    for ax, (brain, roi) in zip(axes, _ortho_slices(label_data, label, center)):
+        ax.imshow(brain.T, origin="lower", cmap="gray", vmin=0, vmax=2.5, interpolation="nearest")
+        ax.imshow(np.ma.masked_where(~roi.T, roi.T), origin="lower", cmap="autumn", interpolation="nearest")
+        ax.axis("off")
+    fig.suptitle(title or f"ROI Index {label}")
+    fig.savefig(out_path, dpi=100, bbox_inches="tight")
+    plt.close(fig)
+    return out_path
+
+
+def _render_roi_job(job) -> str:
+    label, center, out_path = job
+    return render_roi(_WORKER_LABELS, label, center, out_path)
+
+
+def render_rois_parallel(atlas_path: str, geometry: pd.DataFrame, save_dir: str, num_workers: int = None) -> list[str]:
+    """
+    One '<save_dir>/<label>.png' per ROI, across a process pool.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    jobs = [
+        (int(label), (row.com_i, row.com_j, row.com_k), os.path.join(save_dir, f"{int(label)}.png"))
+        for label, row in geometry.iterrows()
+    ]
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(atlas_path,)) as executor:
+        return list(executor.map(_render_roi_job, jobs, chunksize=4))
+
+
+def render_montage(
+    label_data: np.ndarray,
+    geometry: pd.DataFrame,
+    out_path: str,
+    ncols: int = 14,
+    pad: int = 4,
+    names: dict = None
+) -> str:
+    """
+    Contact sheet with one tile per ROI: the axial slice through its center of
+    mass, cropped to its bounding box (plus `pad` voxels).
+    """
+    n = len(geometry)
+    nrows = max(1, int(np.ceil(n / ncols)))
+    fig, axes = plt.subplots(nrows, ncols, figsize=(1.4 * ncols, 1.5 * nrows), squeeze=False)
+    for ax in axes.ravel():
+        ax.axis("off")
+
+    for ax, (label, row) in zip(axes.ravel(), geometry.iterrows()):
+        k = int(round(row.com_k))
+        i0, i1 = max(0, int(row.bbox_i0) - pad), min(label_data.shape[0], int(row.bbox_i1) + pad)
+        j0, j1 = max(0, int(row.bbox_j0) - pad), min(label_data.shape[1], int(row.bbox_j1) + pad)
+        tile = label_data[i0:i1, j0:j1, k]
+        ax.imshow((tile > 0).T, origin="lower", cmap="gray", vmin=0, vmax=2.5, interpolation="nearest")
+        roi = (tile == label).T
+        ax.imshow(np.ma.masked_where(~roi, roi), origin="lower", cmap="autumn", interpolation="nearest")
+        name = names.get(int(label)) if names else None
+        ax.set_title(f"{int(label)}" + (f" {name}" if name else ""), fontsize=6)
+
+    fig.tight_layout()
+    fig.savefig(out_path, dpi=120)
+    plt.close(fig)
+    return out_path
+
+
+def show_atlas(
+    atlas_path: str,
+    save_dir: str,
+    mode: str = "montage",
+    num_workers: int = None,
+    labels: list[int] = None
+) -> pd.DataFrame:
+    """
+    Write roi_geometry.csv and the ROI images ('pngs': one PNG per ROI,
+    'montage': '<save_dir>/<atlas>_montage.png', 'both').
+
+    Returns:
+        pd.DataFrame: The ROI geometry table.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    label_data, affine = load_label_volume(atlas_path)
+    geometry = roi_geometry(label_data, affine, labels)
+    geometry.to_csv(os.path.join(save_dir, "roi_geometry.csv"))
+    print(f"{len(geometry)} ROIs in {atlas_path} (grid {label_data.shape})")
+
+    if mode in ("montage", "both"):
+        atlas_name = os.path.basename(atlas_path).split(".nii")[0]
+        out_path = render_montage(label_data, geometry, os.path.join(save_dir, f"{atlas_name}_montage.png"))
+        print(f"Montage saved to {out_path}")
+    if mode in ("pngs", "both"):
+        paths = render_rois_parallel(atlas_path, geometry, save_dir, num_workers)
+        print(f"{len(paths)} ROI images saved to {save_dir}")
+    return geometry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render QC images of every ROI of a label atlas.")
+    parser.add_argument("--atlas", required=True, help="Label atlas NIfTI (e.g. AAL3.nii.gz).")
+    parser.add_argument("--save_dir", required=True, help="Output folder.")
+    parser.add_argument("--mode", choices=["montage", "pngs", "both"], default="montage", help="(default=montage)")
+    parser.add_argument("--num_workers", type=int, default=None, help="Processes for --mode pngs (default: all cores).")
+
+    args = parser.parse_args()
+
+    show_atlas(args.atlas, args.save_dir, args.mode, args.num_workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Declarative UKB cohort materializer.
+
+copy_files_AD / _PD / _control / _all.ipynb each globbed rsfMRI_zip/*, joined
+eids against trimmed_icd.pkl and unzipped or copied files one subject at a
+time. Here a cohort is one config entry (CohortSpec):
+  - ICD-10 codes and/or prefixes, and a maximum number of diagnoses
+    (e.g. MDD: F330..F339 with at most 2 mental/neural diagnoses),
+  - optional age (21022) and sex (31) filters,
+  - optional stratified subsampling by age (the controls' 10% per age).
+
+The script then:
+  1) Flags every participant once (icd_cohorts.py) and selects each cohort's eids.
+  2) Resolves the eids against the archive index (zip_index.py) in one query,
+     instead of globbing the archive folder.
+  3) Extracts the wanted member of every selected archive straight from its
+     indexed offset across a process pool ('extract'), or links the archives
+     themselves into a per-cohort folder ('link', hardlink/reflink/copy as in
+     bids_materialize.py). Existing outputs are skipped, so re-runs only add
+     new subjects.
+  4) Writes '<output_dir>/cohorts/<name>.csv' (eid, sex, age, archive, output path).
+
+Cohorts are read from a JSON file ({"cohorts": [{...}, ...]}), or
+DEFAULT_COHORTS (the cohorts of copy_files_all.ipynb) are used.
+
+Usage (example):
+  python cohort_materialize.py \
+    --flags ../results/2025_01_21_metadata_eda/proc/trimmed_icd.pkl \
+    --zip_index /orange/ruogu.fang/data/UKB/brain/20227_rsfMRI_NIFTI/zip_index.sqlite \
+    --output_dir /blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/UKB/brain/20227_rsfMRI_NIFTI \
+    --cohorts MDD BPD AD PD control
+"""
+
+import os
+import json
+import argparse
+from dataclasses import dataclass, field, asdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from icd_cohorts import (
+    AGE_COLUMN, SEX_COLUMN, flag_cohorts, read_diagnosis_table, diagnoses_from_lists, select_cohort
+)
+from zip_index import lookup_members, extract_indexed_member
+from bids_materialize import BidsEntry, materialize_entry, DEFAULT_METHODS
+
+
+TARGET_MEMBER = "fMRI/rfMRI.ica/filtered_func_data_clean.nii.gz"
+
+
+@dataclass
+class CohortSpec:
+    """
+    One cohort. A participant is selected if they have any of `codes` (exact)
+    or `prefixes`, at most `max_diagnoses` diagnoses in `count_column`, and
+    pass the age/sex filters. Without codes/prefixes only the count is used.
+
+    Args:
+        name (str): Cohort name (output subfolder / manifest name).
+        codes (List[str]): Exact ICD-10 codes, e.g. ["G309"].
+        prefixes (List[str]): ICD-10 prefixes, e.g. ["F33"].
+        max_diagnoses (int): Maximum diagnosis count, None for no limit.
+        count_column (str): 'n_mental_and_neural_diagnoses' or 'n_diagnoses'.
+        min_age, max_age (float): Inclusive age range on field 21022.
+        sex (int): Field 31 value to keep (0 female, 1 male), None for both.
+        sample_frac (float): Fraction sampled within each age, None for all.
+        seed (int): Random seed of the subsampling.
+    """
+    name: str
+    codes: list[str] = field(default_factory=list)
+    prefixes: list[str] = field(default_factory=list)
+    max_diagnoses: int = None
+    count_column: str = "n_mental_and_neural_diagnoses"
+    min_age: float = None
+    max_age: float = None
+    sex: int = None
+    sample_frac: float = None
+    seed: int = 0
+
+
+# Diagnosis count columns of the flag table, and the list column each one counts
+DIAGNOSIS_COUNT_COLUMNS = {
+    "n_diagnoses": "all_diagnoses",
+    "n_mental_and_neural_diagnoses": "mental_and_neural_diagnoses",
+}
+
+# The cohorts of copy_files_all.ipynb
+DEFAULT_COHORTS = [
+    CohortSpec("MDD", codes=["F330", "F331", "F332", "F338", "F339"], max_diagnoses=2),
+    CohortSpec("BPD", codes=["F310", "F311", "F312", "F316", "F319"], max_diagnoses=2),
+    CohortSpec("AD", codes=["G309"], max_diagnoses=1),
+    CohortSpec("PD", codes=["G20"], max_diagnoses=1),
+    CohortSpec("control", max_diagnoses=0, count_column="n_diagnoses", sample_frac=0.1),
+]
+
+
+def load_cohort_specs(config_path: str = None) -> list[CohortSpec]:
+    """
+    Cohorts from a JSON file ({"cohorts": [...]} or a plain list), or DEFAULT_COHORTS.
+    """
+    if config_path is None:
+        return list(DEFAULT_COHORTS)
+    with open(config_path, "r") as f:
+        config = json.load(f)
+    entries = config["cohorts"] if isinstance(config, dict) else config
+    return [CohortSpec(**entry) for entry in entries]
+
+
+def add_diagnosis_counts(flags: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add the n_* count columns a saved flag table lacks (icd_eda.ipynb's
+    trimmed_icd.pkl only has the lists), from the lengths of its list columns.
+    """
+    for count_column, list_column in DIAGNOSIS_COUNT_COLUMNS.items():
+        if count_column in flags.columns:
+            continue
+        if list_column not in flags.columns:
+            raise ValueError(
+                f"Flag table has neither '{count_column}' nor the '{list_column}' list to count it from"
+            )
+        flags[count_column] = flags[list_column].map(
+            lambda codes: len(codes) if isinstance(codes, (list, tuple, np.ndarray)) else 0
+        )
+    return flags
+
+
+def load_flags(flags_path: str = None, ukb_path: str = None):
+    """
+    (flag table, DiagnosisMatrix) from a saved flag table (trimmed_icd.pkl) or
+    from the UKB CSV / filter_ukb_csv.py Parquet folder.
+    """
+    if flags_path is not None:
+        flags = add_diagnosis_counts(pd.read_pickle(flags_path).reset_index(drop=True))
+        return flags, diagnoses_from_lists(flags)
+    return flag_cohorts(read_diagnosis_table(ukb_path), with_lists=False)
+
+
+def select_eids(flags: pd.DataFrame, diagnoses, spec: CohortSpec, available: set = None) -> pd.DataFrame:
+    """
+    Rows of `flags` in the cohort, restricted to eids in `available` (if given)
+    before subsampling, like the notebooks' file_downloaded filter.
+    """
+    mask = select_cohort(flags, diagnoses, spec.prefixes, spec.codes, spec.max_diagnoses, spec.count_column)
+    if spec.min_age is not None:
+        mask &= flags[AGE_COLUMN].to_numpy() >= spec.min_age
+    if spec.max_age is not None:
+        mask &= flags[AGE_COLUMN].to_numpy() <= spec.max_age
+    if spec.sex is not None:
+        mask &= flags[SEX_COLUMN].to_numpy() == spec.sex
+    if available is not None:
+        mask &= flags["eid"].astype(str).isin(available).to_numpy()
+
+    selected = flags[mask]
+    if spec.sample_frac is not None:
+        selected = selected.groupby(AGE_COLUMN, group_keys=False).sample(
+            frac=spec.sample_frac, random_state=spec.seed
+        )
+    return selected.sort_values("eid")
+
+
+def _extract_entry(args):
+    entry, target_path = args
+    try:
+        return extract_indexed_member(entry, target_path)
+    except (OSError, ValueError) as e:
+        print(f"Error extracting {entry['archive_path']}: {e}")
+        return "failed"
+
+
+def materialize_cohorts(
+    specs: list[CohortSpec],
+    flags: pd.DataFrame,
+    diagnoses,
+    zip_index_path: str,
+    output_dir: str,
+    member: str = TARGET_MEMBER,
+    mode: str = "extract",
+    instance: str = None,
+    num_workers: int = None
+) -> dict:
+    """
+    Select, resolve and materialize every cohort.
+
+    In 'extract' mode each subject's member goes to '<output_dir>/<eid>/<member>'
+    (shared by all cohorts the subject is in, as in copy_files_all.ipynb). In
+    'link' mode the archives are placed in '<output_dir>/<cohort>/'. One archive
+    per eid is used: the given `instance`, else the first indexed one.
+
+    Returns:
+        dict: {cohort name: manifest DataFrame}.
+    """
+    entries = lookup_members(zip_index_path, member)
+    by_eid = {}
+    for entry in entries:
+        if instance is None or entry["instance"] == instance:
+            by_eid.setdefault(entry["eid"], entry)
+    print(f"{len(by_eid)} eids have '{member}' in {zip_index_path}")
+
+    manifests, jobs = {}, {}
+    for spec in specs:
+        cohort = select_eids(flags, diagnoses, spec, available=set(by_eid))
+        eids = cohort["eid"].astype(str).tolist()
+        targets = []
+        for eid in eids:
+            entry = by_eid[eid]
+            if mode == "extract":
+                target = os.path.join(output_dir, eid, member)
+            else:
+                target = os.path.join(output_dir, spec.name, os.path.basename(entry["archive_path"]))
+            jobs[target] = entry
+            targets.append(target)
+        manifests[spec.name] = pd.DataFrame({
+            "eid": eids,
+            "sex": cohort[SEX_COLUMN].to_numpy() if SEX_COLUMN in cohort.columns else None,
+            "age": cohort[AGE_COLUMN].to_numpy() if AGE_COLUMN in cohort.columns else None,
+            "archive_path": [by_eid[eid]["archive_path"] for eid in eids],
+            "path": targets,
+        })
+        print(f"Cohort {spec.name}: {len(eids)} subjects")
+
+    if mode == "extract":
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            outcomes = list(executor.map(_extract_entry, [(e, t) for t, e in jobs.items()], chunksize=4))
+    else:
+        with ThreadPoolExecutor(max_workers=num_workers or 16) as executor:
+            outcomes = list(executor.map(
+                lambda item: materialize_entry(BidsEntry(item[1]["archive_path"], item[0]), DEFAULT_METHODS),
+                jobs.items()
+            ))
+    counts = dict(zip(*np.unique(outcomes, return_counts=True))) if outcomes else {}
+    print(f"Materialized {len(jobs)} files: " + ", ".join(f"{k}: {int(v)}" for k, v in counts.items()))
+
+    failed = {target for target, outcome in zip(jobs, outcomes) if outcome == "failed"}
+    manifest_dir = os.path.join(output_dir, "cohorts")
+    os.makedirs(manifest_dir, exist_ok=True)
+    for name, manifest in manifests.items():
+        manifest = manifest[~manifest["path"].isin(failed)]
+        manifest.to_csv(os.path.join(manifest_dir, f"{name}.csv"), index=False)
+        manifests[name] = manifest
+    return manifests
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Select UKB cohorts and extract/link their files in parallel.")
+    parser.add_argument("--flags", default=None, help="Saved flag table (e.g. proc/trimmed_icd.pkl).")
+    parser.add_argument("--ukb", default=None, help="UKB CSV or filter_ukb_csv.py Parquet folder (if no --flags).")
+    parser.add_argument("--zip_index", required=True, help="SQLite archive index built by zip_index.py.")
+    parser.add_argument("--output_dir", required=True, help="Where files and cohorts/<name>.csv are written.")
+    parser.add_argument("--config", default=None, help="JSON cohort specs (default: the copy_files_all cohorts).")
+    parser.add_argument("--cohorts", nargs="*", default=None, help="Only materialize these cohort names.")
+    parser.add_argument("--member", default=TARGET_MEMBER, help=f"Archive member to extract. (default={TARGET_MEMBER})")
+    parser.add_argument("--mode", choices=["extract", "link"], default="extract", help="(default=extract)")
+    parser.add_argument("--instance", default=None, help="Archive instance to use, e.g. 2_0 (default: first indexed).")
+    parser.add_argument("--num_workers", type=int, default=None, help="Parallel workers (default: all cores).")
+    parser.add_argument("--dry_run", action="store_true", help="Only print the cohort specs and sizes.")
+
+    args = parser.parse_args()
+    if args.flags is None and args.ukb is None:
+        parser.error("one of --flags or --ukb is required")
+
+    specs = load_cohort_specs(args.config)
+    if args.cohorts:
+        specs = [spec for spec in specs if spec.name in args.cohorts]
+    flags, diagnoses = load_flags(args.flags, args.ukb)
+
+    if args.dry_run:
+        for spec in specs:
+            print(f"{spec.name}: {len(select_eids(flags, diagnoses, spec))} participants  {asdict(spec)}")
+        return
+
+    materialize_cohorts(
+        specs, flags, diagnoses, args.zip_index, args.output_dir,
+        member=args.member, mode=args.mode, instance=args.instance, num_workers=args.num_workers
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+Nearest-neighbour index over subject connectivity fingerprints.
+
+Normative modeling and retrieval (the controls most similar to a patient)
+used ad hoc pairwise loops in notebooks. Here each subject is the upper
+triangle of its Fisher-z connectivity matrix (13,695 edges for 166 AAL3
+regions), and:
+  1) Exact search is brute force as blocked GEMM: squared distances
+     |q|^2 + |x|^2 - 2 q.x for a block of indexed subjects at a time, with a
+     running top-k merged by np.argpartition, so memory stays bounded.
+  2) Approximate search reduces the vectors with PCA (fit on a sample), splits
+     the reduced space into k-means partitions and, per query, only scans the
+     `n_probe` nearest partitions, optionally re-ranking the candidates with
+     the full vectors.
+  3) Queries take metadata filters (e.g. {"SITE_ID": "NYU", "DX_GROUP": 2}),
+     and matched_controls() builds a same-site control set for every patient
+     in one batched search per site.
+
+Usage (example, ABIDE: 10 same-site controls per autism subject):
+  python connectome_index.py \
+    --connectivity /blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/ABIDE_connectivity/ledoit_wolf.npz \
+    --phenotype /blue/ruogu.fang/ryoi360/projects/fmri_vlm/results/2025_03_03_abide_abnormality_detection/Phenotypic_V1_0b.csv \
+    --out matched_controls.csv --k 10
+"""
+
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from connectivity import fisher_z
+
+
+# connectivity.py kinds that are correlations, Fisher-z transformed before indexing
+CORRELATION_KINDS = ("correlation", "partial_correlation")
+
+# Indexed subjects scored per GEMM block
+DEFAULT_BLOCK = 4096
+
+
+def upper_triangle(mats: np.ndarray, k: int = 1) -> np.ndarray:
+    """
+    (B, N, N) -> (B, N (N - 1) / 2) upper-triangle edge vectors (float32).
+    """
+    iu, ju = np.triu_indices(mats.shape[-1], k=k)
+    return np.ascontiguousarray(mats[:, iu, ju], dtype=np.float32)
+
+
+def _kmeans(data: np.ndarray, n_clusters: int, n_iter: int = 20, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Plain Lloyd iterations on (small, PCA-reduced) data: (centroids, assignment).
+    """
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignment = _sq_distances(data, centroids).argmin(axis=1)
+        for c in range(n_clusters):
+            members = data[assignment == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+    return centroids, _sq_distances(data, centroids).argmin(axis=1)
+
+
+def _sq_distances(queries: np.ndarray, data: np.ndarray, data_sq: np.ndarray = None) -> np.ndarray:
+    if data_sq is None:
+        data_sq = np.einsum("ij,ij->i", data, data)
+    queries_sq = np.einsum("ij,ij->i", queries, queries)
+    return np.maximum(queries_sq[:, None] + data_sq[None, :] - 2.0 * (queries @ data.T), 0.0)
+
+
+class ConnectomeIndex:
+    """
+    Exact and approximate k-NN over connectivity edge vectors.
+
+    Args:
+        vectors (np.ndarray): (n_subjects, n_edges) Fisher-z edge vectors.
+        subject_ids (List[str]): One identifier per row.
+        metadata (pd.DataFrame, optional): One row per subject (same order),
+            columns usable in `where` filters (site, group, sex, age, ...).
+    """
+
+    def __init__(self, vectors: np.ndarray, subject_ids: list[str], metadata: pd.DataFrame = None):
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.sq_norms = np.einsum("ij,ij->i", self.vectors, self.vectors)
+        self.subject_ids = np.asarray(subject_ids).astype(str)
+        self.positions = {subject_id: i for i, subject_id in enumerate(self.subject_ids)}
+        self.metadata = metadata.reset_index(drop=True) if metadata is not None else pd.DataFrame(index=range(len(self.vectors)))
+
+        # Set by build_approximate()
+        self.mean = None
+        self.components = None
+        self.reduced = None
+        self.centroids = None
+        self.partitions = None
+
+    @classmethod
+    def from_matrices(cls, mats: np.ndarray, subject_ids: list[str], metadata: pd.DataFrame = None, is_correlation: bool = True):
+        """
+        Index a (B, N, N) stack; correlations are Fisher-z transformed first.
+        """
+        return cls(upper_triangle(fisher_z(mats) if is_correlation else mats), subject_ids, metadata)
+
+    def mask(self, where: dict = None) -> np.ndarray:
+        """
+        Boolean mask of indexed subjects whose metadata matches every
+        {column: value or list of values} in `where`.
+        """
+        allowed = np.ones(len(self.vectors), dtype=bool)
+        for column, value in (where or {}).items():
+            values = value if isinstance(value, (list, tuple, set, np.ndarray)) else [value]
+            allowed &= self.metadata[column].isin(list(values)).to_numpy()
+        return allowed
+
+    def _as_queries(self, queries) -> tuple[np.ndarray, np.ndarray]:
+        """
+        (query vectors, their index positions or -1): queries are subject IDs or vectors.
+        """
+        if isinstance(queries, np.ndarray) and queries.dtype.kind == "f":
+            queries = np.atleast_2d(queries).astype(np.float32)
+            return queries, np.full(len(queries), -1)
+        positions = np.array([self.positions[str(q)] for q in np.atleast_1d(queries)])
+        return self.vectors[positions], positions
+
+    def search(self, queries, k: int = 10, where: dict = None, allowed: np.ndarray = None,
+               exclude_self: bool = True, block: int = DEFAULT_BLOCK) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Exact top-k neighbours by Euclidean distance.
+
+        Args:
+            queries: Subject IDs in the index, or a (Q, n_edges) float array.
+            k (int): Neighbours per query.
+            where (dict, optional): Metadata filter on the candidates.
+            allowed (np.ndarray, optional): Boolean candidate mask (combined with `where`).
+            exclude_self (bool): Do not return a query subject as its own neighbour.
+            block (int): Indexed subjects per GEMM block.
+
+        Returns:
+            (np.ndarray, np.ndarray): (Q, k) distances and index positions,
+                sorted by distance (inf / -1 where fewer than k candidates).
+        """
+        query_vectors, self_positions = self._as_queries(queries)
+        candidates = self.mask(where) if allowed is None else allowed & self.mask(where)
+        n_queries = len(query_vectors)
+        best_d = np.full((n_queries, k), np.inf, dtype=np.float32)
+        best_i = np.full((n_queries, k), -1)
+        rows = np.arange(n_queries)
+
+        for start in range(0, len(self.vectors), block):
+            stop = min(start + block, len(self.vectors))
+            keep = np.flatnonzero(candidates[start:stop])
+            if len(keep) == 0:
+                continue
+            index = start + keep
+            d = _sq_distances(query_vectors, self.vectors[index], self.sq_norms[index])
+            if exclude_self:
+                d[self_positions[:, None] == index[None, :]] = np.inf
+            all_d = np.concatenate([best_d, d], axis=1)
+            all_i = np.concatenate([best_i, np.broadcast_to(index, d.shape)], axis=1)
+            top = np.argpartition(all_d, k - 1, axis=1)[:, :k]
+            best_d, best_i = all_d[rows[:, None], top], all_i[rows[:, None], top]
+
+        order = np.argsort(best_d, axis=1)
+        best_d, best_i = best_d[rows[:, None], order], best_i[rows[:, None], order]
+        best_i[~np.isfinite(best_d)] = -1
+        return np.sqrt(best_d), best_i
+
+    def build_approximate(self, n_components: int = 64, n_partitions: int = None, sample: int = 5000, seed: int = 0) -> None:
+        """
+        PCA (fit on up to `sample` subjects) and k-means partitions of the
+        reduced vectors (default ~sqrt(n_subjects) partitions).
+        """
+        rng = np.random.default_rng(seed)
+        fit_rows = rng.choice(len(self.vectors), min(sample, len(self.vectors)), replace=False)
+        self.mean = self.vectors[fit_rows].mean(axis=0)
+        _, _, vt = np.linalg.svd(self.vectors[fit_rows] - self.mean, full_matrices=False)
+        self.components = np.ascontiguousarray(vt[:n_components].T, dtype=np.float32)
+        self.reduced = (self.vectors - self.mean) @ self.components
+
+        n_partitions = n_partitions or max(1, int(np.sqrt(len(self.vectors))))
+        self.centroids, self.partitions = _kmeans(self.reduced, min(n_partitions, len(self.vectors)), seed=seed)
+        print(f"Approximate index: {self.components.shape[1]} components, {len(self.centroids)} partitions")
+
+    def search_approximate(self, queries, k: int = 10, where: dict = None, n_probe: int = 4,
+                           rerank: bool = True, exclude_self: bool = True) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Top-k among the subjects of the `n_probe` partitions nearest to each
+        query (PCA space), re-ranked with the full vectors if `rerank`.
+        Same return values as search().
+        """
+        if self.components is None:
+            self.build_approximate()
+        query_vectors, self_positions = self._as_queries(queries)
+        reduced_queries = (query_vectors - self.mean) @ self.components
+        probes = np.argsort(_sq_distances(reduced_queries, self.centroids), axis=1)[:, :n_probe]
+        candidates = self.mask(where)
+
+        distances = np.full((len(query_vectors), k), np.inf, dtype=np.float32)
+        indices = np.full((len(query_vectors), k), -1)
+        # Queries probing the same partitions share one candidate scan
+        groups = {}
+        for q, probe in enumerate(probes):
+            groups.setdefault(tuple(sorted(probe)), []).append(q)
+        # One extra neighbour per query in case the query itself is returned
+        n_fetch = k + 1 if exclude_self else k
+        for probe, members in groups.items():
+            members = np.array(members)
+            pool = candidates & np.isin(self.partitions, probe)
+            if rerank:
+                d, i = self.search(query_vectors[members], n_fetch, allowed=pool, exclude_self=False)
+            else:
+                index = np.flatnonzero(pool)
+                sq = _sq_distances(reduced_queries[members], self.reduced[index])
+                top = np.argsort(sq, axis=1)[:, :n_fetch]
+                d = np.sqrt(np.take_along_axis(sq, top, axis=1))
+                i = index[top]
+            if exclude_self:
+                own = i == self_positions[members][:, None]
+                d, i = np.where(own, np.inf, d), np.where(own, -1, i)
+                order = np.argsort(d, axis=1, kind="stable")
+                d, i = np.take_along_axis(d, order, axis=1), np.take_along_axis(i, order, axis=1)
+            d, i = d[:, :k], i[:, :k]
+            distances[members, :d.shape[1]], indices[members, :i.shape[1]] = d, i
+        return distances, indices
+
+    def save(self, path: str) -> None:
+        np.savez(path, vectors=self.vectors, subject_ids=self.subject_ids)
+        if len(self.metadata.columns):
+            self.metadata.to_csv(path + ".metadata.csv", index=False)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            vectors, subject_ids = data["vectors"], data["subject_ids"]
+        metadata_path = path + ".metadata.csv"
+        metadata = pd.read_csv(metadata_path) if os.path.exists(metadata_path) else None
+        return cls(vectors, subject_ids, metadata)
+
+
+def matched_controls(
+    index: ConnectomeIndex,
+    patient_ids: list[str],
+    k: int = 10,
+    control_where: dict = None,
+    match_on: list[str] = None,
+    approximate: bool = False
+) -> pd.DataFrame:
+    """
+    The k nearest controls of every patient, restricted to controls with the
+    same values in `match_on` (e.g. ['SITE_ID']). Patients sharing those values
+    are searched together in one batched query.
+
+    Returns:
+        pd.DataFrame: patient, rank, control, distance.
+    """
+    match_on = match_on or []
+    positions = np.array([index.positions[str(p)] for p in patient_ids])
+    patients = index.metadata.iloc[positions].assign(_position=positions)
+    rows = []
+    groups = patients.groupby(match_on, dropna=False) if match_on else [((), patients)]
+    for key, group in groups:
+        key = key if isinstance(key, tuple) else (key,)
+        where = dict(control_where or {})
+        where.update(dict(zip(match_on, [[value] for value in key])))
+        queries = index.subject_ids[group["_position"].to_numpy()]
+        if approximate:
+            distances, neighbours = index.search_approximate(queries, k, where)
+        else:
+            distances, neighbours = index.search(queries, k, where)
+        for patient, d_row, i_row in zip(queries, distances, neighbours):
+            for rank, (d, i) in enumerate(zip(d_row, i_row)):
+                if i >= 0:
+                    rows.append({"patient": patient, "rank": rank, "control": index.subject_ids[i], "distance": float(d)})
+    return pd.DataFrame(rows, columns=["patient", "rank", "control", "distance"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Match each patient to its k nearest controls by connectivity.")
+    parser.add_argument("--connectivity", required=True, help="npz from connectivity.py (subject_ids + a (B, N, N) array).")
+    parser.add_argument("--kind", default="correlation", help="Array in the npz; only (partial) correlations are Fisher-z transformed. (default=correlation)")
+    parser.add_argument("--phenotype", required=True, help="Phenotype CSV (e.g. ABIDE Phenotypic_V1_0b.csv).")
+    parser.add_argument("--id_col", default="FILE_ID", help="(default=FILE_ID)")
+    parser.add_argument("--group_col", default="DX_GROUP", help="(default=DX_GROUP)")
+    parser.add_argument("--control_value", default="2", help="Group value of the controls. (default=2)")
+    parser.add_argument("--match_on", nargs="*", default=["SITE_ID"], help="Columns the controls must share. (default=SITE_ID)")
+    parser.add_argument("--k", type=int, default=10, help="(default=10)")
+    parser.add_argument("--approximate", action="store_true", help="PCA + partitioned search instead of exact.")
+    parser.add_argument("--out", required=True, help="Output CSV (patient, rank, control, distance).")
+
+    args = parser.parse_args()
+
+    with np.load(args.connectivity) as data:
+        mats, subject_ids = data[args.kind], data["subject_ids"].astype(str)
+    phenotype = pd.read_csv(args.phenotype)
+    phenotype = phenotype.assign(_key=phenotype[args.id_col].astype(str)).drop_duplicates("_key").set_index("_key")
+    known = np.isin(subject_ids, phenotype.index)
+    if not known.all():
+        print(f"Skipped {int((~known).sum())} subjects without a phenotype row.")
+    metadata = phenotype.loc[subject_ids[known]].reset_index(drop=True)
+    metadata[args.group_col] = metadata[args.group_col].astype(str)
+
+    index = ConnectomeIndex.from_matrices(mats[known], subject_ids[known], metadata, is_correlation=args.kind in CORRELATION_KINDS)
+    is_control = metadata[args.group_col] == args.control_value
+    patients = index.subject_ids[~is_control.to_numpy()]
+    print(f"{len(index.subject_ids)} subjects indexed, {len(patients)} patients, {int(is_control.sum())} controls")
+
+    matches = matched_controls(
+        index, patients, args.k, {args.group_col: args.control_value}, args.match_on, args.approximate
+    )
+    matches.to_csv(args.out, index=False)
+    print(f"{len(matches)} matches written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+Batched confound regression and band-pass filtering of parcel time series.
+
+After parcellation the only clean-up was `pmTS[np.isnan(pmTS)] = 0`; nuisance
+regression or temporal filtering had to be done per subject in notebooks.
+Working on (T, R) parcel series (166 AAL3 parcels instead of ~200k voxels), a
+whole cohort is denoised with a few batched linear-algebra calls:
+  1) Subjects are grouped by (TR, timepoints, confounds) and stacked into
+     (B, T, R) series and (B, T, K) design matrices (confounds plus intercept
+     and linear trend).
+  2) Zero-phase Butterworth band-pass (scipy.signal.sosfiltfilt) runs along
+     the time axis of the whole stack; the confounds are filtered with the
+     same filter so the regression does not re-introduce filtered-out
+     frequencies.
+  3) All regressions of a group are solved at once: a batched SVD of the
+     design stack gives an orthonormal basis of each design (rank-deficient
+     columns dropped, as np.linalg.lstsq would), and the residual is
+     Y - U (U^T Y).
+  4) Denoised series are written as .dat files to the output store.
+
+Confounds per subject can come from a whitespace/tab-delimited file (e.g. the
+UKB rfMRI.ica/mc/prefiltered_func_data_mcf.par motion parameters, or an fMRIPrep
+confounds .tsv with a header) and/or the global signal saved by the scan QC of
+segment_single_fMRI.py (<name>.qc.npz, see scan_qc.py).
+
+The TR is per subject (ABIDE's depends on the site): a TR column of a table
+keyed by subject ID (--tr_csv), else pixdim[4] of the subject's NIfTI header
+(--nifti_dir), else the cohort-wide --tr. A subject without a TR is an error.
+
+Usage (example, ABIDE AAL3 series, TR from the func_preproc headers, global signal regression):
+  python denoise.py \
+    --in_dir /blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/ABIDE_parcelled \
+    --out_dir /blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/ABIDE_parcelled_denoised \
+    --nifti_dir /blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/ABIDE_preprocessed \
+    --global_signal
+
+Usage (example, UKB, one TR for every subject):
+  python denoise.py --in_dir <parcel dir> --out_dir <output dir> --tr 0.735
+"""
+
+import os
+import glob
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy import signal
+
+from fmri_loader import load_dat_file, parse_abide_subject_id
+from parcellation import save_timeseries
+
+
+# Conventional resting-state band (Hz)
+DEFAULT_LOW_HZ = 0.01
+DEFAULT_HIGH_HZ = 0.1
+
+# Subjects denoised per batched call
+DEFAULT_BATCH_SIZE = 256
+
+
+def butter_sos(tr: float, low_hz: float = DEFAULT_LOW_HZ, high_hz: float = DEFAULT_HIGH_HZ, order: int = 2) -> np.ndarray:
+    """
+    Second-order sections of a Butterworth filter for sampling interval `tr` (s):
+    band-pass, or high-/low-pass when `high_hz`/`low_hz` is None. A cutoff at
+    or above Nyquist is dropped.
+    """
+    nyquist = 0.5 / tr
+    if high_hz is not None and high_hz >= nyquist:
+        high_hz = None
+    if low_hz is not None and high_hz is not None:
+        return signal.butter(order, [low_hz, high_hz], btype="bandpass", fs=1.0 / tr, output="sos")
+    if low_hz is not None:
+        return signal.butter(order, low_hz, btype="highpass", fs=1.0 / tr, output="sos")
+    if high_hz is not None:
+        return signal.butter(order, high_hz, btype="lowpass", fs=1.0 / tr, output="sos")
+    return None
+
+
+def temporal_filter(series: np.ndarray, sos: np.ndarray, axis: int = -2) -> np.ndarray:
+    """
+    Zero-phase (forward-backward) filtering of a whole stack along `axis` (time).
+    The edge padding is shortened for series shorter than scipy's default.
+    """
+    if sos is None:
+        return series
+    n_timepoints = series.shape[axis]
+    padlen = min(3 * (2 * len(sos) + 1), n_timepoints - 1)
+    return signal.sosfiltfilt(sos, series, axis=axis, padlen=padlen)
+
+
+def design_matrix(confounds: np.ndarray, n_timepoints: int, detrend: bool = True) -> np.ndarray:
+    """
+    (T, K) design: intercept, optional linear trend, then the confound columns
+    (NaNs, e.g. the first row of derivative columns, become 0).
+    """
+    columns = [np.ones(n_timepoints)]
+    if detrend:
+        columns.append(np.linspace(-1.0, 1.0, n_timepoints))
+    if confounds is not None and confounds.size:
+        confounds = np.nan_to_num(np.asarray(confounds, dtype=np.float64).reshape(n_timepoints, -1))
+        columns.extend(confounds.T)
+    return np.column_stack(columns)
+
+
+def regress_out(series: np.ndarray, designs: np.ndarray, rcond: float = 1e-10) -> np.ndarray:
+    """
+    Residuals of every (T, R) series after least-squares regression on its (T, K) design.
+
+    Args:
+        series (np.ndarray): (B, T, R) stack.
+        designs (np.ndarray): (B, T, K) stack.
+        rcond (float): Singular values below rcond * largest are treated as zero.
+
+    Returns:
+        np.ndarray: (B, T, R) residuals.
+    """
+    # Scale columns so the rank cut-off does not depend on confound units
+    norms = np.linalg.norm(designs, axis=1, keepdims=True)
+    designs = designs / np.where(norms > 0, norms, 1.0)
+    u, s, _ = np.linalg.svd(designs, full_matrices=False)
+    u = u * (s > rcond * s[:, :1])[:, None, :]
+    return series - u @ (u.transpose(0, 2, 1) @ series)
+
+
+def denoise_stack(
+    series: np.ndarray,
+    confounds: np.ndarray = None,
+    tr: float = None,
+    low_hz: float = DEFAULT_LOW_HZ,
+    high_hz: float = DEFAULT_HIGH_HZ,
+    order: int = 2,
+    detrend: bool = True,
+    standardize: bool = False
+) -> np.ndarray:
+    """
+    Denoise a stack of equal-length subjects.
+
+    Args:
+        series (np.ndarray): (B, T, R) parcel time series.
+        confounds (np.ndarray, optional): (B, T, K) confounds (K may be 0).
+        tr (float, optional): Repetition time in s; no filtering if None.
+        low_hz, high_hz (float, optional): Band edges (None for high-/low-pass only).
+        order (int, optional): Butterworth order (applied twice by filtfilt).
+        detrend (bool, optional): Also regress out a linear trend.
+        standardize (bool, optional): z-score each parcel afterwards.
+
+    Returns:
+        np.ndarray: (B, T, R) denoised series (all-zero parcels stay zero).
+    """
+    series = np.asarray(series, dtype=np.float64)
+    n_subjects, n_timepoints, _ = series.shape
+    empty = ~series.any(axis=1, keepdims=True)
+
+    designs = np.stack([
+        design_matrix(None if confounds is None else confounds[b], n_timepoints, detrend)
+        for b in range(n_subjects)
+    ])
+    sos = butter_sos(tr, low_hz, high_hz, order) if tr is not None else None
+    if sos is not None:
+        series = temporal_filter(series, sos)
+        # Filter the confounds too (the intercept column stays as it is)
+        designs[:, :, 1:] = temporal_filter(designs[:, :, 1:], sos)
+
+    cleaned = regress_out(series, designs)
+    if standardize:
+        std = cleaned.std(axis=1, keepdims=True)
+        cleaned = cleaned / np.where(std > 0, std, 1.0)
+    cleaned[np.broadcast_to(empty, cleaned.shape)] = 0.0
+    return cleaned
+
+
+def load_confounds(path: str) -> np.ndarray:
+    """
+    (T, K) confounds from a .tsv/.csv with a header (fMRIPrep) or a headerless
+    whitespace-delimited file (FSL .par, .txt).
+    """
+    if path.endswith((".tsv", ".csv")):
+        return pd.read_csv(path, sep="\t" if path.endswith(".tsv") else ",").to_numpy(dtype=np.float64)
+    data = np.loadtxt(path)
+    return data[:, None] if data.ndim == 1 else data
+
+
+def qc_global_signal(dat_path: str) -> np.ndarray:
+    """
+    Global signal saved next to a .dat by segment_single_fMRI.py --qc_table.
+    """
+    with np.load(dat_path[:-len(".dat")] + ".qc.npz") as qc:
+        return qc["global_signal"]
+
+
+def nifti_tr(path: str) -> float:
+    """
+    Repetition time in s from pixdim[4] of a NIfTI header (None if unset).
+    """
+    header = nib.load(path).header
+    zooms = header.get_zooms()
+    tr = float(zooms[3]) if len(zooms) > 3 else 0.0
+    if header.get_xyzt_units()[1] == "msec":
+        tr /= 1000.0
+    return tr if tr > 0 else None
+
+
+def subject_trs(
+    dat_paths: list[str],
+    tr: float = None,
+    tr_table: pd.DataFrame = None,
+    id_col: str = "FILE_ID",
+    tr_col: str = "TR",
+    nifti_dir: str = None,
+    nifti_suffix: str = "_func_preproc.nii.gz",
+    id_from_path=parse_abide_subject_id
+) -> dict:
+    """
+    TR of every subject: its `tr_col` value in `tr_table`, else pixdim[4] of
+    '<nifti_dir>/<subject id><nifti_suffix>', else the cohort-wide `tr`.
+
+    Returns:
+        dict: {dat path: TR in s}; subjects without any TR are left out.
+    """
+    table_trs = {}
+    if tr_table is not None:
+        table = tr_table.dropna(subset=[tr_col])
+        table_trs = dict(zip(table[id_col].astype(str), table[tr_col].astype(float)))
+
+    trs = {}
+    for path in dat_paths:
+        subject_id = id_from_path(path)
+        subject_tr = table_trs.get(subject_id)
+        if subject_tr is None and nifti_dir is not None:
+            nifti_path = os.path.join(nifti_dir, subject_id + nifti_suffix)
+            if os.path.isfile(nifti_path):
+                subject_tr = nifti_tr(nifti_path)
+        if subject_tr is None:
+            subject_tr = tr
+        if subject_tr is not None:
+            trs[path] = subject_tr
+    return trs
+
+
+def _load_subject(dat_path: str, confounds_dir: str, confounds_suffix: str, global_signal: bool):
+    data = load_dat_file(dat_path)
+    if data.ndim == 1:
+        data = data[:, None]
+    parts = []
+    if confounds_dir is not None:
+        base_name = os.path.basename(dat_path)[:-len(".dat")]
+        parts.append(load_confounds(os.path.join(confounds_dir, base_name + confounds_suffix)))
+    if global_signal:
+        parts.append(qc_global_signal(dat_path)[:, None])
+    for part in parts:
+        if len(part) != len(data):
+            raise ValueError(f"{dat_path}: {len(data)} timepoints but confounds have {len(part)}")
+    confounds = np.column_stack(parts) if parts else np.zeros((len(data), 0))
+    return data, confounds
+
+
+def denoise_store(
+    dat_paths: list[str],
+    out_dir: str,
+    tr,
+    confounds_dir: str = None,
+    confounds_suffix: str = ".par",
+    global_signal: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    num_workers: int = 16,
+    **denoise_kwargs
+) -> dict:
+    """
+    Denoise a cohort of .dat files into `out_dir` (same file names).
+
+    Subjects are loaded in parallel, grouped by (TR, timepoints, regions,
+    confounds) and denoised `batch_size` at a time with denoise_stack().
+    Existing outputs are skipped; files that fail to load are reported and left out.
+
+    Args:
+        tr (float or dict): Repetition time in s, for every subject or as
+            {dat path: TR} (see subject_trs). Raises ValueError if a subject to
+            denoise has no TR.
+
+    Returns:
+        dict: {'denoised': n, 'skipped': n, 'failed': n}.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    out_paths = {path: os.path.join(out_dir, os.path.basename(path)) for path in dat_paths}
+    todo = [path for path in dat_paths if not os.path.exists(out_paths[path])]
+    counts = {"denoised": 0, "skipped": len(dat_paths) - len(todo), "failed": 0}
+
+    trs = tr if isinstance(tr, dict) else {path: tr for path in dat_paths}
+    missing = [path for path in todo if trs.get(path) is None]
+    if missing:
+        raise ValueError(
+            f"No TR for {len(missing)} subjects, e.g. {', '.join(missing[:3])}; "
+            "pass --tr, a --tr_csv row or a --nifti_dir header for each"
+        )
+
+    def load(path):
+        try:
+            return _load_subject(path, confounds_dir, confounds_suffix, global_signal)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error loading {path}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        loaded = list(executor.map(load, todo))
+
+    groups = {}
+    for path, item in zip(todo, loaded):
+        if item is None:
+            counts["failed"] += 1
+            continue
+        data, confounds = item
+        groups.setdefault((trs[path], data.shape, confounds.shape[1]), []).append((path, data, confounds))
+
+    for (group_tr, shape, n_confounds), members in groups.items():
+        print(f"Denoising {len(members)} subjects of shape {shape} with {n_confounds} confounds, TR {group_tr}s")
+        for start in range(0, len(members), batch_size):
+            batch = members[start:start + batch_size]
+            cleaned = denoise_stack(
+                np.stack([data for _, data, _ in batch]),
+                np.stack([confounds for _, _, confounds in batch]),
+                tr=group_tr,
+                **denoise_kwargs
+            )
+            for (path, _, _), pmTS in zip(batch, cleaned):
+                tmp_path = out_paths[path] + ".part"
+                save_timeseries(pmTS, tmp_path)
+                os.replace(tmp_path, out_paths[path])
+            counts["denoised"] += len(batch)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confound regression and band-pass filtering of parcel time series.")
+    parser.add_argument("--in_dir", required=True, help="Folder of parcellated .dat files.")
+    parser.add_argument("--out_dir", required=True, help="Folder for the denoised .dat files.")
+    parser.add_argument("--pattern", default="*.dat", help="Glob of the input files. (default=*.dat)")
+    parser.add_argument("--tr", type=float, default=None, help="Repetition time in seconds for subjects without a per-subject TR (UKB 0.735).")
+    parser.add_argument("--tr_csv", default=None, help="Table with a per-subject TR column, e.g. a phenotype CSV.")
+    parser.add_argument("--id_col", default="FILE_ID", help="Subject ID column of --tr_csv, matched to the .dat name. (default=FILE_ID)")
+    parser.add_argument("--tr_col", default="TR", help="TR column of --tr_csv, in seconds. (default=TR)")
+    parser.add_argument("--nifti_dir", default=None, help="Folder of the subjects' NIfTI files; the TR is read from pixdim[4].")
+    parser.add_argument("--nifti_suffix", default="_func_preproc.nii.gz", help="NIfTI name after the subject ID. (default=_func_preproc.nii.gz)")
+    parser.add_argument("--low_hz", type=float, default=DEFAULT_LOW_HZ, help=f"High-pass cutoff, <=0 to disable. (default={DEFAULT_LOW_HZ})")
+    parser.add_argument("--high_hz", type=float, default=DEFAULT_HIGH_HZ, help=f"Low-pass cutoff, <=0 to disable. (default={DEFAULT_HIGH_HZ})")
+    parser.add_argument("--order", type=int, default=2, help="Butterworth order. (default=2)")
+    parser.add_argument("--confounds_dir", default=None, help="Folder of per-subject confound files named <dat name><suffix>.")
+    parser.add_argument("--confounds_suffix", default=".par", help="Suffix of the confound files. (default=.par)")
+    parser.add_argument("--global_signal", action="store_true", help="Regress out the global signal from <name>.qc.npz.")
+    parser.add_argument("--no_detrend", action="store_true", help="Do not regress out a linear trend.")
+    parser.add_argument("--standardize", action="store_true", help="z-score each parcel after denoising.")
+    parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE, help=f"Subjects per batched solve. (default={DEFAULT_BATCH_SIZE})")
+    parser.add_argument("--num_workers", type=int, default=16, help="Threads loading .dat files. (default=16)")
+
+    args = parser.parse_args()
+
+    dat_paths = sorted(glob.glob(os.path.join(args.in_dir, args.pattern)))
+    print(f"{len(dat_paths)} files in {args.in_dir}")
+    trs = subject_trs(
+        dat_paths, args.tr,
+        tr_table=pd.read_csv(args.tr_csv) if args.tr_csv is not None else None,
+        id_col=args.id_col,
+        tr_col=args.tr_col,
+        nifti_dir=args.nifti_dir,
+        nifti_suffix=args.nifti_suffix,
+    )
+    print("TRs: " + ", ".join(f"{tr}s x {n}" for tr, n in sorted(Counter(trs.values()).items())))
+    counts = denoise_store(
+        dat_paths, args.out_dir, trs,
+        confounds_dir=args.confounds_dir,
+        confounds_suffix=args.confounds_suffix,
+        global_signal=args.global_signal,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        low_hz=args.low_hz if args.low_hz > 0 else None,
+        high_hz=args.high_hz if args.high_hz > 0 else None,
+        order=args.order,
+        detrend=not args.no_detrend,
+        standardize=args.standardize,
+    )
+    print(", ".join(f"{k}: {v}" for k, v in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Concurrent, resumable HTTP download manager.
+
+Used by abide_download.py for the ABIDE Preprocessed S3 bucket, but written for
+any list of (url, path) pairs:
+  1) One requests.Session with a connection pool shared by all worker threads.
+  2) At most `num_workers` downloads run at once.
+  3) Data is written to '<path>.part'. After an interruption (crash, dropped
+     connection, killed job) the next attempt resumes with an HTTP Range request.
+     The validator (ETag, else Last-Modified) of the response that started the
+     partial file is saved to '<path>.part.validator' before any data, and sent
+     as If-Range, so the server sends the whole file again when it has changed.
+     A partial file without a validator cannot be checked and is discarded.
+  4) The finished file is checked against Content-Length, and against the ETag
+     when it is a plain MD5 (as S3 uses for single-part uploads). It is then
+     renamed into place.
+  5) Each finished file is appended to a JSON-lines manifest. Files already
+     recorded as done with the same size are skipped without a request.
+
+Usage: see results/2025_03_03_abide_abnormality_detection/00_download_abide/abide_download.py
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, asdict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# S3 single-part ETags are the hex MD5 of the object; multipart ones end in '-<parts>'
+MD5_ETAG = re.compile(r"^[0-9a-f]{32}$")
+
+
+@dataclass
+class DownloadTask:
+    """
+    One file to fetch.
+    """
+    url: str
+    path: str
+
+
+@dataclass
+class DownloadResult:
+    """
+    Outcome of one task. `status` is 'done', 'skipped', 'missing' or 'failed'.
+    """
+    url: str
+    path: str
+    status: str
+    size: int = 0
+    etag: str = ""
+    attempts: int = 0
+    seconds: float = 0.0
+    message: str = ""
+
+
+def make_session(pool_size: int = 16, retries: int = 3, backoff: float = 1.0) -> requests.Session:
+    """
+    Session whose connection pool holds `pool_size` connections per host. It
+    retries connection errors and 5xx/429 responses with exponential back-off.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["HEAD", "GET"],
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def load_manifest(manifest_path: str) -> dict:
+    """
+    Latest manifest entry per output path ({} if the manifest does not exist).
+    """
+    entries = {}
+    if manifest_path is None or not os.path.isfile(manifest_path):
+        return entries
+    with open(manifest_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by a crash mid-write
+                continue
+            entries[entry["path"]] = entry
+    return entries
+
+
+def _etag(response: requests.Response) -> str:
+    return response.headers.get("ETag", "").strip('"')
+
+
+def _validator(response: requests.Response) -> str:
+    """
+    If-Range value identifying this version of the object: the strong ETag, else Last-Modified.
+    """
+    etag = response.headers.get("ETag", "")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified", "")
+
+
+def _read_validator(validator_path: str) -> str:
+    if not os.path.isfile(validator_path):
+        return ""
+    with open(validator_path) as f:
+        return f.read().strip()
+
+
+def _md5_of_file(path: str):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest
+
+
+def download_file(
+    session: requests.Session,
+    task: DownloadTask,
+    retries: int = 3,
+    backoff: float = 2.0,
+    timeout: float = 60.0,
+    known: dict = None
+) -> DownloadResult:
+    """
+    Download one file to `task.path`, resuming from '<path>.part' if present.
+
+    Args:
+        session (requests.Session): Shared session (see make_session).
+        task (DownloadTask): URL and output path.
+        retries (int, optional): Extra attempts after an interrupted transfer (default 3).
+        backoff (float, optional): Seconds before the first retry; doubles each time (default 2).
+        timeout (float, optional): Connect/read timeout in seconds (default 60).
+        known (dict, optional): This path's previous manifest entry, if any.
+
+    Returns:
+        DownloadResult: Status, size, ETag and timing of the download.
+    """
+    start = time.time()
+
+    if os.path.isfile(task.path):
+        size = os.path.getsize(task.path)
+        if known is not None and known.get("status") in ("done", "skipped") and known.get("size") == size:
+            return DownloadResult(task.url, task.path, "skipped", size, known.get("etag", ""))
+        try:
+            head = session.head(task.url, timeout=timeout, allow_redirects=True)
+            if head.ok and int(head.headers.get("Content-Length", -1)) == size:
+                return DownloadResult(task.url, task.path, "skipped", size, _etag(head))
+        except requests.RequestException as exc:
+            print(f"HEAD failed for {task.url} ({exc}); downloading again.")
+
+    os.makedirs(os.path.dirname(task.path) or ".", exist_ok=True)
+    part_path = f"{task.path}.part"
+    validator_path = f"{part_path}.validator"
+    message = ""
+
+    for attempt in range(1, retries + 2):
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        headers = {}
+        if offset > 0:
+            validator = _read_validator(validator_path)
+            if validator:
+                headers["Range"] = f"bytes={offset}-"
+                headers["If-Range"] = validator
+            else:
+                # No record of which version the partial file belongs to: it cannot be resumed safely
+                print(f"Discarding unverifiable partial file {part_path} ({offset} bytes).")
+                os.remove(part_path)
+                offset = 0
+
+        try:
+            with session.get(task.url, headers=headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 404:
+                    return DownloadResult(task.url, task.path, "missing", attempts=attempt,
+                                          seconds=time.time() - start, message="404 Not Found")
+                if response.status_code == 416:
+                    # The partial file is not a prefix of the current object; start over
+                    os.remove(part_path)
+                    if os.path.isfile(validator_path):
+                        os.remove(validator_path)
+                    raise IOError("range not satisfiable, restarting from byte 0")
+                response.raise_for_status()
+
+                etag = _etag(response)
+                if response.status_code == 206:
+                    total = int(response.headers["Content-Range"].rsplit("/", 1)[-1])
+                    mode = "ab"
+                else:
+                    # 200: the server ignored the range, or the object changed
+                    total = int(response.headers.get("Content-Length", -1))
+                    offset, mode = 0, "wb"
+                    # Record which version the new partial file belongs to, before writing any of it
+                    validator = _validator(response)
+                    if validator:
+                        with open(validator_path, "w") as f:
+                            f.write(validator)
+                    elif os.path.isfile(validator_path):
+                        os.remove(validator_path)
+
+                check_md5 = bool(MD5_ETAG.match(etag))
+                digest = _md5_of_file(part_path) if check_md5 and offset > 0 else hashlib.md5()
+                with open(part_path, mode) as f:
+                    for block in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(block)
+                        if check_md5:
+                            digest.update(block)
+
+            size = os.path.getsize(part_path)
+            if total >= 0 and size != total:
+                raise IOError(f"incomplete transfer: {size} of {total} bytes")
+            if check_md5 and digest.hexdigest() != etag:
+                os.remove(part_path)
+                raise IOError(f"MD5 {digest.hexdigest()} does not match ETag {etag}")
+
+            os.replace(part_path, task.path)
+            if os.path.isfile(validator_path):
+                os.remove(validator_path)
+            return DownloadResult(task.url, task.path, "done", size, etag, attempt, time.time() - start)
+
+        except (requests.RequestException, IOError) as exc:
+            message = str(exc)
+            if isinstance(exc, requests.HTTPError) and exc.response is not None and exc.response.status_code < 500:
+                break
+            if attempt <= retries:
+                print(f"Attempt {attempt} failed for {task.url} ({message}); resuming.")
+                time.sleep(backoff * 2 ** (attempt - 1))
+
+    return DownloadResult(task.url, task.path, "failed", attempts=attempt,
+                          seconds=time.time() - start, message=message)
+
+
+def download_many(
+    tasks: list[DownloadTask],
+    num_workers: int = 8,
+    manifest_path: str = None,
+    retries: int = 3,
+    timeout: float = 60.0,
+    session: requests.Session = None
+) -> list[DownloadResult]:
+    """
+    Download all tasks with at most `num_workers` transfers at a time.
+
+    Args:
+        tasks (List[DownloadTask]): Files to fetch.
+        num_workers (int, optional): Concurrent downloads (default 8).
+        manifest_path (str, optional): JSON-lines progress manifest, read for
+            skipping and appended to as files finish.
+        retries (int, optional): Extra attempts per interrupted transfer (default 3).
+        timeout (float, optional): Connect/read timeout in seconds (default 60).
+        session (requests.Session, optional): Session to use (default make_session(num_workers)).
+
+    Returns:
+        List[DownloadResult]: One result per task, in completion order.
+    """
+    session = session if session is not None else make_session(pool_size=num_workers)
+    known = load_manifest(manifest_path)
+    manifest_lock = threading.Lock()
+    if manifest_path is not None:
+        os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+
+    print(f"Downloading {len(tasks)} files with {num_workers} workers.")
+    results = []
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(download_file, session, task, retries, 2.0, timeout, known.get(task.path))
+            for task in tasks
+        ]
+        for index, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            results.append(result)
+            if manifest_path is not None:
+                with manifest_lock, open(manifest_path, "a") as f:
+                    f.write(json.dumps(asdict(result)) + "\n")
+            print(f"[{index}/{len(tasks)}] {result.status} {result.path} "
+                  f"({result.size / 2 ** 20:.1f} MiB, {result.seconds:.1f}s) {result.message}")
+
+    counts = {status: sum(r.status == status for r in results) for status in ("done", "skipped", "missing", "failed")}
+    print("Download summary: " + ", ".join(f"{k}={v}" for k, v in counts.items()))
+    return results
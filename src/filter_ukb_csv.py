@@ -1,42 +1,272 @@
-import csv
-import sys
+#!/usr/bin/env python3
+"""
+Extract UKB fields from the main dataset CSV.
+
+The basket is several GB wide, but cohort work only ever needs a handful of
+fields (eid, 31 sex, 21022 age, 41202 diagnoses, ...). Instead of streaming
+every row through csv.DictReader:
+  1) The requested field IDs are resolved against the header once
+     ('41202' -> every '41202-<instance>.<array>' column).
+  2) Only those columns are read, in large chunks, by the pandas C parser.
+  3) Each field is written to its own typed Parquet file,
+     '<out_dir>/field=<id>/part-0.parquet' (eid plus the field's columns).
+     Column types are inferred per chunk: all-integer columns become nullable
+     Int64, other numeric columns float64, everything else string. A chunk that
+     does not fit a column's type widens it (Int64 -> float64 -> string). The
+     CSV is read once: chunks are staged per field as strings while the types
+     widen, then each (small) staged field is cast to its final types, so no
+     value is ever set to missing.
+
+Later queries read a few MB of columnar data with read_fields() instead of
+re-parsing the CSV. Writing a plain CSV (the old filter_csv_by_prefix output)
+is still supported.
+
+Usage (example):
+  python filter_ukb_csv.py /blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/UKB/4041061_11_23.csv \
+    /blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/UKB/fields 31,21022,41202
+"""
+
+import os
 import argparse
 
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+ID_COLUMN = "eid"
+
+# Column types from narrowest to widest
+TYPE_ORDER = ["Int64", "float64", "string"]
+
+# Rows per chunk read from the CSV
+DEFAULT_CHUNKSIZE = 50_000
+
+
+def column_field(column: str) -> str:
+    """
+    Field ID of a UKB column ('41202-0.3' -> '41202', 'eid' -> 'eid').
+    """
+    return str(column).split("-", 1)[0]
+
+
+def column_matches(column: str, prefix: str) -> bool:
+    """
+    A bare field ID ('31') matches its own columns only (not '3140-...'); any
+    other prefix ('41202-0.') matches columns that start with it.
+    """
+    prefix = prefix.strip()
+    return column_field(column) == prefix if prefix.isdigit() else str(column).startswith(prefix)
+
+
+def resolve_columns(header, prefixes: list[str], id_col: str = ID_COLUMN) -> dict:
+    """
+    Map each requested field to its columns in `header` (see column_matches).
+
+    Returns:
+        dict: {field: [columns]} in header order, for the fields that matched.
+    """
+    resolved = {}
+    for col in header:
+        if col == id_col:
+            continue
+        if any(column_matches(col, prefix) for prefix in prefixes):
+            resolved.setdefault(column_field(col), []).append(col)
+    return resolved
+
+
+def infer_column_types(chunk: pd.DataFrame) -> dict:
+    """
+    {column: 'Int64' | 'float64' | 'string'} from a chunk read as strings.
+    Columns without values get the narrowest type, Int64.
+    """
+    types = {}
+    for col in chunk.columns:
+        values = chunk[col].dropna()
+        numeric = pd.to_numeric(values, errors="coerce")
+        if numeric.isna().any():
+            types[col] = "string"
+        elif np.all(np.mod(numeric.to_numpy(dtype=float), 1) == 0):
+            types[col] = "Int64"
+        else:
+            types[col] = "float64"
+    return types
+
+
+def widen_types(types: dict, chunk_types: dict) -> dict:
+    """
+    Per column, the wider of two types (Int64 < float64 < string).
+    """
+    return {col: max(types[col], chunk_types[col], key=TYPE_ORDER.index) for col in types}
+
+
+def cast_chunk(chunk: pd.DataFrame, types: dict) -> pd.DataFrame:
+    """
+    Cast a string chunk to `types` (wide enough for every value of the chunk).
+    """
+    out = {}
+    for col, dtype in types.items():
+        values = chunk[col]
+        if dtype == "string":
+            out[col] = values.astype("string")
+        else:
+            out[col] = pd.to_numeric(values).astype(dtype)
+    return pd.DataFrame(out, index=chunk.index)
+
 
-def filter_csv_by_prefix(input_file: str, output_file: str, prefixes: list[str]) -> None:
+def _append_table(writers: dict, field: str, path: str, table: pa.Table) -> None:
+    """
+    Append `table` to the Parquet writer of `field`, opening it on first use.
+    """
+    if field not in writers:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        writers[field] = pq.ParquetWriter(path, table.schema)
+    writers[field].write_table(table)
+
+
+def _finalize_field(staged_path: str, part_path: str, types: dict, id_col: str) -> None:
+    """
+    Cast a field staged as strings to `types`, one row group at a time.
+    """
+    writer = None
+    try:
+        for batch in pq.ParquetFile(staged_path).iter_batches():
+            chunk = batch.to_pandas()
+            ids = pd.to_numeric(chunk[id_col]).astype("int64")
+            table = pa.Table.from_pandas(pd.concat([ids, cast_chunk(chunk, types)], axis=1), preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(part_path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    os.remove(staged_path)
+
+
+def extract_fields(
+    input_file: str,
+    out_dir: str,
+    prefixes: list[str],
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    id_col: str = ID_COLUMN
+) -> dict:
+    """
+    Write the requested fields of a UKB CSV as one Parquet file per field.
+
+    Args:
+        input_file (str): UKB main dataset CSV.
+        out_dir (str): Output folder ('<out_dir>/field=<id>/part-0.parquet').
+        prefixes (List[str]): Field IDs (or column prefixes) to extract.
+        chunksize (int, optional): Rows per chunk (default 50,000).
+        id_col (str, optional): Participant ID column (default 'eid').
+
+    Returns:
+        dict: {field: [columns]} that were written.
+    """
+    header = pd.read_csv(input_file, nrows=0).columns
+    fields = resolve_columns(header, prefixes, id_col)
+    if not fields:
+        raise ValueError(f"No columns found for the provided fields: {prefixes}")
+    usecols = [id_col] + [col for cols in fields.values() for col in cols]
+    print(f"Extracting {len(usecols) - 1} columns of {len(fields)} fields "
+          f"({len(header)} columns in {input_file})")
+
+    os.makedirs(out_dir, exist_ok=True)
+    types, writers, n_rows = None, {}, 0
+    staged_paths = {
+        field: os.path.join(out_dir, f"field={field}", "part-0.strings.parquet.part") for field in fields
+    }
+    try:
+        reader = pd.read_csv(
+            input_file, usecols=usecols, dtype=str, chunksize=chunksize, engine="c", low_memory=False
+        )
+        for chunk in reader:
+            chunk_types = infer_column_types(chunk[usecols[1:]])
+            if types is None:
+                types = chunk_types
+            else:
+                widened = widen_types(types, chunk_types)
+                for field, cols in fields.items():
+                    changed = sorted({widened[col] for col in cols if widened[col] != types[col]})
+                    if changed:
+                        print(f"  Field {field} widened to {changed} at row {n_rows}")
+                types = widened
+
+            # Staged as strings, so earlier chunks never need re-reading when a type widens
+            for field, cols in fields.items():
+                table = pa.Table.from_pandas(chunk[[id_col] + cols].astype("string"), preserve_index=False)
+                _append_table(writers, field, staged_paths[field], table)
+            n_rows += len(chunk)
+            print(f"  {n_rows} rows")
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    # Publish only after every chunk was written, so a crash never leaves a partial field
+    for field, cols in fields.items():
+        part_path = os.path.join(out_dir, f"field={field}", "part-0.parquet.part")
+        _finalize_field(staged_paths[field], part_path, {col: types[col] for col in cols}, id_col)
+        os.replace(part_path, part_path[:-len(".part")])
+    print(f"{len(fields)} fields of {n_rows} participants written to {out_dir}")
+    return fields
+
+
+def list_fields(out_dir: str) -> list[str]:
+    """
+    Field IDs available in an extract_fields() folder.
+    """
+    return sorted(
+        name[len("field="):] for name in os.listdir(out_dir)
+        if name.startswith("field=") and os.path.isfile(os.path.join(out_dir, name, "part-0.parquet"))
+    )
+
+
+def read_fields(out_dir: str, fields: list[str], id_col: str = ID_COLUMN) -> pd.DataFrame:
+    """
+    Read the given fields from an extract_fields() folder into one table indexed
+    by row, with `id_col` first.
+    """
+    frames = []
+    for field in fields:
+        path = os.path.join(out_dir, f"field={field}", "part-0.parquet")
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"Field {field} was not extracted to {out_dir}")
+        df = pd.read_parquet(path)
+        frames.append(df if not frames else df.drop(columns=[id_col]))
+    return pd.concat(frames, axis=1)
+
+
+def filter_csv_by_prefix(input_file: str, output_file: str, prefixes: list[str], chunksize: int = DEFAULT_CHUNKSIZE) -> None:
     """
     Filters columns from a CSV file whose headers start with specific prefixes and writes them to a new CSV file.
-    
+    A bare field ID matches that field's columns only (see column_matches).
+    The header is resolved once and only the matching columns are parsed, chunk by chunk.
+
     Parameters:
     ----------
     input_file: The path to the input CSV file.
     output_file: The path to the output CSV file where the filtered data will be saved.
     prefixes : A list of prefixes; columns whose headers start with any of these prefixes will be included.
-    
+    chunksize: Rows per chunk.
+
     Returns:
     --------
     None
     """
     try:
-        with open(input_file, mode='r', newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            
-            matching_columns = [col for col in reader.fieldnames if any(col.startswith(prefix) for prefix in prefixes)]
-            
-            if not matching_columns:
-                raise ValueError(f"No columns found starting with the provided prefixes: {prefixes}")
-            
-            with open(output_file, mode='w', newline='', encoding='utf-8') as outfile:
-                writer = csv.DictWriter(outfile, fieldnames=matching_columns, extrasaction='ignore')
-                
-                writer.writeheader()
-                
-                for row in reader:
-                    filtered_row = {col: row[col] for col in matching_columns}
-                    writer.writerow(filtered_row)
-        
+        header = pd.read_csv(input_file, nrows=0).columns
+        matching_columns = [col for col in header if any(column_matches(col, prefix) for prefix in prefixes)]
+
+        if not matching_columns:
+            raise ValueError(f"No columns found starting with the provided prefixes: {prefixes}")
+
+        reader = pd.read_csv(input_file, usecols=matching_columns, dtype=str, chunksize=chunksize)
+        for i, chunk in enumerate(reader):
+            chunk[matching_columns].to_csv(output_file, mode="w" if i == 0 else "a", header=i == 0, index=False)
+
         print(f"Filtered CSV written to {output_file} with columns: {matching_columns}")
-    
+
     except FileNotFoundError:
         print(f"Error: File '{input_file}' not found.")
     except ValueError as ve:
@@ -46,12 +276,15 @@ def filter_csv_by_prefix(input_file: str, output_file: str, prefixes: list[str])
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Filter specific columns from a CSV file.")
     parser.add_argument("input_file", help="Path to the input CSV file")
-    parser.add_argument("output_file", help="Path to the output CSV file")
+    parser.add_argument("output_file", help="Output folder of per-field Parquet files, or a .csv file")
     parser.add_argument("codes", help="Comma-separated list of UKB codes to extract")
-    
+    parser.add_argument("--chunksize", type=int, default=DEFAULT_CHUNKSIZE, help="Rows per chunk. (default=50000)")
+
     args = parser.parse_args()
 
     prefixes = args.codes.split(",")
-    
-    filter_csv_by_prefix(args.input_file, args.output_file, prefixes)
 
+    if args.output_file.endswith(".csv"):
+        filter_csv_by_prefix(args.input_file, args.output_file, prefixes, args.chunksize)
+    else:
+        extract_fields(args.input_file, args.output_file, prefixes, args.chunksize)
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Concurrent FSL FLIRT registration pool.
+
+register_to_mni_space (unzip.py) and mni.sh call `flirt` one file at a time.
+This script runs many `flirt` processes side by side instead:
+  1) A bounded semaphore caps the number of `flirt` processes running at once
+     (default: one per core); retry back-off waits do not hold a slot.
+  2) Each process gets OMP/MKL/OpenBLAS thread variables set to
+     `threads_per_job`, so N concurrent jobs do not each spawn N threads.
+  3) Each job's wall time, exit code and number of attempts are recorded.
+     Only transient failures are retried, with exponential back-off: a timeout,
+     a process killed by a signal, or an exit code listed in `retry_exit_codes`.
+     A bad input or reference fails the same way every time and is not retried.
+  4) flirt writes to a temporary '<name>.part.nii.gz' that is renamed into place
+     after it exits 0, so a crashed job never leaves a partial output; jobs
+     whose output already exists are skipped.
+
+The `flirt` executable is a parameter, so the pool can be exercised with a stub
+script that mimics flirt's command line.
+
+Usage (example, equivalent to mni.sh):
+  python flirt_pool.py \
+    --in_glob "/blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/UKB/brain/*/*/*unzip/*/fMRI/rfMRI.ica/filtered_func_data_clean.nii.gz" \
+    --ref_path /blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/UKB/brain/tpl-MNI152NLin6Asym_res-02_T1w.nii.gz \
+    --out_suffix _MNI.nii.gz \
+    --report registration_report.csv
+
+Usage (example, equivalent to register_to_mni.sh for ABIDE):
+  python flirt_pool.py \
+    --in_glob "/blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/ABIDE_preprocessed/*func_preproc.nii.gz" \
+    --ref_path /blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/tpl-MNI152NLin6Asym_res-02_T1w.nii.gz \
+    --strip_suffix _func_preproc.nii.gz --out_suffix _MNI_2mm.nii.gz \
+    --out_dir /blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/ABIDE_MNI_2mm
+"""
+
+import os
+import csv
+import glob
+import time
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, asdict
+
+
+# Thread-count variables honoured by FSL builds and the BLAS/OpenMP libraries they link
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+]
+
+
+# Extensions flirt keeps on -out; the temporary name goes before them
+NIFTI_EXTENSIONS = (".nii.gz", ".nii")
+
+
+@dataclass
+class FlirtJob:
+    """
+    One `flirt -applyisoxfm` call.
+    """
+    in_path: str
+    out_path: str
+    ref_path: str
+    applyisoxfm: str = "2"
+
+
+@dataclass
+class FlirtResult:
+    """
+    Outcome of one job. `status` is 'done', 'skipped' or 'failed'.
+    """
+    in_path: str
+    out_path: str
+    status: str
+    returncode: int
+    attempts: int
+    seconds: float
+    message: str = ""
+
+
+def fsl_thread_env(threads_per_job: int = 1, base_env: dict = None) -> dict:
+    """
+    Copy of `base_env` (default os.environ) with every thread-count variable set
+    to `threads_per_job`, and FSLOUTPUTTYPE defaulting to NIFTI_GZ.
+    """
+    env = dict(os.environ if base_env is None else base_env)
+    for var in THREAD_ENV_VARS:
+        env[var] = str(threads_per_job)
+    env.setdefault("FSLOUTPUTTYPE", "NIFTI_GZ")
+    return env
+
+
+def partial_path(out_path: str) -> str:
+    """
+    Temporary output name of a job ('x_MNI.nii.gz' -> 'x_MNI.part.nii.gz').
+    """
+    for ext in NIFTI_EXTENSIONS:
+        if out_path.endswith(ext):
+            return f"{out_path[:-len(ext)]}.part{ext}"
+    return f"{out_path}.part"
+
+
+def flirt_command(job: FlirtJob, flirt_bin: str = "flirt", out_path: str = None) -> list[str]:
+    return [
+        flirt_bin,
+        "-in", job.in_path,
+        "-ref", job.ref_path,
+        "-out", job.out_path if out_path is None else out_path,
+        "-applyisoxfm", job.applyisoxfm
+    ]
+
+
+def run_flirt_job(
+    job: FlirtJob,
+    slots: threading.BoundedSemaphore,
+    flirt_bin: str = "flirt",
+    env: dict = None,
+    retries: int = 2,
+    backoff: float = 5.0,
+    overwrite: bool = False,
+    timeout: float = None,
+    retry_exit_codes: tuple = ()
+) -> FlirtResult:
+    """
+    Run one registration, holding a semaphore slot only while `flirt` runs.
+    Only timeouts, signals and `retry_exit_codes` are retried.
+
+    Args:
+        job (FlirtJob): The registration to run.
+        slots (threading.BoundedSemaphore): Shared limit on concurrent flirt processes.
+        flirt_bin (str, optional): flirt executable (default 'flirt' on PATH).
+        env (dict, optional): Environment for the subprocess (default fsl_thread_env()).
+        retries (int, optional): Extra attempts after a transient failure (default 2).
+        backoff (float, optional): Seconds before the first retry; doubles each time (default 5).
+        overwrite (bool, optional): Re-run even if the output exists (default False).
+        timeout (float, optional): Seconds before a flirt process is killed (default no limit).
+        retry_exit_codes (tuple, optional): Exit codes that are also retried (default none).
+
+    Returns:
+        FlirtResult: Timing, exit code and status of the job.
+    """
+    if not overwrite and os.path.isfile(job.out_path) and os.path.getsize(job.out_path) > 0:
+        return FlirtResult(job.in_path, job.out_path, "skipped", 0, 0, 0.0)
+    if not os.path.isfile(job.in_path):
+        return FlirtResult(job.in_path, job.out_path, "failed", -1, 0, 0.0, "input file not found")
+
+    env = env if env is not None else fsl_thread_env()
+    os.makedirs(os.path.dirname(job.out_path) or ".", exist_ok=True)
+
+    tmp_path = partial_path(job.out_path)
+    command = flirt_command(job, flirt_bin, tmp_path)
+    start = time.time()
+    for attempt in range(1, retries + 2):
+        transient = False
+        with slots:
+            try:
+                completed = subprocess.run(command, env=env, capture_output=True, text=True, timeout=timeout)
+                returncode = completed.returncode
+                message = (completed.stderr or completed.stdout).strip()
+                # Negative: killed by a signal (e.g. the OOM killer)
+                transient = returncode < 0 or returncode in retry_exit_codes
+            except subprocess.TimeoutExpired:
+                returncode, message, transient = -1, f"flirt timed out after {timeout}s", True
+            except OSError as exc:
+                returncode, message = -1, str(exc)
+
+        if returncode == 0 and os.path.isfile(tmp_path) and os.path.getsize(tmp_path) > 0:
+            os.replace(tmp_path, job.out_path)
+            return FlirtResult(job.in_path, job.out_path, "done", 0, attempt, time.time() - start)
+        if returncode == 0:
+            message = "flirt exited 0 but the output file is missing"
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+        if not transient or attempt > retries:
+            break
+        print(f"FLIRT attempt {attempt} failed for {job.in_path} (exit code {returncode}); retrying.")
+        time.sleep(backoff * 2 ** (attempt - 1))
+
+    last_line = message.splitlines()[-1] if message else ""
+    return FlirtResult(job.in_path, job.out_path, "failed", returncode, attempt, time.time() - start, last_line)
+
+
+def register_many(
+    jobs: list[FlirtJob],
+    max_concurrent: int = None,
+    threads_per_job: int = 1,
+    flirt_bin: str = "flirt",
+    retries: int = 2,
+    backoff: float = 5.0,
+    overwrite: bool = False,
+    timeout: float = None,
+    retry_exit_codes: tuple = ()
+) -> list[FlirtResult]:
+    """
+    Run all registrations with at most `max_concurrent` flirt processes at a time.
+
+    Args:
+        jobs (List[FlirtJob]): Registrations to run.
+        max_concurrent (int, optional): Concurrent flirt processes
+            (default os.cpu_count() // threads_per_job).
+        threads_per_job (int, optional): Threads allowed per flirt process (default 1).
+        flirt_bin (str, optional): flirt executable (default 'flirt').
+        retries (int, optional): Extra attempts per transiently failed job (default 2).
+        backoff (float, optional): Initial retry delay in seconds (default 5).
+        overwrite (bool, optional): Re-run jobs whose output exists (default False).
+        timeout (float, optional): Seconds before a flirt process is killed (default no limit).
+        retry_exit_codes (tuple, optional): Exit codes that are also retried (default none).
+
+    Returns:
+        List[FlirtResult]: One result per job, in completion order.
+    """
+    if max_concurrent is None:
+        max_concurrent = max(1, (os.cpu_count() or 1) // threads_per_job)
+    slots = threading.BoundedSemaphore(max_concurrent)
+    env = fsl_thread_env(threads_per_job)
+
+    print(f"Registering {len(jobs)} files with up to {max_concurrent} concurrent flirt processes.")
+    results = []
+    # Twice as many threads as slots, so jobs sleeping before a retry do not idle a slot
+    with ThreadPoolExecutor(max_workers=2 * max_concurrent) as executor:
+        futures = [
+            executor.submit(
+                run_flirt_job, job, slots, flirt_bin, env, retries, backoff, overwrite, timeout, retry_exit_codes
+            )
+            for job in jobs
+        ]
+        for index, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            results.append(result)
+            print(f"[{index}/{len(jobs)}] {result.status} {result.in_path} "
+                  f"({result.seconds:.1f}s, exit code {result.returncode}, attempts {result.attempts})")
+
+    n_done = sum(r.status == "done" for r in results)
+    n_skipped = sum(r.status == "skipped" for r in results)
+    n_failed = sum(r.status == "failed" for r in results)
+    print(f"Registration summary: done={n_done}, skipped={n_skipped}, failed={n_failed}")
+    return results
+
+
+def write_report(results: list[FlirtResult], report_path: str) -> None:
+    """
+    Write per-job timing and exit codes to a CSV file.
+    """
+    with open(report_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(FlirtResult.__dataclass_fields__))
+        writer.writeheader()
+        for result in results:
+            writer.writerow(asdict(result))
+
+
+def build_jobs(
+    in_paths: list[str],
+    ref_path: str,
+    out_dir: str = None,
+    strip_suffix: str = ".nii.gz",
+    out_suffix: str = "_MNI.nii.gz",
+    applyisoxfm: str = "2"
+) -> list[FlirtJob]:
+    """
+    Pair each input with an output path '<out_dir or input folder>/<name minus strip_suffix><out_suffix>'.
+    """
+    jobs = []
+    for in_path in in_paths:
+        base_name = os.path.basename(in_path)
+        if base_name.endswith(strip_suffix):
+            base_name = base_name[:-len(strip_suffix)]
+        folder = out_dir if out_dir is not None else os.path.dirname(in_path)
+        jobs.append(FlirtJob(in_path, os.path.join(folder, f"{base_name}{out_suffix}"), ref_path, applyisoxfm))
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Register many NIfTI files to MNI space with concurrent FLIRT processes."
+    )
+    parser.add_argument(
+        "--in_glob", default=None,
+        help="Glob pattern of input files (quote it)."
+    )
+    parser.add_argument(
+        "--file_list", default=None,
+        help="Text file with one input path per line (alternative to --in_glob)."
+    )
+    parser.add_argument(
+        "--ref_path", required=True,
+        help="Reference template, e.g. tpl-MNI152NLin6Asym_res-02_T1w.nii.gz"
+    )
+    parser.add_argument(
+        "--applyisoxfm", default="2",
+        help="Isotropic output voxel size in mm. (default=2)"
+    )
+    parser.add_argument(
+        "--out_dir", default=None,
+        help="Output directory (default: same folder as each input)."
+    )
+    parser.add_argument(
+        "--strip_suffix", default=".nii.gz",
+        help="Suffix removed from the input name before adding --out_suffix."
+    )
+    parser.add_argument(
+        "--out_suffix", default="_MNI.nii.gz",
+        help="Suffix of the output name. (default=_MNI.nii.gz)"
+    )
+    parser.add_argument(
+        "--max_concurrent", type=int, default=None,
+        help="Maximum concurrent flirt processes (default: cores / threads_per_job)."
+    )
+    parser.add_argument(
+        "--threads_per_job", type=int, default=1,
+        help="Threads per flirt process. (default=1)"
+    )
+    parser.add_argument(
+        "--retries", type=int, default=2,
+        help="Retries per job that timed out, was killed by a signal or hit --retry_exit_codes. (default=2)"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=None,
+        help="Seconds before a flirt process is killed and retried (default: no limit)."
+    )
+    parser.add_argument(
+        "--retry_exit_codes", type=int, nargs="*", default=[],
+        help="flirt exit codes that are also retried (default: none)."
+    )
+    parser.add_argument(
+        "--flirt_bin", default="flirt",
+        help="flirt executable. (default=flirt on PATH)"
+    )
+    parser.add_argument(
+        "--report", default=None,
+        help="Optional CSV path for per-job timing and exit codes."
+    )
+
+    args = parser.parse_args()
+
+    if args.file_list is not None:
+        with open(args.file_list) as f:
+            in_paths = [line.strip() for line in f if line.strip()]
+    elif args.in_glob is not None:
+        in_paths = sorted(glob.glob(args.in_glob))
+    else:
+        parser.error("One of --in_glob or --file_list is required.")
+
+    jobs = build_jobs(in_paths, args.ref_path, args.out_dir, args.strip_suffix, args.out_suffix, args.applyisoxfm)
+    results = register_many(
+        jobs,
+        max_concurrent=args.max_concurrent,
+        threads_per_job=args.threads_per_job,
+        flirt_bin=args.flirt_bin,
+        retries=args.retries,
+        timeout=args.timeout,
+        retry_exit_codes=tuple(args.retry_exit_codes)
+    )
+    if args.report is not None:
+        write_report(results, args.report)
+        print(f"Report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
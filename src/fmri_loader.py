@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+Multi-worker prefetching data loader for parcellated fMRI cohorts.
+
+This module provides utilities for:
+
+1. Pairing parcellated time-series files (.dat) with labels from the UKB ICD
+   table (trimmed_icd.pkl) or the ABIDE phenotype table (Phenotypic_V1_0b.csv).
+2. Loading subjects in parallel (threads or processes) and prefetching
+   fixed-shape batches into a bounded queue, so model training is limited by
+   compute rather than by np.loadtxt.
+3. Shuffling with a reproducible per-epoch seed: the same (seed, epoch) pair
+   always yields the same batches, regardless of the number of workers.
+
+Each batch is a dict with:
+    - "timeseries":   float32 array of shape (B, seq_len, n_regions)
+    - "connectivity": float32 array of shape (B, n_regions, n_regions), Fisher-z
+    - "labels":       int64 array of shape (B,)
+    - "subject_ids":  list of B subject identifiers
+
+Example:
+    records = build_abide_records("/path/to/ABIDE_parcelled", "./Phenotypic_V1_0b.csv")
+    loader = PrefetchLoader(records, batch_size=16, seq_len=150, n_regions=166, num_workers=8)
+    for epoch in range(10):
+        loader.set_epoch(epoch)
+        for batch in loader:
+            ...
+
+Dependencies:
+- numpy
+- pandas
+"""
+
+import os
+import glob
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Iterator, Optional
+
+import numpy as np
+import pandas as pd
+
+
+@dataclass(frozen=True)
+class SubjectRecord:
+    """
+    One subject entry for the loader.
+
+    Attributes:
+        subject_id (str): Subject identifier (UKB eid or ABIDE FILE_ID).
+        path (str): Path to the parcellated time series (.dat, tab-delimited).
+        label (int): Integer class label.
+    """
+    subject_id: str
+    path: str
+    label: int
+
+
+def load_dat_file(filepath: str, delimiter: str = '\t') -> np.ndarray:
+    """
+    Load a .dat file into a NumPy array.
+
+    Args:
+        filepath (str): Path to the .dat file.
+        delimiter (str, optional): The delimiter used in the .dat file.
+                                   Default is tab ('\\t').
+
+    Returns:
+        np.ndarray: The data from the .dat file as a NumPy array.
+    """
+    # loadtxt will automatically infer rows/columns based on the file
+    data = np.loadtxt(filepath, delimiter=delimiter)
+    return data
+
+
+def compute_fisher_z(signals: np.ndarray) -> np.ndarray:
+    """
+    Compute the Fisher Z-transformed Pearson correlation among the columns
+    (regions) of a (n_timepoints, n_regions) array.
+
+    Regions with zero variance (e.g. empty parcels filled with 0) produce NaN
+    correlations in np.corrcoef; these are set to 0.
+
+    Args:
+        signals (np.ndarray): fMRI time series of shape (n_timepoints, n_regions).
+
+    Returns:
+        np.ndarray: (n_regions, n_regions) matrix of Fisher Z-transformed connectivity.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr_mat = np.corrcoef(signals, rowvar=False)
+    corr_mat = np.nan_to_num(corr_mat, nan=0.0)
+
+    # Clamp r to avoid infinity at r=±1
+    epsilon = 1e-8
+    corr_mat = np.clip(corr_mat, -1 + epsilon, 1 - epsilon)
+    return np.arctanh(corr_mat)
+
+
+def parse_ukb_subject_id(filepath: str) -> str:
+    """
+    Extract the UKB eid from a parcellated file path.
+
+    Works for both layouts used in this project:
+        .../rsfmri_unzip/1080638_20227_2_0/fMRI/rfMRI.ica/filtered_func_data_clean_MNI.dat
+        .../1080638_20227_2_0_filtered_func_data_clean.dat
+
+    Args:
+        filepath (str): Path to a UKB .dat file.
+
+    Returns:
+        str: The eid (e.g., '1080638'), or '' if none could be found.
+    """
+    for part in reversed(filepath.split(os.sep)):
+        if "_20227_" in part:
+            return part.split("_")[0]
+    return ""
+
+
+def parse_abide_subject_id(filepath: str) -> str:
+    """
+    Extract the ABIDE FILE_ID from a parcellated file path, e.g.
+    'Pitt_0050003_MNI_2mm.dat' -> 'Pitt_0050003'.
+
+    Args:
+        filepath (str): Path to an ABIDE .dat file.
+
+    Returns:
+        str: The ABIDE FILE_ID.
+    """
+    base_name = os.path.basename(filepath)
+    for suffix in ("_MNI_2mm.dat", "_func_preproc.dat", ".dat"):
+        if base_name.endswith(suffix):
+            return base_name[:-len(suffix)]
+    return base_name
+
+
+def records_from_phenotype(
+    dat_paths: list[str],
+    phenotype_df: pd.DataFrame,
+    id_column: str,
+    label_fn: Callable[[pd.Series], int],
+    id_from_path: Callable[[str], str]
+) -> list[SubjectRecord]:
+    """
+    Join parcellated files against a phenotype table.
+
+    Args:
+        dat_paths (List[str]): Paths to .dat files.
+        phenotype_df (pd.DataFrame): Table with one row per subject.
+        id_column (str): Column in `phenotype_df` holding the subject identifier.
+        label_fn (Callable): Maps a phenotype row to an integer label.
+        id_from_path (Callable): Maps a .dat path to the subject identifier.
+
+    Returns:
+        List[SubjectRecord]: One record per file with a matching phenotype row,
+                             sorted by subject ID for reproducibility.
+    """
+    rows_by_id = phenotype_df.assign(
+        _key=phenotype_df[id_column].astype(str)
+    ).drop_duplicates("_key").set_index("_key")
+
+    records = []
+    n_missing = 0
+    for path in dat_paths:
+        subject_id = id_from_path(path)
+        if subject_id not in rows_by_id.index:
+            n_missing += 1
+            continue
+        records.append(SubjectRecord(subject_id, path, int(label_fn(rows_by_id.loc[subject_id]))))
+
+    if n_missing:
+        print(f"Skipped {n_missing} files without a phenotype row.")
+    return sorted(records, key=lambda r: (r.subject_id, r.path))
+
+
+def build_abide_records(
+    parcel_dir: str,
+    phenotype_csv: str,
+    pattern: str = "*.dat"
+) -> list[SubjectRecord]:
+    """
+    Build loader records for ABIDE from a directory of .dat files and the
+    Phenotypic_V1_0b.csv table. DX_GROUP 1 (autism) -> label 1, 2 (control) -> 0.
+
+    Args:
+        parcel_dir (str): Directory with <FILE_ID>_MNI_2mm.dat files.
+        phenotype_csv (str): Path to Phenotypic_V1_0b.csv.
+        pattern (str, optional): Glob pattern for the .dat files.
+
+    Returns:
+        List[SubjectRecord]: Loader records.
+    """
+    phenotype_df = pd.read_csv(phenotype_csv)
+    dat_paths = glob.glob(os.path.join(parcel_dir, pattern))
+    return records_from_phenotype(
+        dat_paths,
+        phenotype_df,
+        id_column="FILE_ID",
+        label_fn=lambda row: 1 if row["DX_GROUP"] == 1 else 0,
+        id_from_path=parse_abide_subject_id
+    )
+
+
+def build_ukb_records(
+    dat_paths: list[str],
+    icd_pickle: str,
+    label_column: str = "has_AD"
+) -> list[SubjectRecord]:
+    """
+    Build loader records for UKB from .dat files and the trimmed_icd.pkl table
+    written by icd_eda.ipynb.
+
+    Args:
+        dat_paths (List[str]): Paths to UKB .dat files.
+        icd_pickle (str): Path to trimmed_icd.pkl (must contain 'eid' and `label_column`).
+        label_column (str, optional): Boolean flag column used as the label (default 'has_AD').
+
+    Returns:
+        List[SubjectRecord]: Loader records.
+    """
+    icd_df = pd.read_pickle(icd_pickle)
+    return records_from_phenotype(
+        dat_paths,
+        icd_df,
+        id_column="eid",
+        label_fn=lambda row: int(bool(row[label_column])),
+        id_from_path=parse_ukb_subject_id
+    )
+
+
+def fix_length(
+    timeseries: np.ndarray,
+    seq_len: int,
+    n_regions: int,
+    rng: np.random.Generator
+) -> np.ndarray:
+    """
+    Bring a (T, R) time series to exactly (seq_len, n_regions).
+
+    Longer series are cropped at a random start drawn from `rng`; shorter ones
+    are zero-padded at the end. Extra regions are dropped, missing ones are
+    zero-filled.
+
+    Args:
+        timeseries (np.ndarray): Array of shape (T, R).
+        seq_len (int): Target number of timepoints.
+        n_regions (int): Target number of regions.
+        rng (np.random.Generator): Random generator for the crop offset.
+
+    Returns:
+        np.ndarray: float32 array of shape (seq_len, n_regions).
+    """
+    out = np.zeros((seq_len, n_regions), dtype=np.float32)
+    n_timepoints = timeseries.shape[0]
+    n_cols = min(n_regions, timeseries.shape[1])
+
+    if n_timepoints > seq_len:
+        start = int(rng.integers(0, n_timepoints - seq_len + 1))
+        out[:, :n_cols] = timeseries[start:start + seq_len, :n_cols]
+    else:
+        out[:n_timepoints, :n_cols] = timeseries[:, :n_cols]
+    return out
+
+
+def _load_batch(
+    batch_records: list[SubjectRecord],
+    seq_len: int,
+    n_regions: int,
+    seeds: list[int]
+) -> dict:
+    """
+    Load and stack one batch. Runs inside a worker thread or process, so it
+    only takes picklable arguments.
+    """
+    timeseries = np.zeros((len(batch_records), seq_len, n_regions), dtype=np.float32)
+    connectivity = np.zeros((len(batch_records), n_regions, n_regions), dtype=np.float32)
+
+    for i, (record, seed) in enumerate(zip(batch_records, seeds)):
+        data = load_dat_file(record.path)
+        if data.ndim == 1:
+            data = data[:, None]
+        timeseries[i] = fix_length(data, seq_len, n_regions, np.random.default_rng(seed))
+        # Connectivity of the observed window only: the zero padding of a
+        # short scan would otherwise dominate every correlation
+        connectivity[i] = compute_fisher_z(timeseries[i, :min(data.shape[0], seq_len)])
+
+    return {
+        "timeseries": timeseries,
+        "connectivity": connectivity,
+        "labels": np.array([r.label for r in batch_records], dtype=np.int64),
+        "subject_ids": [r.subject_id for r in batch_records],
+    }
+
+
+class PrefetchLoader:
+    """
+    Iterate over fixed-shape batches of subjects, loading them in parallel.
+
+    Batches are sharded across `num_workers` threads or processes. At most
+    `prefetch` batches are in flight at any time (a bounded queue), and
+    batches are yielded in a deterministic order for a given (seed, epoch).
+
+    Args:
+        records (List[SubjectRecord]): Subjects to iterate over.
+        batch_size (int): Number of subjects per batch.
+        seq_len (int): Number of timepoints per sample.
+        n_regions (int): Number of parcels per sample (e.g. 166 for AAL3, 17 for Yeo17).
+        num_workers (int, optional): Number of loader workers (default 4).
+        prefetch (int, optional): Maximum number of batches in flight (default 2 * num_workers).
+        shuffle (bool, optional): Shuffle subjects every epoch (default True).
+        drop_last (bool, optional): Drop the final incomplete batch (default False).
+        seed (int, optional): Base seed; combined with the epoch number (default 0).
+        backend (str, optional): 'thread' or 'process' (default 'thread').
+    """
+
+    def __init__(
+        self,
+        records: list[SubjectRecord],
+        batch_size: int,
+        seq_len: int,
+        n_regions: int,
+        num_workers: int = 4,
+        prefetch: Optional[int] = None,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        seed: int = 0,
+        backend: str = "thread"
+    ):
+        if batch_size < 1:
+            raise ValueError("batch_size must be >= 1.")
+        if backend not in ("thread", "process"):
+            raise ValueError(f"Unknown backend '{backend}', expected 'thread' or 'process'.")
+
+        self.records = list(records)
+        self.batch_size = batch_size
+        self.seq_len = seq_len
+        self.n_regions = n_regions
+        self.num_workers = max(1, num_workers)
+        self.prefetch = prefetch if prefetch is not None else 2 * self.num_workers
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.backend = backend
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Set the epoch used to derive the shuffle order and crop offsets.
+        """
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.records) // self.batch_size
+        return -(-len(self.records) // self.batch_size)
+
+    def _plan_batches(self) -> list[tuple[list[SubjectRecord], list[int]]]:
+        """
+        Build the (records, per-sample seeds) list for the current epoch.
+        """
+        rng = np.random.default_rng([self.seed, self.epoch])
+        order = rng.permutation(len(self.records)) if self.shuffle else np.arange(len(self.records))
+        sample_seeds = rng.integers(0, 2**31 - 1, size=len(self.records))
+
+        batches = []
+        for start in range(0, len(order), self.batch_size):
+            idx = order[start:start + self.batch_size]
+            if self.drop_last and len(idx) < self.batch_size:
+                break
+            batches.append(([self.records[i] for i in idx], [int(sample_seeds[i]) for i in idx]))
+        return batches
+
+    def __iter__(self) -> Iterator[dict]:
+        batches = self._plan_batches()
+        executor_cls = ThreadPoolExecutor if self.backend == "thread" else ProcessPoolExecutor
+
+        with executor_cls(max_workers=self.num_workers) as executor:
+            in_flight = deque()
+            next_batch = 0
+
+            # Fill the bounded queue, then refill one slot per consumed batch
+            while next_batch < len(batches) and len(in_flight) < self.prefetch:
+                batch_records, seeds = batches[next_batch]
+                in_flight.append(executor.submit(_load_batch, batch_records, self.seq_len, self.n_regions, seeds))
+                next_batch += 1
+
+            while in_flight:
+                batch = in_flight.popleft().result()
+                if next_batch < len(batches):
+                    batch_records, seeds = batches[next_batch]
+                    in_flight.append(executor.submit(_load_batch, batch_records, self.seq_len, self.n_regions, seeds))
+                    next_batch += 1
+                yield batch
+
+
+def main():
+    """
+    Example usage: iterate over the ABIDE AAL3 cohort for two epochs.
+    """
+    parcel_dir = "/blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/ABIDE_parcelled"
+    phenotype_csv = "/blue/ruogu.fang/ryoi360/projects/fmri_vlm/results/2025_03_03_abide_abnormality_detection/Phenotypic_V1_0b.csv"
+
+    records = build_abide_records(parcel_dir, phenotype_csv)
+    print(f"Number of subjects: {len(records)}")
+
+    loader = PrefetchLoader(records, batch_size=16, seq_len=150, n_regions=166, num_workers=8)
+    for epoch in range(2):
+        loader.set_epoch(epoch)
+        for batch_idx, batch in enumerate(loader):
+            print(f"Epoch {epoch} batch {batch_idx}: timeseries {batch['timeseries'].shape}, "
+                  f"connectivity {batch['connectivity'].shape}, labels {batch['labels'].tolist()}")
+
+
+if __name__ == "__main__":
+    main()
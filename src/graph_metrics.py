@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Graph-theoretic metrics over stacks of connectivity matrices.
+
+After compute_fisher_z the notebooks only threshold single edges
+(flag_outside_range, report_significantly_different_connectivity). Here every
+subject's (N, N) matrix becomes node- and network-level features, computed
+on (B, N, N) stacks:
+  - strength (positive / negative), and the network x network mean
+    connectivity for a network assignment (Yeo17 -> Yeo7, Neuromark domains, ...),
+  - modularity Q of that assignment on the positive weights,
+  - at each proportional threshold (top `density` of the edges): degree,
+    weighted clustering (Onnela, diag((W^1/3)^3) / k(k-1)), participation
+    coefficient, global efficiency and modularity of the binary graph,
+  - optionally binary local efficiency.
+
+Shortest paths are a batched breadth-first search written as boolean matrix
+products: the frontier of every source node of every subject advances with one
+(B, N, N) matmul per path length. Subjects are split into chunks that run
+across a process pool, since clustering and (local) efficiency are O(N^3) per
+subject.
+
+abnormality_zscores() z-scores every feature against a reference group (e.g.
+the controls), as compute_zscore in the preprocessing notebooks does per edge.
+
+Usage (example, Yeo17 ABIDE connectivity from connectivity.py):
+  python graph_metrics.py \
+    --connectivity /blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/ABIDE_connectivity_yeo17/ledoit_wolf.npz \
+    --kind correlation --networks yeo17 \
+    --out /blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/ABIDE_connectivity_yeo17/graph_metrics.npz
+"""
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_DENSITIES = (0.1, 0.2, 0.3)
+
+# Yeo 2011: 17-network index -> 7-network name (Vis, SomMot, DorsAttn,
+# SalVentAttn, Limbic, Control, Default), for the 17-parcel Yeo17 series
+YEO17_TO_YEO7 = [
+    "Vis", "Vis", "SomMot", "SomMot", "DorsAttn", "DorsAttn", "SalVentAttn", "SalVentAttn",
+    "Limbic", "Limbic", "Control", "Control", "Control", "Default", "Default", "Default", "Default",
+]
+
+# Neuromark_fMRI_1.0: the 53 components are ordered by functional domain
+NEUROMARK_DOMAINS = {"SC": 5, "AUD": 2, "SM": 9, "VIS": 9, "CC": 17, "DM": 7, "CB": 4}
+
+# Subjects per process-pool task
+DEFAULT_CHUNK = 16
+
+
+def network_assignment(networks: str, n_nodes: int = None) -> np.ndarray:
+    """
+    Network name of every node: 'yeo17' (17 Yeo networks -> Yeo7), 'neuromark'
+    (53 components -> 7 domains), or a text/CSV file with one name per line
+    (or a 'network' column).
+    """
+    if networks == "yeo17":
+        assignment = np.array(YEO17_TO_YEO7)
+    elif networks == "neuromark":
+        assignment = np.repeat(list(NEUROMARK_DOMAINS), list(NEUROMARK_DOMAINS.values()))
+    else:
+        if networks.endswith(".csv"):
+            assignment = pd.read_csv(networks)["network"].astype(str).to_numpy()
+        else:
+            with open(networks, "r") as f:
+                assignment = np.array([line.strip() for line in f if line.strip()])
+    if n_nodes is not None and len(assignment) != n_nodes:
+        raise ValueError(f"Network assignment '{networks}' has {len(assignment)} nodes, matrices have {n_nodes}")
+    return assignment
+
+
+def _one_hot(assignment: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    names, codes = np.unique(assignment, return_inverse=True)
+    return names, np.eye(len(names))[codes]
+
+
+def zero_diagonal(mats: np.ndarray) -> np.ndarray:
+    mats = np.array(mats, dtype=np.float64)
+    idx = np.arange(mats.shape[-1])
+    mats[:, idx, idx] = 0.0
+    return mats
+
+
+def proportional_threshold(weights: np.ndarray, density: float) -> np.ndarray:
+    """
+    Boolean (B, N, N) adjacency keeping each subject's strongest `density`
+    fraction of (positive) undirected edges.
+    """
+    n_subjects, n_nodes, _ = weights.shape
+    iu, ju = np.triu_indices(n_nodes, k=1)
+    edges = weights[:, iu, ju]
+    n_keep = max(1, int(round(density * len(iu))))
+    top = np.argpartition(-edges, n_keep - 1, axis=1)[:, :n_keep]
+    keep = np.zeros(edges.shape, dtype=bool)
+    np.put_along_axis(keep, top, True, axis=1)
+    keep &= edges > 0
+
+    adjacency = np.zeros(weights.shape, dtype=bool)
+    adjacency[:, iu, ju] = keep
+    return adjacency | adjacency.transpose(0, 2, 1)
+
+
+def bfs_distances(adjacency: np.ndarray) -> np.ndarray:
+    """
+    All-pairs shortest path lengths (in edges) of binary undirected graphs,
+    np.inf where unreachable. One batched boolean matmul per path length.
+    """
+    n_subjects, n_nodes, _ = adjacency.shape
+    step_matrix = adjacency.astype(np.float32)
+    reached = np.broadcast_to(np.eye(n_nodes, dtype=bool), adjacency.shape).copy()
+    frontier = reached.copy()
+    distances = np.where(reached, np.float32(0), np.float32(np.inf))
+    for length in range(1, n_nodes):
+        frontier = ((frontier.astype(np.float32) @ step_matrix) > 0) & ~reached
+        if not frontier.any():
+            break
+        distances[frontier] = length
+        reached |= frontier
+    return distances
+
+
+def global_efficiency(adjacency: np.ndarray) -> np.ndarray:
+    """
+    Mean inverse shortest path length over ordered node pairs, per subject.
+    """
+    n_nodes = adjacency.shape[-1]
+    with np.errstate(divide="ignore"):
+        inverse = 1.0 / bfs_distances(adjacency)
+    idx = np.arange(n_nodes)
+    inverse[:, idx, idx] = 0.0
+    return inverse.sum(axis=(1, 2)) / (n_nodes * (n_nodes - 1))
+
+
+def local_efficiency(adjacency: np.ndarray, block: int = 32) -> np.ndarray:
+    """
+    Binary local efficiency of every node: the efficiency of the subgraph of
+    its neighbours. `block` center nodes of every subject are stacked into one BFS.
+    """
+    n_subjects, n_nodes, _ = adjacency.shape
+    total = np.zeros((n_subjects, n_nodes))
+    idx = np.arange(n_nodes)
+    for start in range(0, n_nodes, block):
+        # (B, centers, N, N): the graph restricted to each center node's neighbours
+        neighbours = adjacency[:, start:start + block, :]
+        pairs = neighbours[:, :, :, None] & neighbours[:, :, None, :]
+        sub = adjacency[:, None, :, :] & pairs
+        distances = bfs_distances(sub.reshape(-1, n_nodes, n_nodes)).reshape(sub.shape)
+        pairs[:, :, idx, idx] = False
+        with np.errstate(divide="ignore"):
+            total[:, start:start + block] = np.where(pairs, 1.0 / distances, 0.0).sum(axis=(2, 3))
+    degree = adjacency.sum(axis=2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(degree > 1, total / (degree * (degree - 1)), 0.0)
+
+
+def weighted_clustering(weights: np.ndarray, adjacency: np.ndarray) -> np.ndarray:
+    """
+    Onnela weighted clustering on the thresholded weights (normalized by each
+    subject's largest weight): diag((W^1/3)^3) / (k (k - 1)).
+    """
+    kept = np.where(adjacency, weights, 0.0)
+    scale = kept.max(axis=(1, 2), keepdims=True)
+    cube_root = np.cbrt(kept / np.where(scale > 0, scale, 1.0))
+    cycles = np.einsum("bij,bji->bi", cube_root @ cube_root, cube_root)
+    degree = adjacency.sum(axis=2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(degree > 1, cycles / (degree * (degree - 1)), 0.0)
+
+
+def participation_coefficient(weights: np.ndarray, membership: np.ndarray) -> np.ndarray:
+    """
+    1 - sum_c (k_ic / k_i)^2 per node, with k_ic the node's weight into network c.
+    """
+    to_networks = weights @ membership
+    total = to_networks.sum(axis=2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(total > 0, 1.0 - np.square(to_networks / total[:, :, None]).sum(axis=2), 0.0)
+
+
+def modularity(weights: np.ndarray, membership: np.ndarray) -> np.ndarray:
+    """
+    Newman modularity of a fixed partition on non-negative weights:
+    trace(e) - ||e 1||^2, with e = M^T W M / 2m.
+    """
+    between = membership.T @ weights @ membership
+    two_m = between.sum(axis=(1, 2))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        e = between / two_m[:, None, None]
+        q = np.trace(e, axis1=1, axis2=2) - np.square(e.sum(axis=2)).sum(axis=1)
+    return np.where(two_m > 0, q, 0.0)
+
+
+def network_connectivity(weights: np.ndarray, membership: np.ndarray) -> np.ndarray:
+    """
+    (B, C, C) mean edge weight within / between networks (diagonal excluded).
+    """
+    sums = membership.T @ weights @ membership
+    sizes = membership.sum(axis=0)
+    pairs = np.outer(sizes, sizes) - np.diag(sizes)
+    return sums / np.where(pairs > 0, pairs, 1.0)
+
+
+def chunk_metrics(mats: np.ndarray, membership: np.ndarray, densities: tuple, with_local: bool = False) -> dict:
+    """
+    Every metric for one (b, N, N) chunk of subjects (run inside a worker).
+    """
+    weights = zero_diagonal(mats)
+    positive = np.clip(weights, 0.0, None)
+    out = {
+        "strength_pos": positive.sum(axis=2),
+        "strength_neg": np.clip(weights, None, 0.0).sum(axis=2),
+        "network_connectivity": network_connectivity(weights, membership),
+        "modularity_weighted": modularity(positive, membership),
+    }
+    per_density = {"degree": [], "clustering": [], "participation": [], "global_efficiency": [], "modularity": []}
+    if with_local:
+        per_density["local_efficiency"] = []
+    for density in densities:
+        adjacency = proportional_threshold(weights, density)
+        binary = adjacency.astype(np.float64)
+        per_density["degree"].append(adjacency.sum(axis=2))
+        per_density["clustering"].append(weighted_clustering(weights, adjacency))
+        per_density["participation"].append(participation_coefficient(binary, membership))
+        per_density["global_efficiency"].append(global_efficiency(adjacency))
+        per_density["modularity"].append(modularity(binary, membership))
+        if with_local:
+            per_density["local_efficiency"].append(local_efficiency(adjacency))
+    # Per-density metrics are stacked as (b, n_densities[, N])
+    for name, values in per_density.items():
+        out[name] = np.stack(values, axis=1)
+    return out
+
+
+def _chunk_job(args):
+    return chunk_metrics(*args)
+
+
+def compute_graph_metrics(
+    mats: np.ndarray,
+    assignment: np.ndarray,
+    densities: tuple = DEFAULT_DENSITIES,
+    with_local: bool = False,
+    num_workers: int = None,
+    chunk: int = DEFAULT_CHUNK
+) -> dict:
+    """
+    Graph metrics for every subject of a (B, N, N) stack.
+
+    Args:
+        mats (np.ndarray): Connectivity matrices (correlation, Fisher z, partial correlation, ...).
+        assignment (np.ndarray): Network name of each of the N nodes.
+        densities (tuple): Proportional thresholds (fraction of edges kept).
+        with_local (bool): Also compute binary local efficiency (the most expensive metric).
+        num_workers (int): Processes (default: all cores); 1 runs in-process.
+        chunk (int): Subjects per task.
+
+    Returns:
+        dict: Node metrics (B, N) or (B, n_densities, N), global metrics (B,)
+            or (B, n_densities), network_connectivity (B, C, C), and
+            'networks' / 'densities'.
+    """
+    names, membership = _one_hot(np.asarray(assignment))
+    jobs = [(mats[start:start + chunk], membership, tuple(densities), with_local) for start in range(0, len(mats), chunk)]
+    if num_workers == 1:
+        results = [_chunk_job(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(_chunk_job, jobs))
+    out = {name: np.concatenate([result[name] for result in results]) for name in results[0]}
+    out["networks"] = names
+    out["densities"] = np.asarray(densities)
+    return out
+
+
+def abnormality_zscores(metrics: dict, reference: np.ndarray) -> dict:
+    """
+    z-score every per-subject metric against the subjects in `reference`
+    (boolean mask, e.g. controls); zero-variance features give 0.
+    """
+    out = {}
+    for name, values in metrics.items():
+        if name in ("networks", "densities"):
+            continue
+        mean = values[reference].mean(axis=0)
+        std = values[reference].std(axis=0)
+        out[name] = np.where(std > 0, (values - mean) / np.where(std > 0, std, 1.0), 0.0)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Graph metrics for a stack of connectivity matrices.")
+    parser.add_argument("--connectivity", required=True, help="npz from connectivity.py (or any npz with a (B, N, N) array).")
+    parser.add_argument("--kind", default="correlation", help="Array in the npz to use. (default=correlation)")
+    parser.add_argument("--networks", required=True, help="'yeo17', 'neuromark' or a file with one network name per node.")
+    parser.add_argument("--densities", nargs="+", type=float, default=list(DEFAULT_DENSITIES), help="(default=0.1 0.2 0.3)")
+    parser.add_argument("--local_efficiency", action="store_true", help="Also compute binary local efficiency.")
+    parser.add_argument("--num_workers", type=int, default=None, help="Processes (default: all cores).")
+    parser.add_argument("--out", required=True, help="Output .npz.")
+
+    args = parser.parse_args()
+
+    with np.load(args.connectivity) as data:
+        mats = data[args.kind]
+        extra = {key: data[key] for key in ("subject_ids", "paths") if key in data}
+    assignment = network_assignment(args.networks, mats.shape[-1])
+    metrics = compute_graph_metrics(mats, assignment, tuple(args.densities), args.local_efficiency, args.num_workers)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    np.savez(args.out, **metrics, **extra)
+    print(f"Graph metrics of {len(mats)} subjects ({mats.shape[-1]} nodes, {len(metrics['networks'])} networks) saved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
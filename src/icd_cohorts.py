@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Vectorized ICD-10 cohort flagging for UK Biobank field 41202 (main diagnoses).
+
+icd_eda.ipynb built a Python list per participant from the 41202-* array
+columns and then ran one lambda per disease over every row. Here:
+  1) The 41202 columns are melted once into a long (eid, code) table.
+  2) The table becomes a sparse participant x code matrix over the code
+     vocabulary (~10k distinct codes).
+  3) Prefix matching (G30*, F31*, F33*, ...) is done once per vocabulary entry,
+     giving a code x disease indicator matrix; one sparse product then flags
+     every disease for every participant.
+  4) Diagnosis counts (all codes, F/G codes) come from row sums. Filters like the
+     copy_files notebooks' `any(code in x for code in codes) and len(x) <= k`
+     are boolean masks over these arrays.
+
+The output keeps the columns of proc/trimmed_icd.pkl (eid, 31-0.0, 21022-0.0,
+all_diagnoses, mental_and_neural_diagnoses, has_any_diagnosis,
+has_mental_or_neural_diagnosis, has_PD, has_AD, ...), so the notebooks can load
+it unchanged.
+
+Usage (example):
+  python icd_cohorts.py \
+    --ukb_csv /blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/UKB/4041061_11_23.csv \
+    --out ../results/2025_01_21_metadata_eda/proc/trimmed_icd.pkl \
+    --no_diagnosis_csv ../results/2025_01_21_metadata_eda/proc/no_diagnosis_icd.csv
+
+--ukb_csv also accepts the per-field Parquet folder written by filter_ukb_csv.py.
+"""
+
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from filter_ukb_csv import column_field, list_fields, read_fields
+
+
+DIAGNOSIS_FIELD = "41202"
+SEX_COLUMN = "31-0.0"
+AGE_COLUMN = "21022-0.0"
+
+# ICD-10 prefixes of the disease flags built in icd_eda.ipynb
+DISEASE_PREFIXES = {
+    "PD": ["G20"],
+    "AD": ["G30"],
+    "BPD": ["F31"],
+    "SZ": ["F20"],
+    "ASD": ["F84"],
+    "MCI": ["F067"],
+    "MDD": ["F33"],
+}
+
+
+def diagnosis_columns(columns, field: str = DIAGNOSIS_FIELD) -> list[str]:
+    """
+    The '<field>-<instance>.<array>' columns of `columns`.
+    """
+    return [col for col in columns if str(col).startswith(f"{field}-")]
+
+
+def melt_diagnoses(df: pd.DataFrame, diag_cols: list[str], id_col: str = "eid") -> pd.DataFrame:
+    """
+    Long (eid, code) table of every non-empty diagnosis cell, in column order per participant.
+    """
+    values = df[diag_cols].to_numpy(dtype=object)
+    rows, cols = np.nonzero(pd.notna(values))
+    codes = values[rows, cols].astype(str)
+    return pd.DataFrame({id_col: df[id_col].to_numpy()[rows], "row": rows, "code": codes})
+
+
+class DiagnosisMatrix:
+    """
+    Sparse participant x code indicator matrix.
+
+    Args:
+        long_df (pd.DataFrame): Output of melt_diagnoses ('row' is the participant's row).
+        n_participants (int): Number of rows of the original table.
+
+    Attributes:
+        codes (pd.Index): Code vocabulary (column labels).
+        matrix (scipy.sparse.csr_matrix): int8 (n_participants, n_codes) counts.
+    """
+
+    def __init__(self, long_df: pd.DataFrame, n_participants: int):
+        code_ids, self.codes = pd.factorize(long_df["code"], sort=True)
+        self.codes = pd.Index(self.codes)
+        self.matrix = sparse.csr_matrix(
+            (np.ones(len(long_df), dtype=np.int8), (long_df["row"].to_numpy(), code_ids)),
+            shape=(n_participants, len(self.codes))
+        )
+
+    def code_mask(self, prefixes: list[str] = None, codes: list[str] = None) -> np.ndarray:
+        """
+        Boolean mask over the vocabulary: codes starting with any of `prefixes`
+        or equal to any of `codes`.
+        """
+        mask = np.zeros(len(self.codes), dtype=bool)
+        if prefixes:
+            mask |= np.asarray(self.codes.str.startswith(tuple(prefixes)), dtype=bool)
+        if codes:
+            mask |= self.codes.isin(list(codes))
+        return mask
+
+    def count(self, mask: np.ndarray = None) -> np.ndarray:
+        """
+        Per-participant number of diagnoses (restricted to `mask` if given).
+        """
+        matrix = self.matrix if mask is None else self.matrix[:, np.flatnonzero(mask)]
+        return np.asarray(matrix.sum(axis=1)).ravel()
+
+    def flags(self, diseases: dict) -> pd.DataFrame:
+        """
+        One boolean column 'has_<name>' per {name: prefixes}, from a single sparse product.
+        """
+        names = list(diseases)
+        indicator = np.column_stack([self.code_mask(diseases[name]) for name in names]).astype(np.int32)
+        hits = self.matrix @ indicator
+        return pd.DataFrame(np.asarray(hits) > 0, columns=[f"has_{name}" for name in names])
+
+
+def code_lists(long_df: pd.DataFrame, n_participants: int, keep: pd.Series = None) -> list[list[str]]:
+    """
+    Per-participant list of codes in column order (only rows where `keep` is True),
+    as icd_eda.ipynb's list columns.
+    """
+    if keep is not None:
+        long_df = long_df[keep.to_numpy()]
+    lists = long_df.groupby("row", sort=True)["code"].agg(list)
+    out = [[] for _ in range(n_participants)]
+    for row, codes in zip(lists.index, lists.to_numpy()):
+        out[row] = codes
+    return out
+
+
+def mental_neural_mask(codes: pd.Index) -> np.ndarray:
+    """
+    Chapter F (mental) and G (nervous system) codes, as icd_eda.ipynb's "f"/"g" test.
+    """
+    return np.asarray(codes.str.contains("[FfGg]", regex=True), dtype=bool)
+
+
+def flag_cohorts(
+    df: pd.DataFrame,
+    diseases: dict = None,
+    id_col: str = "eid",
+    with_lists: bool = True
+) -> tuple[pd.DataFrame, DiagnosisMatrix]:
+    """
+    All disease flags and diagnosis counts for every participant in one pass.
+
+    Args:
+        df (pd.DataFrame): eid, optional sex/age columns and the 41202-* columns.
+        diseases (dict, optional): {name: ICD-10 prefixes} (default DISEASE_PREFIXES).
+        id_col (str, optional): Participant ID column (default 'eid').
+        with_lists (bool, optional): Also build the all_diagnoses /
+            mental_and_neural_diagnoses list columns (default True).
+
+    Returns:
+        (pd.DataFrame, DiagnosisMatrix): The flag table (41202 columns dropped) and the matrix.
+    """
+    diseases = DISEASE_PREFIXES if diseases is None else diseases
+    diag_cols = diagnosis_columns(df.columns)
+    long_df = melt_diagnoses(df, diag_cols, id_col)
+    diagnoses = DiagnosisMatrix(long_df, len(df))
+    mental_neural = mental_neural_mask(diagnoses.codes)
+
+    out = df.drop(columns=diag_cols).reset_index(drop=True)
+    if with_lists:
+        out["all_diagnoses"] = code_lists(long_df, len(df))
+        is_mental_neural = long_df["code"].isin(diagnoses.codes[mental_neural])
+        out["mental_and_neural_diagnoses"] = code_lists(long_df, len(df), is_mental_neural)
+    out["n_diagnoses"] = diagnoses.count()
+    out["n_mental_and_neural_diagnoses"] = diagnoses.count(mental_neural)
+    out["has_any_diagnosis"] = out["n_diagnoses"] >= 1
+    out["has_mental_or_neural_diagnosis"] = out["n_mental_and_neural_diagnoses"] >= 1
+    out = pd.concat([out, diagnoses.flags(diseases)], axis=1)
+    return out, diagnoses
+
+
+def diagnoses_from_lists(flags: pd.DataFrame, column: str = "all_diagnoses", id_col: str = "eid") -> DiagnosisMatrix:
+    """
+    Rebuild the DiagnosisMatrix of a saved flag table (e.g. trimmed_icd.pkl) from its list column.
+    """
+    exploded = flags[column].reset_index(drop=True).explode().dropna()
+    long_df = pd.DataFrame({
+        id_col: flags[id_col].to_numpy()[exploded.index.to_numpy()],
+        "row": exploded.index.to_numpy(),
+        "code": exploded.astype(str).to_numpy(),
+    })
+    return DiagnosisMatrix(long_df, len(flags))
+
+
+def select_cohort(
+    flags: pd.DataFrame,
+    diagnoses: DiagnosisMatrix,
+    prefixes: list[str] = None,
+    codes: list[str] = None,
+    max_diagnoses: int = None,
+    count_column: str = "n_mental_and_neural_diagnoses"
+) -> np.ndarray:
+    """
+    Boolean mask of participants with any of the given codes/prefixes and at
+    most `max_diagnoses` diagnoses in `count_column`. E.g. the copy_files_all
+    MDD cohort is select_cohort(flags, diagnoses, codes=["F330", ..., "F339"], max_diagnoses=2).
+    Without prefixes/codes, selects on the count only (controls: max_diagnoses=0
+    with count_column='n_diagnoses').
+    """
+    mask = np.ones(len(flags), dtype=bool)
+    if prefixes or codes:
+        mask &= diagnoses.count(diagnoses.code_mask(prefixes, codes)) > 0
+    if max_diagnoses is not None:
+        mask &= flags[count_column].to_numpy() <= max_diagnoses
+    return mask
+
+
+def read_diagnosis_table(ukb_csv: str, id_col: str = "eid") -> pd.DataFrame:
+    """
+    Read eid, sex, age and every 41202 column of the UKB basket (header resolved first).
+    `ukb_csv` can also be a per-field Parquet folder written by filter_ukb_csv.extract_fields.
+    """
+    if os.path.isdir(ukb_csv):
+        available = list_fields(ukb_csv)
+        fields = [column_field(col) for col in [SEX_COLUMN, AGE_COLUMN] if column_field(col) in available]
+        return read_fields(ukb_csv, fields + [DIAGNOSIS_FIELD], id_col)
+    header = pd.read_csv(ukb_csv, nrows=0).columns
+    usecols = [col for col in [id_col, SEX_COLUMN, AGE_COLUMN] if col in header] + diagnosis_columns(header)
+    dtypes = {col: "string" for col in diagnosis_columns(header)}
+    return pd.read_csv(ukb_csv, usecols=usecols, dtype=dtypes)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Flag ICD-10 (field 41202) disease cohorts for all UKB participants."
+    )
+    parser.add_argument("--ukb_csv", required=True, help="UKB main dataset CSV (or filter_ukb_csv.py Parquet folder).")
+    parser.add_argument("--out", required=True, help="Output pickle (same layout as proc/trimmed_icd.pkl).")
+    parser.add_argument(
+        "--no_diagnosis_csv", default=None,
+        help="Optional CSV of eid/sex/age for participants without any diagnosis."
+    )
+    parser.add_argument(
+        "--no_lists", action="store_true",
+        help="Skip the all_diagnoses / mental_and_neural_diagnoses list columns."
+    )
+
+    args = parser.parse_args()
+
+    df = read_diagnosis_table(args.ukb_csv)
+    flags, _ = flag_cohorts(df, with_lists=not args.no_lists)
+    flags.to_pickle(args.out)
+    print(f"Flags for {len(flags)} participants written to {args.out}")
+    for col in [c for c in flags.columns if c.startswith("has_")]:
+        print(f"{col}: {int(flags[col].sum())}")
+
+    if args.no_diagnosis_csv is not None:
+        id_cols = [col for col in ["eid", SEX_COLUMN, AGE_COLUMN] if col in flags.columns]
+        flags[~flags["has_any_diagnosis"]][id_cols].to_csv(args.no_diagnosis_csv)
+        print(f"Participants without diagnoses written to {args.no_diagnosis_csv}")
+
+
+if __name__ == "__main__":
+    main()
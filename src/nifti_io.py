@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+"""
+Shared NIfTI read/write layer with faster gzip backends.
+
+nibabel reads and writes every .nii.gz (ABIDE func_preproc, UKB
+filtered_func_data_clean, FLIRT outputs) through the stdlib gzip module, i.e.
+single-threaded zlib in the same thread as the parcellation arithmetic. This
+module picks the fastest backend that is installed:
+  1) isal      - python-isal (ISA-L inflate/deflate). Reads inflate in a
+                 background thread; writes compress blocks in parallel.
+  2) pigz      - the `pigz` executable through a pipe (parallel compression,
+                 decompression in a separate process).
+  3) indexed_gzip - random-access reads through a seek-point index.
+  4) gzip      - stdlib gzip via nibabel (always available).
+
+A single deflate stream cannot be inflated block-parallel, so the read-side gain
+comes from the faster inflate and from overlapping decompression with the
+caller's work; the isal and pigz readers are sequential, so volumes must be read
+in increasing order (as iter_volume_chunks does). Use backend='indexed_gzip' or
+'gzip' for arbitrary access.
+
+Writes go to '<path>.part' and are renamed when complete. Reads that go
+through open_nifti() close the decompression stream (and stop the pigz
+process) when the block exits.
+
+Usage (example, benchmark on a synthetic 4D volume):
+  python nifti_io.py --shape 91 109 91 200 --work_dir /tmp/nifti_bench
+"""
+
+import io
+import os
+import gzip
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from contextlib import contextmanager
+
+import numpy as np
+import nibabel as nib
+
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+
+READ_BACKENDS = ("isal", "pigz", "indexed_gzip", "gzip")
+WRITE_BACKENDS = ("isal", "pigz", "gzip")
+
+# Compression level used when none is given, per backend (isal levels are 0..3)
+DEFAULT_COMPRESSLEVEL = {"isal": 2, "pigz": 6, "gzip": 6}
+
+# Bytes kept from the start of a sequential stream, so the header and
+# extensions can be re-read after nibabel seeks back to them
+HEAD_CACHE_SIZE = 1 << 16
+SKIP_BLOCK_SIZE = 1 << 22
+
+
+def available_backends(write: bool = False) -> list[str]:
+    """
+    Backends usable in this environment, fastest first.
+    """
+    backends = []
+    for backend in (WRITE_BACKENDS if write else READ_BACKENDS):
+        if backend == "isal" and igzip_threaded is None:
+            continue
+        if backend == "pigz" and shutil.which("pigz") is None:
+            continue
+        if backend == "indexed_gzip" and indexed_gzip is None:
+            continue
+        backends.append(backend)
+    return backends
+
+
+def resolve_backend(backend: str = "auto", write: bool = False) -> str:
+    """
+    Return `backend`, or the fastest available one for 'auto'.
+    """
+    available = available_backends(write)
+    if backend == "auto":
+        return available[0]
+    if backend not in available:
+        raise ValueError(f"gzip backend '{backend}' is not available here (available: {available})")
+    return backend
+
+
+def default_threads() -> int:
+    return max(1, os.cpu_count() or 1)
+
+
+class SequentialReader(io.RawIOBase):
+    """
+    Read-only stream over a non-seekable source, with tell() and forward seeks.
+
+    The first HEAD_CACHE_SIZE bytes are kept, so seeks back into the header
+    work; any other backward seek raises io.UnsupportedOperation.
+
+    Args:
+        raw: Object with read(n) returning decompressed bytes.
+        on_close (callable, optional): Called once when the stream is closed.
+    """
+
+    def __init__(self, raw, on_close=None):
+        super().__init__()
+        self._raw = raw
+        self._on_close = on_close
+        self._head = self._read_exact(HEAD_CACHE_SIZE)
+        self._raw_pos = len(self._head)
+        self._pos = 0
+
+    def _read_exact(self, n: int) -> bytes:
+        parts, remaining = [], n
+        while remaining > 0:
+            data = self._raw.read(remaining)
+            if not data:
+                break
+            parts.append(data)
+            remaining -= len(data)
+        return b"".join(parts)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("SequentialReader cannot seek relative to the end")
+        if offset < self._pos and offset > len(self._head):
+            raise io.UnsupportedOperation(
+                f"Backward seek to {offset} (at {self._pos}); this gzip backend is sequential, "
+                "read volumes in order or use backend='indexed_gzip' / 'gzip'."
+            )
+        self._pos = offset
+        return self._pos
+
+    def _sync_raw(self) -> None:
+        # Only reached past the cached head: skip forward in the source if needed
+        if self._pos < self._raw_pos:
+            raise io.UnsupportedOperation(
+                f"Cannot re-read data at {self._pos} (stream is at {self._raw_pos}); this gzip backend is "
+                "sequential, read volumes in order or use backend='indexed_gzip' / 'gzip'."
+            )
+        while self._raw_pos < self._pos:
+            skipped = self._raw.read(min(SKIP_BLOCK_SIZE, self._pos - self._raw_pos))
+            if not skipped:
+                break
+            self._raw_pos += len(skipped)
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        filled = 0
+        if self._pos < len(self._head):
+            n = min(len(view), len(self._head) - self._pos)
+            view[:n] = self._head[self._pos:self._pos + n]
+            self._pos += n
+            filled = n
+        if filled < len(view):
+            self._sync_raw()
+            data = self._read_exact(len(view) - filled)
+            view[filled:filled + len(data)] = data
+            filled += len(data)
+            self._pos += len(data)
+            self._raw_pos += len(data)
+        return filled
+
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                self._raw.close()
+            finally:
+                if self._on_close is not None:
+                    self._on_close()
+        super().close()
+
+
+class CountingWriter(io.RawIOBase):
+    """
+    Write-only wrapper that reports tell() for a non-seekable sink, so nibabel
+    can pad to the data offset with zeros instead of seeking.
+    """
+
+    def __init__(self, raw, on_close=None):
+        super().__init__()
+        self._raw = raw
+        self._on_close = on_close
+        self._pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET and offset == self._pos:
+            return self._pos
+        raise io.UnsupportedOperation("CountingWriter cannot seek")
+
+    def write(self, data) -> int:
+        n = memoryview(data).nbytes
+        self._raw.write(data)
+        self._pos += n
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                self._raw.close()
+            finally:
+                if self._on_close is not None:
+                    self._on_close()
+        super().close()
+
+
+def _finish_process(process: subprocess.Popen, what: str) -> None:
+    returncode = process.wait()
+    if returncode != 0:
+        raise IOError(f"pigz exited with code {returncode} while {what}")
+
+
+def open_gzip_reader(path: str, backend: str = "auto", threads: int = None):
+    """
+    Open a .gz file for reading with the given backend.
+
+    Returns:
+        A binary file-like object of the decompressed bytes. isal and pigz
+        streams are sequential (see SequentialReader).
+    """
+    backend = resolve_backend(backend)
+    threads = threads or default_threads()
+
+    if backend == "isal":
+        return SequentialReader(igzip_threaded.open(path, "rb", threads=1))
+    if backend == "pigz":
+        process = subprocess.Popen(
+            ["pigz", "-dc", "-p", str(threads), path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+
+        def on_close():
+            # Closing early (e.g. header-only use) stops pigz with SIGPIPE; that is not an error
+            if process.poll() is None:
+                process.terminate()
+            process.wait()
+
+        return SequentialReader(process.stdout, on_close)
+    if backend == "indexed_gzip":
+        return indexed_gzip.IndexedGzipFile(path)
+    return gzip.open(path, "rb")
+
+
+def _image_class(fileobj):
+    # sizeof_hdr is 348 for NIfTI-1 and 540 for NIfTI-2, in either byte order
+    start = fileobj.tell()
+    sizeof_hdr = fileobj.read(4)
+    fileobj.seek(start)
+    if sizeof_hdr in (np.int32(540).tobytes(), np.int32(540).byteswap().tobytes()):
+        return nib.Nifti2Image
+    return nib.Nifti1Image
+
+
+def load_nifti(path: str, backend: str = "auto", threads: int = None):
+    """
+    Load a NIfTI image, decompressing .nii.gz files with the fastest available backend.
+
+    Args:
+        path (str): .nii or .nii.gz file.
+        backend (str, optional): 'auto', 'isal', 'pigz', 'indexed_gzip' or 'gzip' (default 'auto').
+        threads (int, optional): Threads for pigz (default all cores).
+
+    Returns:
+        nib.Nifti1Image | nib.Nifti2Image: Image whose data proxy reads from the open
+        stream; with the sequential backends, read volumes in increasing order.
+        The stream (and a pigz process) stays open until garbage collection;
+        long-lived processes should use open_nifti instead.
+    """
+    if not path.endswith(".gz"):
+        return nib.load(path)
+    backend = resolve_backend(backend)
+    if backend == "gzip":
+        # keep_file_open lets consecutive chunk reads continue from the current gzip position
+        return nib.load(path, keep_file_open=True)
+
+    fileobj = open_gzip_reader(path, backend, threads)
+    return _image_class(fileobj).from_stream(fileobj)
+
+
+@contextmanager
+def open_nifti(path: str, backend: str = "auto", threads: int = None):
+    """
+    load_nifti as a context manager: the decompression stream is closed, and a
+    pigz process stopped and reaped, when the block exits.
+
+    Usage:
+        with open_nifti(path) as img:
+            for t_start, chunk in iter_volume_chunks(img):
+                ...
+    """
+    if not path.endswith(".gz"):
+        yield nib.load(path)
+        return
+    fileobj = open_gzip_reader(path, backend, threads)
+    try:
+        yield _image_class(fileobj).from_stream(fileobj)
+    finally:
+        fileobj.close()
+
+
+def save_nifti(img, path: str, backend: str = "auto", threads: int = None, compresslevel: int = None) -> str:
+    """
+    Save a NIfTI image, compressing .nii.gz files with the fastest available backend.
+
+    Args:
+        img: nibabel NIfTI image.
+        path (str): Output .nii or .nii.gz path.
+        backend (str, optional): 'auto', 'isal', 'pigz' or 'gzip' (default 'auto').
+        threads (int, optional): Compression threads for isal / pigz (default all cores).
+        compresslevel (int, optional): Backend-specific level (default DEFAULT_COMPRESSLEVEL).
+
+    Returns:
+        str: Name of the backend used.
+    """
+    if not path.endswith(".gz"):
+        nib.save(img, path)
+        return "none"
+
+    backend = resolve_backend(backend, write=True)
+    threads = threads or default_threads()
+    level = DEFAULT_COMPRESSLEVEL[backend] if compresslevel is None else compresslevel
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    part_path = f"{path}.part"
+
+    try:
+        if backend == "isal":
+            stream = CountingWriter(igzip_threaded.open(part_path, "wb", compresslevel=level, threads=threads))
+        elif backend == "pigz":
+            out_file = open(part_path, "wb")
+            process = subprocess.Popen(
+                ["pigz", "-c", f"-{level}", "-p", str(threads)],
+                stdin=subprocess.PIPE, stdout=out_file
+            )
+
+            def on_close():
+                out_file.close()
+                _finish_process(process, f"writing {path}")
+
+            stream = CountingWriter(process.stdin, on_close)
+        else:
+            stream = CountingWriter(gzip.open(part_path, "wb", compresslevel=level))
+
+        with stream:
+            img.to_stream(stream)
+        os.replace(part_path, path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    return backend
+
+
+def synthetic_volume(shape: tuple, seed: int = 0) -> nib.Nifti1Image:
+    """
+    float32 4D image with a spherical 'brain' of smooth signal plus noise and a
+    zero background, roughly as compressible as preprocessed fMRI.
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.indices(shape[:3], dtype=np.float32)
+    centre = (np.array(shape[:3], dtype=np.float32) - 1) / 2
+    radius = ((grid - centre[:, None, None, None]) ** 2 / centre[:, None, None, None] ** 2).sum(axis=0)
+    mask = radius <= 1.0
+
+    data = np.zeros(shape, dtype=np.float32)
+    baseline = 1000 * (1 - 0.3 * radius[mask])
+    for t in range(shape[3]):
+        volume = data[..., t]
+        volume[mask] = baseline + rng.normal(0, 10, mask.sum()).astype(np.float32)
+
+    img = nib.Nifti1Image(data, np.diag([2.0, 2.0, 2.0, 1.0]))
+    img.header.set_xyzt_units("mm", "sec")
+    return img
+
+
+def benchmark(shape: tuple, work_dir: str, threads: int = None, chunk_size: int = 32) -> list[dict]:
+    """
+    Time writing and chunked reading of a synthetic 4D volume with every
+    available backend, and check each read against the original data.
+
+    Returns:
+        List[dict]: One row per backend with write/read seconds and speedups vs gzip.
+    """
+    img = synthetic_volume(shape)
+    expected = np.asarray(img.dataobj)
+    os.makedirs(work_dir, exist_ok=True)
+    print(f"Synthetic volume {shape}, {expected.nbytes / 2 ** 20:.0f} MiB uncompressed.")
+
+    # One file per write backend; all read backends are timed on the stdlib-gzip file
+    rows = []
+    for backend in available_backends(write=True):
+        path = os.path.join(work_dir, f"bench_{backend}.nii.gz")
+        start = time.time()
+        save_nifti(img, path, backend, threads)
+        rows.append({
+            "backend": backend,
+            "op": "write",
+            "seconds": time.time() - start,
+            "mib": os.path.getsize(path) / 2 ** 20,
+        })
+
+    source = os.path.join(work_dir, "bench_gzip.nii.gz")
+    for backend in available_backends():
+        start = time.time()
+        with open_nifti(source, backend, threads) as loaded:
+            n_timepoints = loaded.shape[-1]
+            for t_start in range(0, n_timepoints, chunk_size):
+                t_stop = min(t_start + chunk_size, n_timepoints)
+                chunk = np.asarray(loaded.dataobj[..., t_start:t_stop])
+                if not np.array_equal(chunk, expected[..., t_start:t_stop]):
+                    raise AssertionError(f"{backend} read back different data at volumes {t_start}:{t_stop}")
+        rows.append({
+            "backend": backend,
+            "op": "read",
+            "seconds": time.time() - start,
+            "mib": os.path.getsize(source) / 2 ** 20,
+        })
+
+    baseline = {row["op"]: row["seconds"] for row in rows if row["backend"] == "gzip"}
+    for row in rows:
+        row["speedup"] = baseline[row["op"]] / row["seconds"] if row["seconds"] > 0 else float("inf")
+        print(f"{row['op']:>5}  {row['backend']:<12} {row['seconds']:7.2f}s  "
+              f"{row['mib']:8.1f} MiB on disk  x{row['speedup']:.2f} vs gzip")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the NIfTI gzip backends on a synthetic 4D volume."
+    )
+    parser.add_argument(
+        "--shape", type=int, nargs=4, default=[91, 109, 91, 200],
+        help="Volume shape X Y Z T. (default=91 109 91 200)"
+    )
+    parser.add_argument(
+        "--work_dir", default=None,
+        help="Directory for the benchmark files (default: a temporary directory)."
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None,
+        help="Threads for isal / pigz (default: all cores)."
+    )
+
+    args = parser.parse_args()
+
+    print(f"Available backends: read={available_backends()}, write={available_backends(write=True)}")
+    if args.work_dir is not None:
+        benchmark(tuple(args.shape), args.work_dir, args.threads)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            benchmark(tuple(args.shape), work_dir, args.threads)
+
+
+if __name__ == "__main__":
+    main()
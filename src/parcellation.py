@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Shared atlas parcellation utilities.
+
+Computes parcel-mean time series from 4D fMRI data in time chunks, so a
+volume never has to be held in memory as a full float64 array, and the same
+code can parcellate data that comes from disk or from an in-memory step
+(e.g. the in-process MNI resampler in resample.py).
+
+The parcel means match the original per-label loop in segment_single_fMRI.py:
+for labels 1..n_parcels, the NaN-ignoring mean over the parcel's voxels,
+with empty or all-NaN parcels set to 0.
+
+With qc=True the same pass also feeds a scan_qc.QCAccumulator (tSNR, DVARS,
+global signal, per-parcel coverage and NaN fraction).
+"""
+
+import os
+from typing import Iterable
+
+import numpy as np
+import nibabel as nib
+
+from nifti_io import open_nifti
+from scan_qc import QCAccumulator
+
+
+# Number of volumes read and reduced at a time
+DEFAULT_CHUNK_SIZE = 32
+
+
+def load_atlas(atlas_path: str) -> np.ndarray:
+    """
+    Load a NIfTI atlas from `atlas_path` and return it as a flattened NumPy array.
+    """
+    try:
+        atlas_img = nib.load(atlas_path)
+        atlas_data = atlas_img.get_fdata()
+        return atlas_data.flatten()
+    except Exception as e:
+        raise IOError(f"Failed to load atlas at {atlas_path}: {str(e)}")
+
+
+class ParcelAccumulator:
+    """
+    Accumulate parcel-mean time series from chunks of volumes.
+
+    The voxels of labels 1..n_parcels are sorted by label once, so each chunk
+    is reduced with a single np.add.reduceat over the labelled voxels instead
+    of one boolean mask per parcel.
+
+    Args:
+        label_data (np.ndarray): Flattened atlas labels (C order, same grid as the fMRI data).
+        n_parcels (int): Labels 1..n_parcels are extracted.
+        n_timepoints (int): Total number of volumes that will be added.
+    """
+
+    def __init__(self, label_data: np.ndarray, n_parcels: int, n_timepoints: int):
+        labels = np.rint(np.asarray(label_data).ravel()).astype(np.int64)
+        in_range = np.flatnonzero((labels >= 1) & (labels <= n_parcels))
+        order = np.argsort(labels[in_range], kind="stable")
+
+        self.n_parcels = n_parcels
+        self.n_voxels = labels.size
+        self.voxel_index = in_range[order]
+        sorted_labels = labels[self.voxel_index]
+
+        self.voxel_counts = np.bincount(sorted_labels - 1, minlength=n_parcels)
+        self.present = np.flatnonzero(self.voxel_counts)
+        self.starts = np.searchsorted(sorted_labels, self.present + 1)
+
+        self.sums = np.zeros((n_timepoints, n_parcels))
+        self.valid_counts = np.zeros((n_timepoints, n_parcels))
+        self.qc = None
+
+    @classmethod
+    def from_atlas(cls, atlas, n_timepoints: int, n_parcels: int = None) -> "ParcelAccumulator":
+        """
+        Build from a compiled atlas (atlas_registry.CompiledAtlas), reusing its
+        precomputed label-sorted voxel index instead of sorting the labels again.
+        n_parcels defaults to the atlas's largest label.
+        """
+        self = cls.__new__(cls)
+        self.n_parcels = atlas.n_parcels if n_parcels is None else n_parcels
+        self.n_voxels = atlas.n_voxels
+
+        keep = np.asarray(atlas.labels) <= self.n_parcels
+        n_kept = int(np.sum(atlas.counts[keep]))
+        self.voxel_index = np.asarray(atlas.voxel_index[:n_kept])
+        self.voxel_counts = np.zeros(self.n_parcels, dtype=np.int64)
+        self.voxel_counts[np.asarray(atlas.labels)[keep] - 1] = atlas.counts[keep]
+        self.present = np.asarray(atlas.labels)[keep] - 1
+        self.starts = np.asarray(atlas.starts)[keep]
+
+        self.sums = np.zeros((n_timepoints, self.n_parcels))
+        self.valid_counts = np.zeros((n_timepoints, self.n_parcels))
+        self.qc = None
+        return self
+
+    def enable_qc(self) -> QCAccumulator:
+        """
+        Also accumulate scan QC metrics from every chunk added from now on.
+        """
+        self.qc = QCAccumulator(self.starts, self.present, self.voxel_counts, self.sums.shape[0])
+        return self.qc
+
+    def add_chunk(self, t_start: int, chunk: np.ndarray) -> None:
+        """
+        Add volumes t_start .. t_start + chunk.shape[-1] - 1.
+
+        Args:
+            t_start (int): Index of the first volume in the chunk.
+            chunk (np.ndarray): Array of shape (X, Y, Z, t) or (n_voxels, t).
+        """
+        n_t = chunk.shape[-1]
+        if len(self.present) == 0 or n_t == 0:
+            return
+
+        flat = chunk.reshape(self.n_voxels, n_t)
+        values = flat[self.voxel_index].astype(np.float64)
+        if self.qc is not None:
+            self.qc.add_values(t_start, values)
+        valid = ~np.isnan(values)
+        values[~valid] = 0.0
+
+        rows = slice(t_start, t_start + n_t)
+        self.sums[rows, self.present] = np.add.reduceat(values, self.starts, axis=0).T
+        self.valid_counts[rows, self.present] = np.add.reduceat(valid, self.starts, axis=0).T
+
+    def result(self) -> np.ndarray:
+        """
+        Return the (timepoints, parcels) mean time series, with empty parcels as 0.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pmTS = self.sums / self.valid_counts
+        pmTS[np.isnan(pmTS)] = 0
+        return pmTS
+
+
+def iter_volume_chunks(fmri_img: nib.spatialimages.SpatialImage, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """
+    Yield (t_start, float32 array of shape (X, Y, Z, t)) chunks of a 4D image,
+    reading only `chunk_size` volumes at a time from its data proxy.
+    """
+    n_timepoints = fmri_img.shape[-1]
+    for t_start in range(0, n_timepoints, chunk_size):
+        t_stop = min(t_start + chunk_size, n_timepoints)
+        chunk = np.asarray(fmri_img.dataobj[..., t_start:t_stop], dtype=np.float32)
+        yield t_start, chunk
+
+
+def parcellate_chunks(
+    chunks: Iterable[tuple[int, np.ndarray]],
+    label_data,
+    n_parcels: int,
+    n_timepoints: int,
+    qc: bool = False
+):
+    """
+    Parcellate a stream of (t_start, volumes) chunks into a (timepoints, parcels) array.
+    `label_data` is a flattened label array or a compiled atlas (atlas_registry.py).
+    With `qc`, returns (array, scan_qc.ScanQC) computed in the same pass.
+    """
+    if isinstance(label_data, np.ndarray):
+        accumulator = ParcelAccumulator(label_data, n_parcels, n_timepoints)
+    else:
+        accumulator = ParcelAccumulator.from_atlas(label_data, n_timepoints, n_parcels)
+    if qc:
+        accumulator.enable_qc()
+    for t_start, chunk in chunks:
+        accumulator.add_chunk(t_start, chunk)
+    if qc:
+        return accumulator.result(), accumulator.qc.result()
+    return accumulator.result()
+
+
+def check_grid(fmri_shape: tuple, label_data: np.ndarray, fmri_path: str = "") -> None:
+    """
+    Raise ValueError if the atlas does not have one label per fMRI voxel.
+    """
+    n_voxels = int(np.prod(fmri_shape[:3]))
+    if label_data.size != n_voxels:
+        raise ValueError(
+            f"Atlas has {label_data.size} voxels but {fmri_path or 'the fMRI data'} has "
+            f"{n_voxels} {tuple(fmri_shape[:3])}; the atlas and data must share a grid."
+        )
+
+
+def extract_parcel_timeseries(
+    fmri_path: str,
+    label_data,
+    n_parcels: int = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    gzip_backend: str = "auto",
+    qc: bool = False
+):
+    """
+    Load a 4D fMRI volume from `fmri_path` in chunks of `chunk_size` volumes and
+    compute the mean time series for each of the `n_parcels` in `label_data`.
+    Assumes labels 1..n_parcels. Returns a 2D array of shape (timepoints, parcels).
+    `label_data` is either a flattened label array (then n_parcels is required)
+    or a compiled atlas from atlas_registry.get_atlas, whose grid (shape and affine)
+    is checked against the fMRI header and whose largest label is the default n_parcels.
+    `gzip_backend` selects the decompressor (see nifti_io.load_nifti); the
+    stream is closed before returning.
+    With `qc`, returns (timeseries, scan_qc.ScanQC) from the same streamed pass.
+    """
+    # Chunks are read in order, so the sequential (threaded) gzip backends can be used
+    with open_nifti(fmri_path, gzip_backend) as fmri_img:
+        if isinstance(label_data, np.ndarray):
+            if n_parcels is None:
+                raise ValueError("n_parcels is required with a plain label array")
+            check_grid(fmri_img.shape, label_data, fmri_path)
+        else:
+            label_data.check_image(fmri_img, fmri_path)
+        return parcellate_chunks(
+            iter_volume_chunks(fmri_img, chunk_size),
+            label_data,
+            n_parcels,
+            fmri_img.shape[-1],
+            qc
+        )
+
+
+def save_timeseries(pmTS: np.ndarray, out_file: str):
+    """
+    Save time series (2D NumPy array) to a .dat file using tab delimiters.
+    """
+    np.savetxt(out_file, pmTS, delimiter='\t')
+
+
+def output_dat_path(fmri_file: str, out_dir: str = None) -> str:
+    """
+    '<out_dir or fMRI folder>/<fMRI name without .nii.gz>.dat'
+    """
+    if out_dir is None:
+        out_dir = os.path.dirname(fmri_file)
+    base_name = os.path.basename(fmri_file).replace(".nii.gz", "")
+    return os.path.join(out_dir, f"{base_name}.dat")
@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+"""
+Local parallel pipeline runner for the per-subject preprocessing chain.
+
+The SLURM array scripts (register_to_mni.sh, run_convert_to_parcels.sh, mni.sh)
+each pick one line of file_list.txt per array task, or loop serially, and
+nothing links registration to parcellation. This script instead declares the
+chain of stages once:
+
+    extract (UKB only) -> register -> parcellate -> connectivity
+
+(or, with --fused, extract -> register_parcellate -> connectivity, see
+register_and_parcellate.py)
+
+and runs it over a local process pool:
+  1) Every stage lists its output files. When a stage succeeds, a
+     '<output>.done' marker is written next to each output; a stage whose
+     outputs and markers exist is skipped, so re-runs only do missing work. A
+     file left by a job killed mid-write has no marker and is redone.
+  2) Stages are chained per subject: as soon as a subject's registration
+     finishes, its parcellation is scheduled ahead of new registrations.
+  3) Each stage may cap how many of its jobs run at once (e.g. memory-heavy
+     registration), independently of the total number of workers.
+  4) A subject whose stage fails is reported and its later stages are not run.
+
+A SLURM backend is still available: --slurm writes a manifest and an sbatch
+array script in which each task runs the whole chain for one subject.
+
+Usage (example):
+  python pipeline.py \
+    --cohort abide \
+    --file_list file_list.txt \
+    --work_dir /blue/ruogu.fang/ryoi360/projects/fmri_vlm/data \
+    --num_workers 16
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+import numpy as np
+
+from fmri_loader import load_dat_file, compute_fisher_z
+from unzip import extract_selected_members, unzip_destination
+from atlas_registry import resolve_template_path
+
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(SRC_DIR)
+SEGMENT_SCRIPT = os.path.join(
+    REPO_DIR, "results", "2025_03_03_abide_abnormality_detection",
+    "02_convert_to_parcels", "segment_single_fMRI.py"
+)
+FUSED_SCRIPT = os.path.join(SRC_DIR, "register_and_parcellate.py")
+
+# Written next to each output once its stage succeeded
+COMPLETE_SUFFIX = ".done"
+
+# Registered names in atlas_registry.py (TEMPLATES / ATLASES)
+DEFAULT_REF = "mni152_2mm"
+DEFAULT_ATLAS = "aal3"
+
+
+@dataclass
+class Stage:
+    """
+    One step of the per-subject chain.
+
+    Exactly one of `command` or `func` is set. Strings in `command` and
+    `outputs` are format templates filled from the subject dict, e.g.
+    "{registered}" -> subject["registered"].
+
+    Attributes:
+        name (str): Stage name used in logs and the status table.
+        outputs (List[str]): Output path templates; the stage is complete when all
+            exist with their completion markers.
+        command (List[str], optional): Command line template run with subprocess.
+        func (Callable, optional): Module-level function called as func(subject).
+        max_parallel (int, optional): Maximum number of concurrent jobs of this stage.
+        slurm_time (str): Per-subject time estimate, used for the SLURM backend.
+        slurm_mem (str): Per-subject memory estimate, used for the SLURM backend.
+        modules (List[str]): Environment modules this stage needs under SLURM (e.g. 'fsl').
+    """
+    name: str
+    outputs: list[str]
+    command: Optional[list[str]] = None
+    func: Optional[Callable[[dict], None]] = None
+    max_parallel: Optional[int] = None
+    slurm_time: str = "0:10:00"
+    slurm_mem: str = "8gb"
+    modules: list[str] = field(default_factory=list)
+
+    def output_paths(self, subject: dict) -> list[str]:
+        return [template.format(**subject) for template in self.outputs]
+
+    def is_complete(self, subject: dict) -> bool:
+        """
+        True if every output exists, is non-empty and has its completion marker.
+        """
+        return all(
+            os.path.isfile(path) and os.path.getsize(path) > 0 and os.path.isfile(path + COMPLETE_SUFFIX)
+            for path in self.output_paths(subject)
+        )
+
+    def mark_complete(self, subject: dict, complete: bool = True) -> None:
+        """
+        Write (or remove) the completion marker of every output.
+        """
+        for path in self.output_paths(subject):
+            marker = path + COMPLETE_SUFFIX
+            if complete:
+                open(marker, "w").close()
+            elif os.path.isfile(marker):
+                os.remove(marker)
+
+
+def run_stage(stage: Stage, subject: dict) -> dict:
+    """
+    Run one stage for one subject. Runs inside a worker process.
+
+    Returns:
+        dict: {'ok': bool, 'seconds': float, 'message': str}
+    """
+    start = time.time()
+    for path in stage.output_paths(subject):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # The outputs are about to be rewritten: they are incomplete until the stage succeeds
+    stage.mark_complete(subject, complete=False)
+
+    try:
+        if stage.command is not None:
+            command = [part.format(**subject) for part in stage.command]
+            completed = subprocess.run(command, capture_output=True, text=True)
+            if completed.returncode != 0:
+                message = (completed.stderr or completed.stdout).strip().splitlines()
+                return {
+                    "ok": False,
+                    "seconds": time.time() - start,
+                    "message": f"exit code {completed.returncode}: {message[-1] if message else ''}"
+                }
+        else:
+            stage.func(subject)
+    except Exception as exc:
+        return {"ok": False, "seconds": time.time() - start, "message": f"{type(exc).__name__}: {exc}"}
+
+    if not all(os.path.isfile(path) and os.path.getsize(path) > 0 for path in stage.output_paths(subject)):
+        return {"ok": False, "seconds": time.time() - start, "message": "finished without writing its outputs"}
+    stage.mark_complete(subject)
+    return {"ok": True, "seconds": time.time() - start, "message": ""}
+
+
+def run_pipeline(
+    stages: list[Stage],
+    subjects: list[dict],
+    num_workers: int = None,
+    force: bool = False
+) -> dict:
+    """
+    Run the stage chain for all subjects over a local process pool.
+
+    Args:
+        stages (List[Stage]): Ordered stages; stage i+1 of a subject starts after stage i finished.
+        subjects (List[dict]): One dict per subject with 'subject_id' and the template fields.
+        num_workers (int, optional): Number of worker processes (default os.cpu_count()).
+        force (bool, optional): Re-run stages even if their outputs exist (default False).
+
+    Returns:
+        dict: subject_id -> {stage name: 'done' | 'skipped' | 'failed: <message>'}.
+    """
+    num_workers = num_workers or os.cpu_count()
+    status = {subject["subject_id"]: {} for subject in subjects}
+    counts = Counter()
+
+    # (subject, next stage index); in-flight subjects are re-queued at the front
+    ready = deque((subject, 0) for subject in subjects)
+    running = {}
+    stage_running = Counter()
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        while ready or running:
+            deferred = deque()
+            while ready and len(running) < num_workers:
+                subject, stage_idx = ready.popleft()
+
+                # Skip stages whose outputs are already on disk
+                while not force and stage_idx < len(stages) and stages[stage_idx].is_complete(subject):
+                    status[subject["subject_id"]][stages[stage_idx].name] = "skipped"
+                    counts[(stages[stage_idx].name, "skipped")] += 1
+                    stage_idx += 1
+                if stage_idx == len(stages):
+                    continue
+
+                stage = stages[stage_idx]
+                if stage.max_parallel is not None and stage_running[stage.name] >= stage.max_parallel:
+                    deferred.append((subject, stage_idx))
+                    continue
+
+                future = executor.submit(run_stage, stage, subject)
+                running[future] = (subject, stage_idx)
+                stage_running[stage.name] += 1
+            ready.extendleft(reversed(deferred))
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                subject, stage_idx = running.pop(future)
+                stage = stages[stage_idx]
+                stage_running[stage.name] -= 1
+                subject_id = subject["subject_id"]
+
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    result = {"ok": False, "seconds": 0.0, "message": f"{type(exc).__name__}: {exc}"}
+
+                if result["ok"]:
+                    status[subject_id][stage.name] = "done"
+                    counts[(stage.name, "done")] += 1
+                    print(f"[{stage.name}] {subject_id} done in {result['seconds']:.1f}s")
+                    if stage_idx + 1 < len(stages):
+                        ready.appendleft((subject, stage_idx + 1))
+                else:
+                    status[subject_id][stage.name] = f"failed: {result['message']}"
+                    counts[(stage.name, "failed")] += 1
+                    print(f"[{stage.name}] {subject_id} FAILED: {result['message']}")
+
+    print("Pipeline summary:")
+    for stage in stages:
+        print(f"  {stage.name}: " + ", ".join(
+            f"{kind}={counts[(stage.name, kind)]}" for kind in ("done", "skipped", "failed")
+        ))
+    return status
+
+
+def compute_connectivity(subject: dict) -> None:
+    """
+    Connectivity stage: Fisher-z correlation matrix of a subject's parcel time series,
+    saved as a .npy file.
+    """
+    fisher_z = compute_fisher_z(load_dat_file(subject["parcels"]))
+    tmp_path = subject["connectivity"] + ".part.npy"
+    np.save(tmp_path, fisher_z.astype(np.float32))
+    os.replace(tmp_path, subject["connectivity"])
+
+
+def extract_ukb_archive(subject: dict) -> None:
+    """
+    Extraction stage: stream the cleaned rfMRI data out of a UKB bulk archive.
+    """
+    member = "fMRI/rfMRI.ica/filtered_func_data_clean.nii.gz"
+    status = extract_selected_members(subject["zip_path"], [member], subject["extract_dir"])
+    if status[member] == "missing":
+        raise FileNotFoundError(f"'{member}' not found in {subject['zip_path']}")
+
+
+def register_stage(ref: str = DEFAULT_REF, applyisoxfm: str = "2", max_parallel: int = None) -> Stage:
+    """
+    FLIRT registration of '{in_file}' to '{registered}' (`ref` is a registered template name or path).
+    """
+    return Stage(
+        name="register",
+        outputs=["{registered}"],
+        command=["flirt", "-in", "{in_file}", "-ref", resolve_template_path(ref), "-out", "{registered}",
+                 "-applyisoxfm", applyisoxfm],
+        max_parallel=max_parallel,
+        modules=["fsl"]
+    )
+
+
+def parcellate_stage(atlas: str = DEFAULT_ATLAS, n_parcels: int = 166) -> Stage:
+    """
+    Atlas parcellation of '{registered}' into '{parcels}' with segment_single_fMRI.py
+    (`atlas` is a registered atlas name or path).
+    """
+    return Stage(
+        name="parcellate",
+        outputs=["{parcels}"],
+        command=[sys.executable, SEGMENT_SCRIPT, "--fmri_file", "{registered}",
+                 "--atlas", atlas, "--n_parcels", str(n_parcels),
+                 "--out_dir", "{parcel_dir}"]
+    )
+
+
+def register_parcellate_stage(
+    ref: str = DEFAULT_REF,
+    atlas: str = DEFAULT_ATLAS,
+    n_parcels: int = 166,
+    iso_mm: str = "2"
+) -> Stage:
+    """
+    Fused registration + parcellation of '{in_file}' into '{parcels}' with
+    register_and_parcellate.py; the MNI-space volume is never written.
+    """
+    return Stage(
+        name="register_parcellate",
+        outputs=["{parcels}"],
+        command=[sys.executable, FUSED_SCRIPT, "--fmri_file", "{in_file}", "--ref", ref,
+                 "--atlas", atlas, "--n_parcels", str(n_parcels), "--iso_mm", iso_mm,
+                 "--out_file", "{parcels}"]
+    )
+
+
+def connectivity_stage() -> Stage:
+    return Stage(name="connectivity", outputs=["{connectivity}"], func=compute_connectivity, slurm_time="0:02:00")
+
+
+def build_abide_subjects(file_list: list[str], work_dir: str) -> list[dict]:
+    """
+    Subject dicts for ABIDE '*_func_preproc.nii.gz' files, using the folder
+    layout of the ABIDE SLURM scripts under `work_dir`.
+    """
+    subjects = []
+    for in_file in file_list:
+        subject_id = os.path.basename(in_file).replace("_func_preproc.nii.gz", "")
+        parcel_dir = os.path.join(work_dir, "ABIDE_parcelled")
+        subjects.append({
+            "subject_id": subject_id,
+            "in_file": in_file,
+            "registered": os.path.join(work_dir, "ABIDE_MNI_2mm", f"{subject_id}_MNI_2mm.nii.gz"),
+            "parcel_dir": parcel_dir,
+            "parcels": os.path.join(parcel_dir, f"{subject_id}_MNI_2mm.dat"),
+            "connectivity": os.path.join(work_dir, "ABIDE_connectivity", f"{subject_id}_fisher_z.npy"),
+        })
+    return subjects
+
+
+def build_ukb_subjects(zip_paths: list[str]) -> list[dict]:
+    """
+    Subject dicts for UKB 20227 bulk archives, using the rsfMRI_unzip layout of
+    the copy_files_* notebooks and mni.sh.
+    """
+    subjects = []
+    for zip_path in zip_paths:
+        subject_id = os.path.splitext(os.path.basename(zip_path))[0]
+        extract_dir = unzip_destination(zip_path)
+        ica_dir = os.path.join(extract_dir, "fMRI", "rfMRI.ica")
+        subjects.append({
+            "subject_id": subject_id,
+            "zip_path": zip_path,
+            "extract_dir": extract_dir,
+            "in_file": os.path.join(ica_dir, "filtered_func_data_clean.nii.gz"),
+            "registered": os.path.join(ica_dir, "filtered_func_data_clean_MNI.nii.gz"),
+            "parcel_dir": ica_dir,
+            "parcels": os.path.join(ica_dir, "filtered_func_data_clean_MNI.dat"),
+            "connectivity": os.path.join(ica_dir, "filtered_func_data_clean_MNI_fisher_z.npy"),
+        })
+    return subjects
+
+
+def build_stages(cohort: str, max_register: int = None, fused: bool = False) -> list[Stage]:
+    """
+    The default stage chain for 'abide' or 'ukb'. With `fused`, registration and
+    parcellation run as one in-process stage instead of flirt + segment_single_fMRI.py.
+    """
+    if fused:
+        stages = [register_parcellate_stage(), connectivity_stage()]
+    else:
+        stages = [register_stage(max_parallel=max_register), parcellate_stage(), connectivity_stage()]
+    if cohort == "ukb":
+        extract = Stage(name="extract", outputs=["{in_file}"], func=extract_ukb_archive, slurm_time="0:05:00")
+        stages.insert(0, extract)
+    return stages
+
+
+def write_slurm_array(stages: list[Stage], subjects: list[dict], out_dir: str, cohort: str) -> str:
+    """
+    Write a subject manifest and an sbatch array script where task i runs the
+    full chain for subject i (with the same skip-if-complete logic).
+
+    Returns:
+        str: Path of the sbatch script.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, "pipeline_manifest.jsonl")
+    with open(manifest_path, "w") as f:
+        for subject in subjects:
+            f.write(json.dumps(subject) + "\n")
+
+    total_minutes = 0
+    for stage in stages:
+        h, m, s = (int(x) for x in stage.slurm_time.split(":"))
+        total_minutes += h * 60 + m + (1 if s else 0)
+    modules = sorted({module for stage in stages for module in stage.modules})
+    max_mem = max((int(stage.slurm_mem.rstrip("gb")) for stage in stages), default=8)
+
+    script_path = os.path.join(out_dir, "run_pipeline_array.sh")
+    with open(script_path, "w") as f:
+        f.write("#!/bin/bash\n")
+        f.write("#SBATCH --job-name=fmri_pipeline\n")
+        f.write("#SBATCH --output=pipeline_%A_%a.out\n")
+        f.write("#SBATCH --error=pipeline_%A_%a.err\n")
+        f.write(f"#SBATCH --time={total_minutes // 60}:{total_minutes % 60:02d}:00\n")
+        f.write("#SBATCH --cpus-per-task=1\n")
+        f.write(f"#SBATCH --mem={max_mem}gb\n")
+        f.write(f"#SBATCH --array=0-{len(subjects) - 1}\n\n")
+        for module in modules:
+            f.write(f"module load {module}\n")
+        f.write("set -e\n\n")
+        fused_flag = " --fused" if any(stage.name == "register_parcellate" for stage in stages) else ""
+        f.write(f"python {os.path.abspath(__file__)} --cohort {cohort}{fused_flag} "
+                f"--manifest {manifest_path} --task_index ${{SLURM_ARRAY_TASK_ID}} --num_workers 1\n")
+
+    print(f"Wrote {script_path} for {len(subjects)} subjects. Submit with: sbatch {script_path}")
+    return script_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the extract/register/parcellate/connectivity chain over a local process pool."
+    )
+    parser.add_argument(
+        "--cohort", choices=["abide", "ukb"], default="abide",
+        help="Which default stage chain and folder layout to use."
+    )
+    parser.add_argument(
+        "--file_list", default=None,
+        help="Text file with one input per line (*_func_preproc.nii.gz for ABIDE, *.zip for UKB)."
+    )
+    parser.add_argument(
+        "--work_dir", default="/blue/ruogu.fang/ryoi360/projects/fmri_vlm/data",
+        help="Base data folder for ABIDE outputs."
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=None,
+        help="Number of concurrent jobs (default: all cores)."
+    )
+    parser.add_argument(
+        "--max_register", type=int, default=None,
+        help="Maximum number of concurrent registrations (default: no extra limit)."
+    )
+    parser.add_argument(
+        "--fused", action="store_true",
+        help="Register and parcellate in one in-process stage, without writing MNI-space volumes."
+    )
+    parser.add_argument(
+        "--force", action="store_true",
+        help="Re-run stages even if their outputs exist."
+    )
+    parser.add_argument(
+        "--slurm", default=None, metavar="OUT_DIR",
+        help="Instead of running locally, write a SLURM array script to OUT_DIR."
+    )
+    parser.add_argument(
+        "--manifest", default=None,
+        help="(SLURM backend) JSONL manifest of subject dicts."
+    )
+    parser.add_argument(
+        "--task_index", type=int, default=None,
+        help="(SLURM backend) Run only this line of --manifest."
+    )
+
+    args = parser.parse_args()
+    stages = build_stages(args.cohort, max_register=args.max_register, fused=args.fused)
+
+    if args.manifest is not None:
+        with open(args.manifest) as f:
+            subjects = [json.loads(line) for line in f if line.strip()]
+        if args.task_index is not None:
+            subjects = [subjects[args.task_index]]
+    else:
+        if args.file_list is None:
+            parser.error("--file_list is required unless --manifest is given.")
+        with open(args.file_list) as f:
+            inputs = [line.strip() for line in f if line.strip()]
+        if args.cohort == "abide":
+            subjects = build_abide_subjects(inputs, args.work_dir)
+        else:
+            subjects = build_ukb_subjects(inputs)
+
+    if args.slurm is not None:
+        write_slurm_array(stages, subjects, args.slurm, args.cohort)
+        return
+
+    status = run_pipeline(stages, subjects, num_workers=args.num_workers, force=args.force)
+    n_failed = sum(any(v.startswith("failed") for v in s.values()) for s in status.values())
+    if n_failed:
+        print(f"{n_failed} subjects had a failed stage.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
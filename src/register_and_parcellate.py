@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Fused "register-then-parcellate" stage for a single 4D fMRI volume.
+
+Today a subject goes *_func_preproc.nii.gz -> flirt -> *_MNI_2mm.nii.gz on disk
+-> segment_single_fMRI.py -> .dat, i.e. two full compressed 4D writes/reads,
+although the MNI-space volume is used by nothing else. This script goes from
+the native-space file to the .dat directly:
+  1) Every labelled voxel of the compiled atlas (labels 1..n_parcels, see
+     atlas_registry.py) is mapped back into the native voxel grid once, using
+     the same geometry as `flirt -applyisoxfm` (see resample.py). The atlas
+     grid fingerprint is checked against that output grid first.
+  2) The input is read in chunks of volumes, and only those atlas points are
+     sampled (trilinear, 0 outside the field of view, like flirt) with
+     scipy.ndimage.map_coordinates; unlabelled MNI voxels are never computed.
+  3) The samples are reduced to parcel means and saved as a .dat file.
+
+The resampled 4D volume is only written when --keep_intermediate is given.
+
+Usage (example):
+  python register_and_parcellate.py \
+    --fmri_file /path/to/Pitt_0050003_func_preproc.nii.gz \
+    --ref mni152_2mm \
+    --atlas aal3 \
+    --n_parcels 166 \
+    --out_dir /path/to/ABIDE_parcelled \
+    [--keep_intermediate /path/to/ABIDE_MNI_2mm]
+"""
+
+import os
+import argparse
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+from nifti_io import open_nifti, save_nifti
+from parcellation import (
+    DEFAULT_CHUNK_SIZE,
+    ParcelAccumulator,
+    iter_volume_chunks,
+    parcellate_chunks,
+    save_timeseries,
+)
+from resample import isotropic_reference_grid, output_to_input_matrix, resample_to_mni
+from atlas_registry import ATLASES, TEMPLATES, get_atlas, resolve_template_path
+
+
+class AtlasSampler:
+    """
+    Native-space sampling points of every labelled atlas voxel.
+
+    Args:
+        atlas (CompiledAtlas): Atlas on the output (MNI) grid (atlas_registry.get_atlas).
+        in_img: Native-space 4D image.
+        ref_img: Registration reference (defines the flirt output grid).
+        n_parcels (int, optional): Labels 1..n_parcels are used (default: the atlas's largest label).
+        iso_mm (float): Isotropic output voxel size, as flirt -applyisoxfm.
+        space (str): 'fsl' (flirt geometry) or 'world' (NIfTI affines).
+    """
+
+    def __init__(self, atlas, in_img, ref_img, n_parcels: int = None, iso_mm: float = 2.0, space: str = "fsl"):
+        out_shape, out_affine, out_vox2fsl = isotropic_reference_grid(ref_img, iso_mm)
+        atlas.check_grid(out_shape, out_affine, "the registration output grid")
+
+        self.n_parcels = atlas.n_parcels if n_parcels is None else n_parcels
+        voxel_index, self.point_labels = atlas.point_labels(self.n_parcels)
+        atlas_voxels = np.stack(np.unravel_index(voxel_index, out_shape))  # (3, n_points)
+
+        out_to_in = output_to_input_matrix(in_img, out_affine, out_vox2fsl, space)
+        self.coords = (out_to_in[:3, :3] @ atlas_voxels) + out_to_in[:3, 3:4]  # (3, n_points)
+
+    def sample_chunk(self, chunk: np.ndarray) -> np.ndarray:
+        """
+        Sample a (X, Y, Z, t) native-space chunk at the atlas points.
+
+        Returns:
+            np.ndarray: float32 array of shape (n_points, t).
+        """
+        samples = np.empty((self.coords.shape[1], chunk.shape[-1]), dtype=np.float32)
+        for t in range(chunk.shape[-1]):
+            ndimage.map_coordinates(
+                chunk[..., t], self.coords, output=samples[:, t],
+                order=1, mode="constant", cval=0.0, prefilter=False
+            )
+        return samples
+
+
+def register_and_parcellate(
+    fmri_path: str,
+    ref_path: str,
+    atlas,
+    n_parcels: int = None,
+    iso_mm: float = 2.0,
+    space: str = "fsl",
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> np.ndarray:
+    """
+    Parcel time series of a native-space fMRI file on an MNI atlas (a compiled
+    atlas, or a registered name / path for atlas_registry.get_atlas), without
+    materialising the resampled volume.
+
+    Returns:
+        np.ndarray: (timepoints, parcels) array, equal to parcellating the
+        output of resample.resample_to_mni.
+    """
+    if isinstance(atlas, str):
+        atlas = get_atlas(atlas)
+    with open_nifti(fmri_path) as in_img:
+        sampler = AtlasSampler(atlas, in_img, nib.load(ref_path), n_parcels, iso_mm, space)
+
+        accumulator = ParcelAccumulator(sampler.point_labels, sampler.n_parcels, in_img.shape[-1])
+        for t_start, chunk in iter_volume_chunks(in_img, chunk_size):
+            accumulator.add_chunk(t_start, sampler.sample_chunk(chunk))
+    return accumulator.result()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Register a native-space 4D fMRI volume to MNI and parcellate it in one pass."
+    )
+    parser.add_argument(
+        "--fmri_file", required=True,
+        help="Path to the native-space 4D fMRI .nii.gz file."
+    )
+    parser.add_argument(
+        "--ref", "--ref_path", dest="ref", default="mni152_2mm",
+        help=f"Registered template name ({', '.join(sorted(TEMPLATES))}) or path to the reference. (default=mni152_2mm)"
+    )
+    parser.add_argument(
+        "--atlas", "--atlas_path", dest="atlas", required=True,
+        help=f"Registered atlas name ({', '.join(sorted(ATLASES))}) or path to a NIfTI atlas on the output grid"
+    )
+    parser.add_argument(
+        "--n_parcels", type=int, default=None,
+        help="Parcels 1..n_parcels are extracted. (default=largest label in the atlas)"
+    )
+    parser.add_argument(
+        "--iso_mm", type=float, default=2.0,
+        help="Isotropic output voxel size in mm, as flirt -applyisoxfm. (default=2)"
+    )
+    parser.add_argument(
+        "--out_dir", default=None,
+        help="Optional output directory (default: same folder as --fmri_file)."
+    )
+    parser.add_argument(
+        "--out_file", default=None,
+        help="Optional exact output .dat path (overrides --out_dir naming)."
+    )
+    parser.add_argument(
+        "--keep_intermediate", default=None, metavar="MNI_DIR",
+        help="Also write the resampled <name>_MNI_<iso>mm.nii.gz into MNI_DIR (off by default)."
+    )
+
+    args = parser.parse_args()
+
+    ref_path = resolve_template_path(args.ref)
+    atlas = get_atlas(args.atlas)
+    if args.n_parcels is not None and args.n_parcels < atlas.n_parcels:
+        dropped = [int(label) for label in atlas.labels if label > args.n_parcels]
+        print(f"Note: --n_parcels {args.n_parcels} leaves out atlas labels {dropped}")
+
+    base_name = os.path.basename(args.fmri_file).replace("_func_preproc.nii.gz", "").replace(".nii.gz", "")
+    mni_name = f"{base_name}_MNI_{args.iso_mm:g}mm"
+
+    if args.keep_intermediate is None:
+        pmTS = register_and_parcellate(
+            args.fmri_file, ref_path, atlas, args.n_parcels, args.iso_mm
+        )
+    else:
+        # Opt-in: materialise the MNI volume once, save it, and parcellate it from memory
+        mni_img = resample_to_mni(args.fmri_file, ref_path, args.iso_mm)
+        os.makedirs(args.keep_intermediate, exist_ok=True)
+        mni_file = os.path.join(args.keep_intermediate, f"{mni_name}.nii.gz")
+        save_nifti(mni_img, mni_file)
+        print(f"Intermediate MNI volume saved to: {mni_file}")
+
+        atlas.check_image(mni_img, mni_file)
+        pmTS = parcellate_chunks([(0, np.asarray(mni_img.dataobj))], atlas, args.n_parcels, mni_img.shape[-1])
+
+    if args.out_file is not None:
+        out_file = args.out_file
+    else:
+        out_dir = args.out_dir if args.out_dir is not None else os.path.dirname(args.fmri_file)
+        out_file = os.path.join(out_dir, f"{mni_name}.dat")
+    os.makedirs(os.path.dirname(out_file) or ".", exist_ok=True)
+    save_timeseries(pmTS, out_file)
+    print(f"Parcel-based time series saved to: {out_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+In-process affine resampling of 4D fMRI data onto the MNI152 atlas grid.
+
+For inputs that only need `flirt -applyisoxfm <mm>` (no estimated transform),
+spawning FSL and writing a compressed `_MNI_2mm.nii.gz` that the segmenter
+immediately re-reads is unnecessary. This script:
+  1) Reproduces flirt's geometry: with no -init matrix, flirt applies the
+     identity transform in FSL "scaled voxel" coordinates (voxel index times
+     voxel size, with x flipped for images whose affine has a positive
+     determinant), onto the reference field of view at an isotropic voxel size.
+  2) Resamples time chunks of the input with scipy.ndimage.affine_transform
+     (trilinear, like flirt's default), in float32.
+  3) Feeds the resampled chunks straight into the parcellation accumulator,
+     so no intermediate 4D file is written unless asked for.
+
+Usage (example):
+  python resample.py \
+    --in_file /path/to/Pitt_0050003_func_preproc.nii.gz \
+    --ref mni152_2mm \
+    --atlas aal3 \
+    --n_parcels 166 \
+    --out_dir /path/to/ABIDE_parcelled \
+    [--compare_dat /path/to/flirt_path/Pitt_0050003_MNI_2mm.dat]
+"""
+
+import os
+import argparse
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+from nifti_io import open_nifti, save_nifti
+from parcellation import (
+    DEFAULT_CHUNK_SIZE,
+    check_grid,
+    parcellate_chunks,
+    save_timeseries,
+)
+from atlas_registry import ATLASES, TEMPLATES, get_atlas, resolve_template_path
+
+
+def fsl_scaled_voxel_matrix(img: nib.spatialimages.SpatialImage) -> np.ndarray:
+    """
+    4x4 matrix from voxel indices to FSL scaled-voxel (mm) coordinates.
+
+    FSL scales voxel indices by the voxel sizes and, when the image's affine has
+    a positive determinant (neurological voxel order), flips the x axis.
+    """
+    shape = img.shape
+    zooms = np.array(img.header.get_zooms()[:3], dtype=np.float64)
+    matrix = np.diag(np.append(zooms, 1.0))
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = shape[0] - 1
+        matrix = matrix @ flip
+    return matrix
+
+
+def isotropic_reference_grid(ref_img: nib.spatialimages.SpatialImage, iso_mm: float) -> tuple:
+    """
+    Output grid of `flirt -applyisoxfm iso_mm`: the reference field of view
+    resampled to isotropic `iso_mm` voxels.
+
+    Returns:
+        (shape, affine, vox2fsl): 3D output shape, its world affine, and its
+        voxel -> FSL scaled-voxel matrix.
+    """
+    ref_zooms = np.array(ref_img.header.get_zooms()[:3], dtype=np.float64)
+    ref_shape = np.array(ref_img.shape[:3])
+    out_shape = tuple(int(n) for n in np.maximum(1, np.round(ref_shape * ref_zooms / iso_mm)))
+
+    out_vox2fsl = np.diag([iso_mm, iso_mm, iso_mm, 1.0])
+    ref_is_neurological = np.linalg.det(ref_img.affine[:3, :3]) > 0
+    if ref_is_neurological:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = out_shape[0] - 1
+        out_vox2fsl = out_vox2fsl @ flip
+
+    # World affine consistent with the reference: world = ref_vox2world @ ref_fsl2vox @ out_vox2fsl
+    ref_fsl2vox = np.linalg.inv(fsl_scaled_voxel_matrix(ref_img))
+    out_affine = ref_img.affine @ ref_fsl2vox @ out_vox2fsl
+    return out_shape, out_affine, out_vox2fsl
+
+
+def output_to_input_matrix(
+    in_img: nib.spatialimages.SpatialImage,
+    out_affine: np.ndarray,
+    out_vox2fsl: np.ndarray,
+    space: str = "fsl"
+) -> np.ndarray:
+    """
+    4x4 matrix mapping output voxel indices to input voxel indices.
+
+    Args:
+        in_img: Input image.
+        out_affine (np.ndarray): World affine of the output grid.
+        out_vox2fsl (np.ndarray): FSL scaled-voxel matrix of the output grid.
+        space (str): 'fsl' reproduces flirt -applyisoxfm (identity in FSL
+            coordinates); 'world' aligns the images by their NIfTI affines instead.
+    """
+    if space == "fsl":
+        return np.linalg.inv(fsl_scaled_voxel_matrix(in_img)) @ out_vox2fsl
+    if space == "world":
+        return np.linalg.inv(in_img.affine) @ out_affine
+    raise ValueError(f"Unknown space '{space}', expected 'fsl' or 'world'.")
+
+
+def iter_resampled_chunks(
+    in_img: nib.spatialimages.SpatialImage,
+    out_shape: tuple,
+    out_to_in: np.ndarray,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    order: int = 1
+):
+    """
+    Yield (t_start, float32 array of shape out_shape + (t,)) resampled chunks.
+
+    Only `chunk_size` input volumes are read and held in memory at a time.
+    Voxels that map outside the input are set to 0, as flirt does.
+    """
+    n_timepoints = in_img.shape[3] if len(in_img.shape) > 3 else 1
+    matrix, offset = out_to_in[:3, :3], out_to_in[:3, 3]
+
+    for t_start in range(0, n_timepoints, chunk_size):
+        t_stop = min(t_start + chunk_size, n_timepoints)
+        if len(in_img.shape) > 3:
+            chunk = np.asarray(in_img.dataobj[..., t_start:t_stop], dtype=np.float32)
+        else:
+            chunk = np.asarray(in_img.dataobj, dtype=np.float32)[..., None]
+
+        out_chunk = np.empty(out_shape + (t_stop - t_start,), dtype=np.float32)
+        for t in range(t_stop - t_start):
+            ndimage.affine_transform(
+                chunk[..., t], matrix, offset=offset,
+                output_shape=out_shape, output=out_chunk[..., t],
+                order=order, mode="constant", cval=0.0, prefilter=False
+            )
+        yield t_start, out_chunk
+
+
+def resample_to_reference(
+    in_img: nib.spatialimages.SpatialImage,
+    ref_img: nib.spatialimages.SpatialImage,
+    iso_mm: float = 2.0,
+    space: str = "fsl",
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> tuple:
+    """
+    Set up resampling of `in_img` onto `ref_img` at `iso_mm`.
+
+    Returns:
+        (chunks, out_shape, out_affine): a generator of resampled chunks
+        (see iter_resampled_chunks), the 3D output shape and its affine.
+    """
+    out_shape, out_affine, out_vox2fsl = isotropic_reference_grid(ref_img, iso_mm)
+    out_to_in = output_to_input_matrix(in_img, out_affine, out_vox2fsl, space)
+    chunks = iter_resampled_chunks(in_img, out_shape, out_to_in, chunk_size)
+    return chunks, out_shape, out_affine
+
+
+def resample_to_mni(
+    in_path: str,
+    ref_path: str,
+    iso_mm: float = 2.0,
+    space: str = "fsl",
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> nib.Nifti1Image:
+    """
+    In-memory equivalent of `flirt -in in_path -ref ref_path -applyisoxfm iso_mm`.
+
+    Returns:
+        nib.Nifti1Image: float32 4D image on the output grid.
+    """
+    ref_img = nib.load(ref_path)
+    with open_nifti(in_path) as in_img:
+        chunks, out_shape, out_affine = resample_to_reference(in_img, ref_img, iso_mm, space, chunk_size)
+
+        n_timepoints = in_img.shape[3] if len(in_img.shape) > 3 else 1
+        data = np.empty(out_shape + (n_timepoints,), dtype=np.float32)
+        for t_start, chunk in chunks:
+            data[..., t_start:t_start + chunk.shape[-1]] = chunk
+
+    out_img = nib.Nifti1Image(data, out_affine)
+    out_img.header.set_xyzt_units(*in_img.header.get_xyzt_units())
+    if len(in_img.shape) > 3:
+        out_img.header["pixdim"][4] = in_img.header["pixdim"][4]
+    return out_img
+
+
+def resample_and_parcellate(
+    in_path: str,
+    ref_path: str,
+    label_data,
+    n_parcels: int = None,
+    iso_mm: float = 2.0,
+    space: str = "fsl",
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> np.ndarray:
+    """
+    Resample `in_path` onto the atlas grid chunk by chunk and return the
+    (timepoints, parcels) time series, without writing the resampled volume.
+    `label_data` is a compiled atlas (atlas_registry.py; its grid fingerprint is
+    checked against the output grid and n_parcels defaults to its largest label)
+    or a flattened label array.
+    """
+    ref_img = nib.load(ref_path)
+    with open_nifti(in_path) as in_img:
+        chunks, out_shape, out_affine = resample_to_reference(in_img, ref_img, iso_mm, space, chunk_size)
+        if isinstance(label_data, np.ndarray):
+            check_grid(out_shape, label_data, f"the resampled {os.path.basename(in_path)}")
+        else:
+            label_data.check_grid(out_shape, out_affine, f"the resampled {os.path.basename(in_path)}")
+
+        n_timepoints = in_img.shape[3] if len(in_img.shape) > 3 else 1
+        return parcellate_chunks(chunks, label_data, n_parcels, n_timepoints)
+
+
+def compare_timeseries(pmTS: np.ndarray, reference_pmTS: np.ndarray) -> dict:
+    """
+    Agreement between two (timepoints, parcels) arrays, e.g. in-process vs FLIRT path.
+
+    Returns:
+        dict: max absolute difference, max difference relative to the reference's
+        dynamic range, and the minimum per-parcel Pearson correlation.
+    """
+    if pmTS.shape != reference_pmTS.shape:
+        raise ValueError(f"Shape mismatch: {pmTS.shape} vs {reference_pmTS.shape}")
+    diff = np.abs(pmTS - reference_pmTS)
+    value_range = np.ptp(reference_pmTS) or 1.0
+
+    a = pmTS - pmTS.mean(axis=0)
+    b = reference_pmTS - reference_pmTS.mean(axis=0)
+    denom = np.sqrt((a ** 2).sum(axis=0) * (b ** 2).sum(axis=0))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = (a * b).sum(axis=0) / denom
+    corr = corr[denom > 0]
+
+    return {
+        "max_abs_diff": float(diff.max()),
+        "max_rel_diff": float(diff.max() / value_range),
+        "min_parcel_corr": float(corr.min()) if corr.size else float("nan"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Resample a 4D fMRI volume onto the MNI atlas grid in-process and parcellate it."
+    )
+    parser.add_argument(
+        "--in_file", required=True,
+        help="Path to the native-space 4D fMRI .nii.gz file."
+    )
+    parser.add_argument(
+        "--ref", "--ref_path", dest="ref", default="mni152_2mm",
+        help=f"Registered template name ({', '.join(sorted(TEMPLATES))}) or path to the reference. (default=mni152_2mm)"
+    )
+    parser.add_argument(
+        "--iso_mm", type=float, default=2.0,
+        help="Isotropic output voxel size in mm, as flirt -applyisoxfm. (default=2)"
+    )
+    parser.add_argument(
+        "--space", choices=["fsl", "world"], default="fsl",
+        help="'fsl' matches flirt -applyisoxfm; 'world' aligns by NIfTI affines."
+    )
+    parser.add_argument(
+        "--atlas", "--atlas_path", dest="atlas", default=None,
+        help=f"Registered atlas name ({', '.join(sorted(ATLASES))}) or path to an atlas on the output grid. "
+             "If given, write parcel time series (.dat)."
+    )
+    parser.add_argument(
+        "--n_parcels", type=int, default=None,
+        help="Parcels 1..n_parcels are extracted. (default=largest label in the atlas)"
+    )
+    parser.add_argument(
+        "--out_dir", default=None,
+        help="Output directory (default: same folder as --in_file)."
+    )
+    parser.add_argument(
+        "--out_file", default=None,
+        help="Optional path to also write the resampled 4D volume (for checking against flirt)."
+    )
+    parser.add_argument(
+        "--compare_dat", default=None,
+        help="Optional .dat from the FLIRT path to compare the parcel time series with."
+    )
+
+    args = parser.parse_args()
+    ref_path = resolve_template_path(args.ref)
+
+    if args.out_file is not None:
+        out_img = resample_to_mni(args.in_file, ref_path, args.iso_mm, args.space)
+        save_nifti(out_img, args.out_file)
+        print(f"Resampled volume saved to: {args.out_file}")
+
+    if args.atlas is None:
+        return
+
+    atlas = get_atlas(args.atlas)
+    if args.n_parcels is not None and args.n_parcels < atlas.n_parcels:
+        dropped = [int(label) for label in atlas.labels if label > args.n_parcels]
+        print(f"Note: --n_parcels {args.n_parcels} leaves out atlas labels {dropped}")
+    pmTS = resample_and_parcellate(
+        args.in_file, ref_path, atlas, args.n_parcels, args.iso_mm, args.space
+    )
+
+    out_dir = args.out_dir if args.out_dir is not None else os.path.dirname(args.in_file)
+    os.makedirs(out_dir, exist_ok=True)
+    base_name = os.path.basename(args.in_file).replace("_func_preproc.nii.gz", "").replace(".nii.gz", "")
+    out_file = os.path.join(out_dir, f"{base_name}_MNI_{args.iso_mm:g}mm.dat")
+    save_timeseries(pmTS, out_file)
+    print(f"Parcel-based time series saved to: {out_file}")
+
+    if args.compare_dat is not None:
+        reference = np.loadtxt(args.compare_dat, delimiter='\t')
+        print(f"Agreement with {args.compare_dat}: {compare_timeseries(pmTS, reference)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Per-scan QC metrics computed while a 4D volume is parcellated.
+
+QCAccumulator receives the same (labelled voxels x volumes) blocks that
+parcellation.ParcelAccumulator reduces, so tSNR, DVARS, the global signal,
+per-parcel voxel coverage and NaN fraction cost no extra read of the volume.
+Only running per-voxel sums are kept, plus the last volume of the previous
+chunk for DVARS.
+
+Metrics (over the atlas's labelled voxels):
+  - tSNR: temporal mean / temporal std per voxel; median and mean over covered voxels.
+  - DVARS: RMS over voxels of the volume-to-volume difference; also as a
+    percentage of the mean global signal.
+  - Global signal: mean over voxels per volume.
+  - Coverage: fraction of each parcel's voxels with finite, non-constant data
+    at every volume; parcels with no covered voxel are empty in the data.
+  - NaN fraction per parcel.
+
+Summaries of many scans go into a cohort QC table (JSON lines, one row per
+scan, appended by each job; load_qc_table() keeps the last row per subject).
+
+Usage (example, print the QC table of a cohort):
+  python scan_qc.py --qc_table /blue/ruogu.fang/ryoi360/projects/fmri_vlm/data/ABIDE_parcelled/qc.jsonl
+"""
+
+import os
+import json
+import argparse
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+
+@dataclass
+class ScanQC:
+    """
+    QC of one scan: scalar `summary` plus per-parcel and per-volume arrays
+    (parcel arrays have one entry per parcel 1..n_parcels).
+    """
+    summary: dict
+    parcel_coverage: np.ndarray
+    parcel_nan_fraction: np.ndarray
+    parcel_tsnr: np.ndarray
+    global_signal: np.ndarray
+    dvars: np.ndarray = field(repr=False)
+
+    def save(self, npz_path: str) -> None:
+        np.savez_compressed(
+            npz_path,
+            parcel_coverage=self.parcel_coverage,
+            parcel_nan_fraction=self.parcel_nan_fraction,
+            parcel_tsnr=self.parcel_tsnr,
+            global_signal=self.global_signal,
+            dvars=self.dvars,
+            summary=json.dumps(self.summary),
+        )
+
+
+class QCAccumulator:
+    """
+    Running per-voxel statistics of label-sorted voxel blocks.
+
+    Args:
+        starts (np.ndarray): Offset of each present parcel's voxels in the block rows.
+        present (np.ndarray): 0-based parcel column of each entry of `starts`.
+        voxel_counts (np.ndarray): Atlas voxels per parcel 1..n_parcels.
+        n_timepoints (int): Total number of volumes that will be added.
+    """
+
+    def __init__(self, starts: np.ndarray, present: np.ndarray, voxel_counts: np.ndarray, n_timepoints: int):
+        self.starts = np.asarray(starts)
+        self.present = np.asarray(present)
+        self.voxel_counts = np.asarray(voxel_counts)
+        self.n_parcels = len(self.voxel_counts)
+        self.n_timepoints = n_timepoints
+        n_voxels = int(self.voxel_counts.sum())
+
+        self.sum = np.zeros(n_voxels)
+        self.sumsq = np.zeros(n_voxels)
+        self.n_finite = np.zeros(n_voxels, dtype=np.int64)
+        self.global_signal = np.full(n_timepoints, np.nan)
+        self.dvars = np.full(n_timepoints, np.nan)
+        self.prev = None
+
+    def add_values(self, t_start: int, values: np.ndarray) -> None:
+        """
+        Add volumes t_start .. t_start + values.shape[1] - 1 of the labelled
+        voxels (rows in label order, NaNs allowed). Chunks must arrive in order.
+        """
+        n_t = values.shape[1]
+        if n_t == 0:
+            return
+        finite = np.isfinite(values)
+        filled = np.where(finite, values, 0.0)
+        self.sum += filled.sum(axis=1)
+        self.sumsq += np.square(filled).sum(axis=1)
+        self.n_finite += finite.sum(axis=1)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.global_signal[t_start:t_start + n_t] = filled.sum(axis=0) / finite.sum(axis=0)
+
+            if self.prev is None:
+                diffs, first = np.diff(values, axis=1), t_start + 1
+            else:
+                diffs, first = np.diff(np.column_stack([self.prev, values]), axis=1), t_start
+            if diffs.shape[1]:
+                valid = np.isfinite(diffs)
+                sq = np.where(valid, np.square(diffs), 0.0)
+                self.dvars[first:t_start + n_t] = np.sqrt(sq.sum(axis=0) / valid.sum(axis=0))
+        self.prev = values[:, -1].copy()
+
+    def _per_parcel(self, voxel_values: np.ndarray) -> np.ndarray:
+        out = np.zeros(self.n_parcels)
+        if len(self.present):
+            out[self.present] = np.add.reduceat(voxel_values, self.starts)
+        return out
+
+    def result(self) -> ScanQC:
+        n_t = self.n_timepoints
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.sum / self.n_finite
+            var = np.clip(self.sumsq / self.n_finite - np.square(mean), 0.0, None)
+            std = np.sqrt(var * self.n_finite / np.maximum(self.n_finite - 1, 1))
+            covered = (self.n_finite == n_t) & (std > 0)
+            tsnr = np.where(covered, mean / np.where(std > 0, std, 1.0), 0.0)
+
+            n_covered = self._per_parcel(covered.astype(np.float64))
+            parcel_coverage = np.where(self.voxel_counts > 0, n_covered / self.voxel_counts, 0.0)
+            n_missing = self._per_parcel((n_t - self.n_finite).astype(np.float64))
+            parcel_nan_fraction = np.where(self.voxel_counts > 0, n_missing / (self.voxel_counts * n_t), 0.0)
+            parcel_tsnr = np.where(n_covered > 0, self._per_parcel(tsnr) / n_covered, 0.0)
+            dvars_pct = 100.0 * self.dvars / np.nanmean(self.global_signal)
+
+        in_atlas = self.voxel_counts > 0
+        covered_tsnr = tsnr[covered]
+        summary = {
+            "n_timepoints": int(n_t),
+            "n_parcels": int(self.n_parcels),
+            "tsnr_median": float(np.median(covered_tsnr)) if covered_tsnr.size else 0.0,
+            "tsnr_mean": float(covered_tsnr.mean()) if covered_tsnr.size else 0.0,
+            "dvars_mean": _nan_stat(np.nanmean, self.dvars),
+            "dvars_max": _nan_stat(np.nanmax, self.dvars),
+            "dvars_pct_mean": _nan_stat(np.nanmean, dvars_pct),
+            "global_signal_mean": _nan_stat(np.nanmean, self.global_signal),
+            "global_signal_std": _nan_stat(np.nanstd, self.global_signal),
+            "voxel_coverage": float(covered.mean()) if covered.size else 0.0,
+            "nan_fraction": float(1.0 - self.n_finite.sum() / max(self.n_finite.size * n_t, 1)),
+            "coverage_min": float(parcel_coverage[in_atlas].min()) if in_atlas.any() else 0.0,
+            "n_empty_in_atlas": int((~in_atlas).sum()),
+            "n_empty_in_data": int((in_atlas & (n_covered == 0)).sum()),
+            "empty_parcels": [int(p) + 1 for p in np.flatnonzero(in_atlas & (n_covered == 0))],
+        }
+        return ScanQC(summary, parcel_coverage, parcel_nan_fraction, parcel_tsnr, self.global_signal, self.dvars)
+
+
+def _nan_stat(func, values: np.ndarray) -> float:
+    if not np.isfinite(values).any():
+        return float("nan")
+    return float(func(values))
+
+
+def append_qc_row(table_path: str, subject: str, qc: ScanQC, **extra) -> dict:
+    """
+    Append one scan's summary to a cohort QC table (JSON lines). The row is
+    written with a single write, so parallel jobs can share the table.
+    """
+    row = {"subject": subject, **extra, **qc.summary}
+    os.makedirs(os.path.dirname(table_path) or ".", exist_ok=True)
+    line = json.dumps(row, default=str) + "\n"
+    fd = os.open(table_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+    return row
+
+
+def load_qc_table(table_path: str) -> pd.DataFrame:
+    """
+    The cohort QC table, one row per subject (last entry wins; torn lines are skipped).
+    """
+    rows = {}
+    with open(table_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            rows[row["subject"]] = row
+    return pd.DataFrame(list(rows.values()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a cohort QC table.")
+    parser.add_argument("--qc_table", required=True, help="QC table (JSON lines) written by segment_single_fMRI.py.")
+    parser.add_argument("--out", default=None, help="Optional .csv/.parquet copy of the table.")
+    parser.add_argument("--min_tsnr", type=float, default=None, help="Flag scans with median tSNR below this.")
+    parser.add_argument("--max_dvars_pct", type=float, default=None, help="Flag scans with mean DVARS (%% of global signal) above this.")
+
+    args = parser.parse_args()
+
+    table = load_qc_table(args.qc_table)
+    print(f"{len(table)} scans in {args.qc_table}")
+    columns = ["tsnr_median", "dvars_pct_mean", "global_signal_std", "voxel_coverage", "nan_fraction", "n_empty_in_data"]
+    print(table[[c for c in columns if c in table.columns]].describe())
+
+    flagged = pd.Series(False, index=table.index)
+    if args.min_tsnr is not None:
+        flagged |= table["tsnr_median"] < args.min_tsnr
+    if args.max_dvars_pct is not None:
+        flagged |= table["dvars_pct_mean"] > args.max_dvars_pct
+    if args.min_tsnr is not None or args.max_dvars_pct is not None:
+        print(f"{int(flagged.sum())} scans flagged:")
+        print("\n".join(table.loc[flagged, "subject"].astype(str)))
+
+    if args.out is not None:
+        if args.out.endswith(".parquet"):
+            table.drop(columns=["empty_parcels"], errors="ignore").to_parquet(args.out, index=False)
+        else:
+            table.to_csv(args.out, index=False)
+        print(f"Table written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,21 @@ Refactor Example: Convert a set of subject data folders into a minimal BIDS stru
 This script iterates over folders in 'input_dir'. For each subject:
   1) Determines the subject ID from the folder name.
   2) Creates BIDS-like directories (anat, func) under 'output_dir/<subject_id>'.
-  3) Copies the subject's T1-weighted image and resting-state fMRI data into the correct BIDS paths.
-  4) Copies a corresponding JSON sidecar (if present).
+  3) Places the subject's T1-weighted image and resting-state fMRI data at the correct BIDS paths.
+  4) Places a corresponding JSON sidecar (if present), byte-for-byte.
+
+Files are hardlinked (or reflinked) where the filesystem allows and copied
+otherwise; re-runs skip files that are already in place (bids_materialize.py).
 
 Author: [Your Name]
 Date: [Optional: YYYY-MM-DD]
 """
 
 import os
-import shutil
-import json
 from ipdb import set_trace
 
+from bids_materialize import plan_subject, build_plan, validate_plan, materialize
+
 # Input: Directory with subject subfolders (each containing <subject_id>_T1w.nii.gz, etc.)
 INPUT_DIR = "/orange/ruogu.fang/zeyun.zhao/DATA/UKB_sub/my_dataset"
 # Output: Base directory where BIDS structure will be created
@@ -43,8 +46,9 @@ def convert_to_bids(subject_dir, subject_id):
     """
     Convert a single subject's data into a BIDS-like structure.
 
-    Copies T1-weighted and resting BOLD data (plus optional JSON metadata) from the subject directory
-    to the newly created BIDS directories under OUTPUT_DIR.
+    Places T1-weighted and resting BOLD data (plus optional JSON metadata) from the subject directory
+    in the newly created BIDS directories under OUTPUT_DIR, as hardlinks/reflinks where the
+    filesystem allows and as copies otherwise (see bids_materialize.py).
 
     Args:
         subject_dir (str): Path to the subject's original data folder.
@@ -56,41 +60,30 @@ def convert_to_bids(subject_dir, subject_id):
     # Debug if needed
     # set_trace()
 
-    # Copy T1-weighted data
-    t1_src = os.path.join(subject_dir, f"{subject_id}_T1w.nii.gz")
-    t1_dest = os.path.join(OUTPUT_DIR, subject_id, "anat", f"{subject_id}_T1w.nii.gz")
-    shutil.copy(t1_src, t1_dest)
-
-    # Copy resting BOLD data
-    bold_src = os.path.join(subject_dir, f"{subject_id}_rest_bold.nii.gz")
-    bold_dest = os.path.join(OUTPUT_DIR, subject_id, "func", f"{subject_id}_rest_bold.nii.gz")
-    shutil.copy(bold_src, bold_dest)
-
-    # Copy JSON sidecar if it exists
-    info_file = os.path.join(subject_dir, f"{subject_id}_rest_bold.json")
-    if os.path.exists(info_file):
-        with open(info_file, "r") as f:
-            info = json.load(f)
-
-        json_output_path = os.path.join(OUTPUT_DIR, subject_id, "func", f"{subject_id}_rest_bold.json")
-        with open(json_output_path, "w") as f:
-            json.dump(info, f, indent=4)
+    entries = plan_subject(subject_dir, subject_id, OUTPUT_DIR)
+    problems = validate_plan(entries)
+    if problems:
+        raise FileNotFoundError("; ".join(problems))
+    return materialize(entries)
 
 
 def main():
     """
-    Main loop: traverse 'INPUT_DIR', identify subject folders, and convert each to BIDS format.
+    Main loop: plan every subject folder in 'INPUT_DIR', validate the plan, then materialize it.
 
     The subject ID is extracted from the folder name by splitting on underscores
     and taking the last element. For example, a directory named 'sub_01'
     yields a subject_id of '01'.
     """
-    for subject in os.listdir(INPUT_DIR):
-        subject_dir = os.path.join(INPUT_DIR, subject)
-        if os.path.isdir(subject_dir):
-            # Example extraction of subject ID from folder name
-            subject_id = subject.split("_")[-1]
-            convert_to_bids(subject_dir, subject_id)
+    entries = build_plan(INPUT_DIR, OUTPUT_DIR)
+    problems = validate_plan(entries)
+    if problems:
+        for problem in problems:
+            print(problem)
+        raise SystemExit(f"{len(problems)} problems in the plan; nothing was written.")
+
+    counts = materialize(entries)
+    print(", ".join(f"{outcome}: {n}" for outcome, n in sorted(counts.items())))
 
 
 if __name__ == "__main__":
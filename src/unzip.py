@@ -2,54 +2,213 @@ import os
 import zipfile
 import shutil
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
-def extract_filtered_func_data(zip_file_path, file_to_extract, output_path):
+# Members of a UKB 20227 (rfMRI) bulk archive that downstream steps use
+UKB_RFMRI_MEMBERS = [
+    "fMRI/rfMRI.ica/filtered_func_data_clean.nii.gz",
+    "fMRI/rfMRI.ica/mask.nii.gz",
+    "fMRI/rfMRI.ica/mean_func.nii.gz",
+    "fMRI/rfMRI.ica/reg/example_func2standard.mat",
+]
+
+# Default flat output folder for extract_filtered_func_data
+FILTERED_FUNC_DIR = "/orange/ruogu.fang/zeyun.zhao/DATA/UKB_sub/rsfMRI_processed_nii/filtered_func_data_clean"
+
+# Read/write block size when streaming a member out of an archive
+STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def stream_member_to_path(zip_ref, member_info, target_path, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Stream one ZIP member directly to its final path.
+
+    The member is decompressed through ZipFile.open into '<target_path>.part'
+    in the target folder, then atomically renamed, so the data is written to
+    disk exactly once and a crash never leaves a truncated file at 'target_path'.
+    If 'target_path' already exists with the member's uncompressed size, it is
+    left untouched.
+
+    Args:
+        zip_ref (zipfile.ZipFile): An open ZIP archive.
+        member_info (zipfile.ZipInfo): The member to extract.
+        target_path (str): Final path of the extracted file.
+        chunk_size (int, optional): Copy block size in bytes (default 4 MiB).
+
+    Returns:
+        str: 'skipped' if an up-to-date copy was already present, otherwise 'extracted'.
+    """
+    if os.path.isfile(target_path) and os.path.getsize(target_path) == member_info.file_size:
+        return "skipped"
+
+    os.makedirs(os.path.dirname(target_path) or ".", exist_ok=True)
+    partial_path = f"{target_path}.part"
+    try:
+        with zip_ref.open(member_info, "r") as src, open(partial_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, chunk_size)
+        os.replace(partial_path, target_path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    return "extracted"
+
+
+def unzip_destination(zip_file_path):
+    """
+    Return the folder a UKB archive is unpacked into.
+
+    Mirrors the layout used by the copy_files_* notebooks: an archive in a
+    folder whose name contains 'zip' (e.g. 'rsfMRI_zip/1000023_20227_2_0.zip')
+    goes to the sibling 'unzip' folder ('rsfMRI_unzip/1000023_20227_2_0/');
+    otherwise it is unpacked next to the archive.
+
+    Args:
+        zip_file_path (str): Path to the ZIP archive.
+
+    Returns:
+        str: Extraction folder for this archive.
+    """
+    dirpath, filename = os.path.split(zip_file_path)
+    extraction_folder_name = os.path.splitext(filename)[0]
+    parent_folder = os.path.basename(dirpath)
+    if 'zip' in parent_folder.lower():
+        new_parent_folder = parent_folder.lower().replace('zip', 'unzip')
+        return os.path.join(os.path.dirname(dirpath), new_parent_folder, extraction_folder_name)
+    return os.path.join(dirpath, extraction_folder_name)
+
+
+def extract_selected_members(zip_file_path, members, output_dir=None, flat=False):
+    """
+    Stream the selected members of one archive to their final paths.
+
+    Args:
+        zip_file_path (str): Path to the ZIP archive.
+        members (List[str]): Member names to extract; names missing from the archive are reported.
+        output_dir (str, optional): Base output folder. Defaults to unzip_destination(zip_file_path)
+            for the tree layout; required for the flat layout.
+        flat (bool, optional): If True, write '<output_dir>/<zip stem>_<member basename>'
+            instead of '<output_dir>/<member path>'.
+
+    Returns:
+        dict: Member name -> 'extracted', 'skipped' or 'missing'.
+    """
+    zip_stem = os.path.splitext(os.path.basename(zip_file_path))[0]
+    if output_dir is None:
+        if flat:
+            raise ValueError("output_dir is required for the flat layout.")
+        output_dir = unzip_destination(zip_file_path)
+
+    status = {}
+    with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+        for member in members:
+            try:
+                member_info = zip_ref.getinfo(member)
+            except KeyError:
+                status[member] = "missing"
+                continue
+
+            if flat:
+                target_path = os.path.join(output_dir, f"{zip_stem}_{os.path.basename(member)}")
+            else:
+                target_path = os.path.join(output_dir, *member.split("/"))
+            status[member] = stream_member_to_path(zip_ref, member_info, target_path)
+    return status
+
+
+def find_zip_files(root_dir):
+    """
+    Recursively list all .zip files under 'root_dir', sorted.
+    """
+    zip_paths = []
+    for dirpath, _, filenames in os.walk(root_dir):
+        for filename in filenames:
+            if filename.lower().endswith('.zip'):
+                zip_paths.append(os.path.join(dirpath, filename))
+    return sorted(zip_paths)
+
+
+def extract_archives_parallel(zip_paths, members=None, output_dir=None, flat=False, num_workers=None):
     """
-    Extract a specific file from a ZIP archive, rename it, and remove the intermediate folder.
+    Extract the selected members from many archives across a process pool.
 
-    This function opens the ZIP file at 'zip_file_path' and checks if 'file_to_extract' exists within it.
-    If found, it extracts the file into 'output_path'. Afterwards, it renames the extracted file
-    to a new location (based on the output folder name) and removes the temporary extraction folder.
+    Each worker opens one archive at a time and streams its members straight to
+    their final paths (see stream_member_to_path), skipping members that are
+    already present with the right size. Failures in one archive are reported
+    and do not stop the others.
+
+    Args:
+        zip_paths (List[str]): Archives to process.
+        members (List[str], optional): Member names to extract (default UKB_RFMRI_MEMBERS).
+        output_dir (str, optional): See extract_selected_members.
+        flat (bool, optional): See extract_selected_members.
+        num_workers (int, optional): Number of worker processes (default os.cpu_count()).
+
+    Returns:
+        dict: Archive path -> member status dict, or the error message if the archive failed.
+    """
+    if members is None:
+        members = UKB_RFMRI_MEMBERS
+
+    results = {}
+    counts = {"extracted": 0, "skipped": 0, "missing": 0, "failed": 0}
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(extract_selected_members, path, members, output_dir, flat): path
+            for path in zip_paths
+        }
+        for index, future in enumerate(as_completed(futures), start=1):
+            path = futures[future]
+            try:
+                results[path] = future.result()
+                for member_status in results[path].values():
+                    counts[member_status] += 1
+            except Exception as exc:
+                results[path] = f"error: {exc}"
+                counts["failed"] += 1
+                print(f"Failed to extract '{path}': {exc}")
+            if index % 100 == 0 or index == len(futures):
+                print(f"Progress: {index}/{len(futures)} archives")
+
+    print(f"Extraction summary: {counts}")
+    return results
+
+
+def extract_filtered_func_data(zip_file_path, file_to_extract, output_path, target_dir=FILTERED_FUNC_DIR):
+    """
+    Extract a specific file from a ZIP archive straight to its final, subject-named path.
+
+    The member is streamed via ZipFile.open to
+    '<target_dir>/<subject_id>_filtered_func_data_clean.nii.gz', where the subject ID
+    is the basename of 'output_path' (e.g. "1000023_20227_2_0"). No intermediate
+    folder is created, and an existing output of the right size is not rewritten.
 
     Note:
         - The function assumes a particular file structure:
               fMRI/rfMRI.ica/filtered_func_data_clean.nii.gz
-        - Once extracted, the file is moved to:
-              /orange/ruogu.fang/zeyun.zhao/DATA/UKB_sub/rsfMRI_processed_nii/filtered_func_data_clean/
-          plus a suffix of the subject ID extracted from 'output_path'.
-        - Then 'output_path' (the temporary folder) is deleted.
 
     Args:
         zip_file_path (str): The file path to the ZIP archive.
         file_to_extract (str): The path (inside the ZIP) to the file to be extracted.
-        output_path (str): The directory path where the file will initially be extracted.
+        output_path (str): Per-subject path whose basename is the subject ID.
+        target_dir (str, optional): Folder for the extracted file (default FILTERED_FUNC_DIR).
 
     Returns:
         int: Always returns 0 upon completion.
     """
     with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
         # Check if the specified file exists within the ZIP
-        if file_to_extract in zip_ref.namelist():
-            zip_ref.extract(file_to_extract, output_path)
-            print(f"Extracted '{file_to_extract}' into: {output_path}")
-
-            # Construct source and target file paths
-            source_file_path = os.path.join(output_path, "fMRI", "rfMRI.ica", "filtered_func_data_clean.nii.gz")
-            subject_id = os.path.basename(output_path)  # e.g., "1000023_20227_2_0"
-            target_file_path = (
-                "/orange/ruogu.fang/zeyun.zhao/DATA/UKB_sub/"
-                "rsfMRI_processed_nii/filtered_func_data_clean/"
-                f"{subject_id}_filtered_func_data_clean.nii.gz"
-            )
-
-            # Rename/move the extracted file to the target file path
-            os.rename(source_file_path, target_file_path)
-
-            # Remove the intermediate extraction folder
-            shutil.rmtree(output_path)
-        else:
+        try:
+            member_info = zip_ref.getinfo(file_to_extract)
+        except KeyError:
             print(f"File '{file_to_extract}' not found in '{zip_file_path}'. Skipping.")
+            return 0
+
+        subject_id = os.path.basename(output_path)  # e.g., "1000023_20227_2_0"
+        target_file_path = os.path.join(target_dir, f"{subject_id}_filtered_func_data_clean.nii.gz")
+        status = stream_member_to_path(zip_ref, member_info, target_file_path)
+        print(f"{status.capitalize()} '{file_to_extract}' -> {target_file_path}")
 
     return 0
 
@@ -90,31 +249,30 @@ def register_to_mni_space(in_path, out_path,
 
 def main():
     """
-    Example main function to demonstrate iterating through a folder
-    and extracting a specified file from ZIP archives.
+    Example main function to demonstrate extracting a specified file from
+    every ZIP archive in a folder.
 
     It looks for ZIP files in '/orange/ruogu.fang/zeyun.zhao/DATA/UKB_sub/rsfMRI_processed_nii',
-    extracts a particular file ('fMRI/rfMRI.ica/filtered_func_data_clean.nii.gz'),
-    and places the extracted file in a dedicated directory for further processing.
+    streams a particular file ('fMRI/rfMRI.ica/filtered_func_data_clean.nii.gz') out of each
+    archive across a process pool, and places it in a dedicated directory for further processing.
     """
     folder_path = "/orange/ruogu.fang/zeyun.zhao/DATA/UKB_sub/rsfMRI_processed_nii"
     file_to_extract = "fMRI/rfMRI.ica/filtered_func_data_clean.nii.gz"
 
-    # Loop through all items in the specified folder
-    for root in os.listdir(folder_path):
-        # Only process if the item is a ZIP file
-        if not root.endswith(".zip"):
-            continue
-
-        zip_file_path = os.path.join(folder_path, root)
-        # Output path is a subdirectory named after the ZIP file (minus '.zip')
-        output_path = os.path.join(
-            folder_path,
-            "filtered_func_data_clean",
-            root[:-4]
-        )
-
-        extract_filtered_func_data(zip_file_path, file_to_extract, output_path)
+    # Only the ZIP files directly in the specified folder
+    zip_paths = sorted(
+        os.path.join(folder_path, name)
+        for name in os.listdir(folder_path)
+        if name.endswith(".zip")
+    )
+
+    # Stream the member of every archive to filtered_func_data_clean/<zip stem>_<member basename>
+    extract_archives_parallel(
+        zip_paths,
+        members=[file_to_extract],
+        output_dir=FILTERED_FUNC_DIR,
+        flat=True
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+SQLite index of the members of UKB bulk ZIP archives.
+
+Opening tens of thousands of UKB archives just to ask "does this one contain
+fMRI/rfMRI.ica/filtered_func_data_clean.nii.gz?" is slow. This script reads
+each archive's central directory once and records, per member, its name,
+sizes, CRC-32 and local header offset in a small SQLite database. The index
+is updated incrementally: archives whose size and mtime are unchanged are not
+reopened.
+
+With the index in place:
+  1) Cohort selection can query which eids have a given member without
+     touching the archives (eids_with_member).
+  2) Extraction can seek straight to a member's local header and stream its
+     data, without parsing the central directory again (extract_indexed_member).
+
+Usage (example):
+  python zip_index.py \
+    --zip_dir /orange/ruogu.fang/data/UKB/brain/20227_rsfMRI_NIFTI/rsfMRI_zip \
+    --db_path /orange/ruogu.fang/data/UKB/brain/20227_rsfMRI_NIFTI/zip_index.sqlite
+"""
+
+import os
+import struct
+import sqlite3
+import zipfile
+import zlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from unzip import find_zip_files
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    archive_path TEXT PRIMARY KEY,
+    eid          TEXT NOT NULL,
+    field_id     TEXT,
+    instance     TEXT,
+    size         INTEGER NOT NULL,
+    mtime_ns     INTEGER NOT NULL,
+    n_members    INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS members (
+    archive_path  TEXT NOT NULL REFERENCES archives(archive_path) ON DELETE CASCADE,
+    name          TEXT NOT NULL,
+    file_size     INTEGER NOT NULL,
+    compress_size INTEGER NOT NULL,
+    compress_type INTEGER NOT NULL,
+    crc           INTEGER NOT NULL,
+    header_offset INTEGER NOT NULL,
+    PRIMARY KEY (archive_path, name)
+);
+CREATE INDEX IF NOT EXISTS members_by_name ON members(name);
+CREATE INDEX IF NOT EXISTS archives_by_eid ON archives(eid);
+"""
+
+# Fixed-size part of a ZIP local file header (APPNOTE 4.3.7)
+LOCAL_HEADER_STRUCT = struct.Struct("<4s2B4HL2L2H")
+LOCAL_HEADER_SIGNATURE = b"PK\003\004"
+
+
+def connect_index(db_path: str) -> sqlite3.Connection:
+    """
+    Open (and create if needed) the index database.
+    """
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def parse_archive_name(archive_path: str) -> tuple[str, str, str]:
+    """
+    Split a UKB bulk archive name such as '1000023_20227_2_0.zip' into
+    (eid, field_id, instance). Missing parts are returned as ''.
+    """
+    stem = os.path.splitext(os.path.basename(archive_path))[0]
+    parts = stem.split("_")
+    eid = parts[0]
+    field_id = parts[1] if len(parts) > 1 else ""
+    instance = "_".join(parts[2:]) if len(parts) > 2 else ""
+    return eid, field_id, instance
+
+
+def read_central_directory(archive_path: str) -> tuple[str, list[tuple]]:
+    """
+    Read the member table of one archive. Runs inside a worker process.
+
+    Args:
+        archive_path (str): Path to the ZIP archive.
+
+    Returns:
+        (archive_path, rows): rows are
+            (name, file_size, compress_size, compress_type, crc, header_offset).
+    """
+    with zipfile.ZipFile(archive_path, "r") as zip_ref:
+        rows = [
+            (info.filename, info.file_size, info.compress_size,
+             info.compress_type, info.CRC, info.header_offset)
+            for info in zip_ref.infolist()
+            if not info.is_dir()
+        ]
+    return archive_path, rows
+
+
+def update_index(db_path: str, zip_paths: list[str], num_workers: int = None) -> dict:
+    """
+    Add new or changed archives to the index and drop ones that disappeared.
+
+    Only archives whose (size, mtime) differ from the stored values are
+    reopened; their central directories are read across a process pool.
+
+    Args:
+        db_path (str): Path to the SQLite index.
+        zip_paths (List[str]): All archives that should be in the index.
+        num_workers (int, optional): Number of worker processes (default os.cpu_count()).
+
+    Returns:
+        dict: Counts of 'indexed', 'unchanged', 'removed' and 'failed' archives.
+    """
+    conn = connect_index(db_path)
+    known = {
+        path: (size, mtime_ns)
+        for path, size, mtime_ns in conn.execute("SELECT archive_path, size, mtime_ns FROM archives")
+    }
+
+    wanted = {}
+    for path in zip_paths:
+        stat = os.stat(path)
+        wanted[os.path.abspath(path)] = (stat.st_size, stat.st_mtime_ns)
+
+    stale = [path for path in wanted if known.get(path) != wanted[path]]
+    removed = [path for path in known if path not in wanted]
+    counts = {"indexed": 0, "unchanged": len(wanted) - len(stale), "removed": len(removed), "failed": 0}
+
+    with conn:
+        conn.executemany("DELETE FROM archives WHERE archive_path = ?", [(p,) for p in removed])
+
+    print(f"Index has {len(known)} archives; {len(stale)} new or changed, {len(removed)} removed.")
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(_read_central_directory_safe, stale, chunksize=64)
+        for index, (path, rows) in enumerate(results, start=1):
+            if rows is None:
+                counts["failed"] += 1
+                continue
+
+            size, mtime_ns = wanted[path]
+            eid, field_id, instance = parse_archive_name(path)
+            with conn:
+                conn.execute("DELETE FROM archives WHERE archive_path = ?", (path,))
+                conn.execute(
+                    "INSERT INTO archives VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (path, eid, field_id, instance, size, mtime_ns, len(rows))
+                )
+                conn.executemany(
+                    "INSERT INTO members VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(path, *row) for row in rows]
+                )
+            counts["indexed"] += 1
+            if index % 1000 == 0:
+                print(f"Progress: {index}/{len(stale)} archives indexed")
+
+    conn.close()
+    print(f"Index update summary: {counts}")
+    return counts
+
+
+def _read_central_directory_safe(archive_path: str) -> tuple[str, list]:
+    """
+    read_central_directory that reports corrupt archives instead of raising.
+    """
+    try:
+        return read_central_directory(archive_path)
+    except (zipfile.BadZipFile, OSError) as exc:
+        print(f"Could not read '{archive_path}': {exc}")
+        return archive_path, None
+
+
+def eids_with_member(db_path: str, member: str) -> list[str]:
+    """
+    Return the sorted eids that have at least one archive containing `member`,
+    e.g. 'fMRI/rfMRI.ica/filtered_func_data_clean.nii.gz'.
+    """
+    conn = connect_index(db_path)
+    rows = conn.execute(
+        "SELECT DISTINCT a.eid FROM archives a JOIN members m USING (archive_path) "
+        "WHERE m.name = ? ORDER BY a.eid",
+        (member,)
+    ).fetchall()
+    conn.close()
+    return [row[0] for row in rows]
+
+
+def archives_with_member(db_path: str, member: str, eids: list[str] = None) -> dict:
+    """
+    Map eid -> list of archive paths containing `member`, optionally restricted to `eids`.
+    """
+    conn = connect_index(db_path)
+    rows = conn.execute(
+        "SELECT a.eid, a.archive_path FROM archives a JOIN members m USING (archive_path) "
+        "WHERE m.name = ? ORDER BY a.eid, a.archive_path",
+        (member,)
+    ).fetchall()
+    conn.close()
+
+    wanted = set(str(e) for e in eids) if eids is not None else None
+    eid_to_archives = {}
+    for eid, path in rows:
+        if wanted is None or eid in wanted:
+            eid_to_archives.setdefault(eid, []).append(path)
+    return eid_to_archives
+
+
+def lookup_member(db_path: str, archive_path: str, member: str) -> dict:
+    """
+    Return the stored entry of one member as a dict, or None if it is not indexed.
+    """
+    conn = connect_index(db_path)
+    conn.row_factory = sqlite3.Row
+    row = conn.execute(
+        "SELECT * FROM members WHERE archive_path = ? AND name = ?",
+        (os.path.abspath(archive_path), member)
+    ).fetchone()
+    conn.close()
+    return dict(row) if row is not None else None
+
+
+def lookup_members(db_path: str, member: str, eids: list[str] = None) -> list[dict]:
+    """
+    Stored entries of `member` in every archive (optionally only archives of `eids`),
+    with the archive's eid and instance, in one query. Sorted by eid and archive path.
+    """
+    conn = connect_index(db_path)
+    conn.row_factory = sqlite3.Row
+    rows = conn.execute(
+        "SELECT a.eid, a.instance, m.* FROM archives a JOIN members m USING (archive_path) "
+        "WHERE m.name = ? ORDER BY a.eid, a.archive_path",
+        (member,)
+    ).fetchall()
+    conn.close()
+
+    wanted = set(str(e) for e in eids) if eids is not None else None
+    return [dict(row) for row in rows if wanted is None or row["eid"] in wanted]
+
+
+def extract_indexed_member(entry: dict, target_path: str, chunk_size: int = 4 * 1024 * 1024) -> str:
+    """
+    Stream one member to `target_path` using its indexed header offset.
+
+    The archive is opened as a plain file, the local header at
+    entry['header_offset'] is validated and skipped, and the compressed bytes
+    are inflated directly into '<target_path>.part', which is renamed once the
+    CRC-32 and size match the index. Existing outputs of the right size are skipped.
+
+    Args:
+        entry (dict): A row from lookup_member.
+        target_path (str): Final path of the extracted file.
+        chunk_size (int, optional): Read block size in bytes (default 4 MiB).
+
+    Returns:
+        str: 'skipped' or 'extracted'.
+
+    Raises:
+        ValueError: If the local header, compression method, size or CRC do not match.
+    """
+    if os.path.isfile(target_path) and os.path.getsize(target_path) == entry["file_size"]:
+        return "skipped"
+
+    if entry["compress_type"] == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    elif entry["compress_type"] == zipfile.ZIP_STORED:
+        decompressor = None
+    else:
+        raise ValueError(f"Unsupported compression method {entry['compress_type']} for {entry['name']}")
+
+    os.makedirs(os.path.dirname(target_path) or ".", exist_ok=True)
+    partial_path = f"{target_path}.part"
+    crc = 0
+    written = 0
+    try:
+        with open(entry["archive_path"], "rb") as src, open(partial_path, "wb") as dst:
+            src.seek(entry["header_offset"])
+            header = LOCAL_HEADER_STRUCT.unpack(src.read(LOCAL_HEADER_STRUCT.size))
+            if header[0] != LOCAL_HEADER_SIGNATURE:
+                raise ValueError(f"Bad local header for {entry['name']} in {entry['archive_path']}")
+            name_length, extra_length = header[10], header[11]
+            src.seek(name_length + extra_length, os.SEEK_CUR)
+
+            remaining = entry["compress_size"]
+            while remaining > 0:
+                block = src.read(min(chunk_size, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                data = decompressor.decompress(block) if decompressor is not None else block
+                crc = zlib.crc32(data, crc)
+                written += len(data)
+                dst.write(data)
+            if decompressor is not None:
+                data = decompressor.flush()
+                crc = zlib.crc32(data, crc)
+                written += len(data)
+                dst.write(data)
+
+        if written != entry["file_size"] or crc != entry["crc"]:
+            raise ValueError(f"Size/CRC mismatch for {entry['name']} in {entry['archive_path']}")
+        os.replace(partial_path, target_path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    return "extracted"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build or update an SQLite index of UKB ZIP archive members."
+    )
+    parser.add_argument(
+        "--zip_dir", required=True,
+        help="Directory searched recursively for .zip archives."
+    )
+    parser.add_argument(
+        "--db_path", required=True,
+        help="Path to the SQLite index file (created if missing)."
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=None,
+        help="Number of worker processes (default: all cores)."
+    )
+    parser.add_argument(
+        "--member", default="fMRI/rfMRI.ica/filtered_func_data_clean.nii.gz",
+        help="Member to report eid coverage for after the update."
+    )
+
+    args = parser.parse_args()
+
+    update_index(args.db_path, find_zip_files(args.zip_dir), num_workers=args.num_workers)
+    eids = eids_with_member(args.db_path, args.member)
+    print(f"{len(eids)} eids have '{args.member}'.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import time
+import asyncio
+from collections import Counter
+
+import pandas as pd
+from aiohttp import web
+
+from async_fetcher import AsyncFetcher, TokenBucket, fetch_terms, resolve_dois
+from pmid_cache import PmidCache
+
+
+STUDY_LINK = '<a href="/studies/{pmid}/">{title}</a>'
+
+HTML_TABLE = """<html><body><table id="analysis-studies-table">
+<tr><th>Title</th><th>Authors</th><th>Journal</th><th>Loading</th></tr>
+<tr><td><a href="/studies/444/">Memory study</a></td><td>Doe J</td><td>Neuron</td><td>0.5</td></tr>
+</table></body></html>"""
+
+ESUMMARY_DOIS = {"111": "10.1/one", "444": "10.1/four"}
+
+
+def fixture_app(requests: Counter, esummary_ids: list) -> web.Application:
+    """
+    Stand-in for neurosynth, esummary and PubMed. The first esummary request gets a 503.
+    """
+
+    async def studies_json(request):
+        requests[request.path] += 1
+        if request.match_info["term"] != "pain":
+            raise web.HTTPNotFound()
+        rows = [[STUDY_LINK.format(pmid=p, title=f"Pain {p}"), "Roe A", "Pain", "0.9"] for p in ("111", "222", "333")]
+        return web.json_response({"data": rows})
+
+    async def studies_html(request):
+        requests[request.path] += 1
+        return web.Response(text=HTML_TABLE, content_type="text/html")
+
+    async def esummary(request):
+        requests[request.path] += 1
+        if requests[request.path] == 1:
+            return web.Response(status=503, headers={"Retry-After": "0"})
+        ids = request.query["id"].split(",")
+        esummary_ids.append(ids)
+        result = {"uids": ids}
+        for pmid in ids:
+            article_ids = [{"idtype": "doi", "value": ESUMMARY_DOIS[pmid]}] if pmid in ESUMMARY_DOIS else []
+            result[pmid] = {"articleids": [{"idtype": "pubmed", "value": pmid}] + article_ids}
+        return web.json_response({"result": result})
+
+    async def pubmed_page(request):
+        requests[request.path] += 1
+        if request.match_info["pmid"] != "222":
+            raise web.HTTPNotFound()
+        html = '<span class="identifier doi"><a href="#">10.1/two</a></span>'
+        return web.Response(text=html, content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get("/api/analyses/{term}/studies", studies_json)
+    app.router.add_get("/analyses/terms/{term}/", studies_html)
+    app.router.add_get("/eutils/esummary.fcgi", esummary)
+    app.router.add_get("/pubmed/{pmid}/", pubmed_page)
+    return app
+
+
+async def run_against_fixture(coro_factory):
+    requests, esummary_ids = Counter(), []
+    runner = web.AppRunner(fixture_app(requests, esummary_ids))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    base_url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+    urls = {"base_url": base_url, "pubmed_url": f"{base_url}/pubmed", "eutils_url": f"{base_url}/eutils"}
+    try:
+        return await coro_factory(urls), requests, esummary_ids
+    finally:
+        await runner.cleanup()
+
+
+FETCHER_KWARGS = {"default_rate": 1000.0, "retries": 2, "backoff": 0.0, "timeout": 5.0}
+
+
+def test_fetch_terms_writes_term_csvs(tmp_path):
+    out_dir = str(tmp_path / "term_csv")
+    cache = PmidCache(str(tmp_path / "cache.sqlite"))
+
+    results, requests, esummary_ids = asyncio.run(run_against_fixture(
+        lambda urls: fetch_terms([("pain", 10), ("memory", 10)], out_dir, 2, False, FETCHER_KWARGS, urls, cache)
+    ))
+
+    assert results == {"pain": 3, "memory": 1}
+    pain = pd.read_csv(tmp_path / "term_csv" / "pain.csv", dtype=str)
+    assert list(pain["paper_name"]) == ["pain_00001", "pain_00002", "pain_00003"]
+    assert list(pain["Doi"]) == ["10.1/one", "10.1/two", "-1"]
+    memory = pd.read_csv(tmp_path / "term_csv" / "memory.csv", dtype=str)
+    assert (memory["Title"][0], memory["PMID"][0], memory["Doi"][0]) == ("Memory study", "444", "10.1/four")
+    # The 503 was retried; only PMIDs without an esummary DOI went to PubMed pages
+    assert requests["/eutils/esummary.fcgi"] == 3
+    assert requests["/pubmed/111/"] == 0 and requests["/pubmed/222/"] == 1
+
+    # Cached PMIDs are not requested again; the unreachable page is not negative-cached
+    dois, _, esummary_ids = asyncio.run(run_against_fixture(
+        lambda urls: _resolve(urls, ["111", "222", "333"], cache)
+    ))
+    cache.close()
+    assert dois == {"111": "10.1/one", "222": "10.1/two", "333": None}
+    assert esummary_ids == [["333"]]
+
+
+async def _resolve(urls, pmids, cache):
+    async with AsyncFetcher(**FETCHER_KWARGS) as fetcher:
+        return await resolve_dois(fetcher, pmids, urls["pubmed_url"], urls["eutils_url"], cache)
+
+
+def test_token_bucket_limits_rate():
+    async def acquire_many(bucket, n):
+        start = time.monotonic()
+        for _ in range(n):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    assert asyncio.run(acquire_many(TokenBucket(rate=20.0, burst=1), 5)) >= 0.15
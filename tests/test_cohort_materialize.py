@@ -0,0 +1,45 @@
+from dataclasses import replace
+
+import pandas as pd
+import pytest
+
+from cohort_materialize import DEFAULT_COHORTS, load_flags, select_eids
+
+
+def notebook_flags(path):
+    """
+    A trimmed_icd.pkl as icd_eda.ipynb saves it: diagnosis lists and has_* flags, no counts.
+    """
+    flags = pd.DataFrame({
+        "eid": [1000014, 1000023, 1000030, 1000041, 1000052],
+        "31-0.0": [1, 1, 0, 0, 1],
+        "21022-0.0": [63, 48, 65, 53, 70],
+        "all_diagnoses": [["I10", "F330"], [], ["F331", "F410", "G20"], ["G309"], ["G20"]],
+        "mental_and_neural_diagnoses": [["F330"], [], ["F331", "F410", "G20"], ["G309"], ["G20"]],
+    })
+    flags["has_any_diagnosis"] = flags["all_diagnoses"].map(bool)
+    flags["has_mental_or_neural_diagnosis"] = flags["mental_and_neural_diagnoses"].map(bool)
+    flags.to_pickle(path)
+
+
+def test_load_flags_counts_notebook_lists(tmp_path):
+    notebook_flags(tmp_path / "trimmed_icd.pkl")
+
+    flags, diagnoses = load_flags(str(tmp_path / "trimmed_icd.pkl"))
+
+    assert list(flags["n_diagnoses"]) == [2, 0, 3, 1, 1]
+    assert list(flags["n_mental_and_neural_diagnoses"]) == [1, 0, 3, 1, 1]
+    selected = {
+        spec.name: list(select_eids(flags, diagnoses, spec)["eid"])
+        for spec in DEFAULT_COHORTS if spec.name != "control"
+    }
+    assert selected == {"MDD": [1000014], "BPD": [], "AD": [1000041], "PD": [1000052]}
+    control = next(spec for spec in DEFAULT_COHORTS if spec.name == "control")
+    assert list(select_eids(flags, diagnoses, replace(control, sample_frac=None))["eid"]) == [1000023]
+
+
+def test_load_flags_without_lists_fails(tmp_path):
+    pd.DataFrame({"eid": [1], "all_diagnoses": [["F330"]]}).to_pickle(tmp_path / "flags.pkl")
+
+    with pytest.raises(ValueError, match="mental_and_neural_diagnoses"):
+        load_flags(str(tmp_path / "flags.pkl"))
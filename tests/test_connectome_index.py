@@ -0,0 +1,42 @@
+import sys
+
+import numpy as np
+import pandas as pd
+
+import connectome_index
+from connectome_index import upper_triangle
+
+
+def run_main(tmp_path, monkeypatch, mats, kind):
+    subject_ids = np.array(["p0", "c0", "c1"])
+    np.savez(tmp_path / "conn.npz", subject_ids=subject_ids, **{kind: mats})
+    pd.DataFrame({"FILE_ID": subject_ids, "DX_GROUP": [1, 2, 2], "SITE_ID": ["NYU"] * 3}).to_csv(
+        tmp_path / "phenotype.csv", index=False
+    )
+    monkeypatch.setattr(sys, "argv", [
+        "connectome_index.py", "--connectivity", str(tmp_path / "conn.npz"), "--kind", kind,
+        "--phenotype", str(tmp_path / "phenotype.csv"), "--k", "2", "--out", str(tmp_path / "matches.csv"),
+    ])
+    connectome_index.main()
+    return pd.read_csv(tmp_path / "matches.csv")
+
+
+def test_covariance_is_not_fisher_z_transformed(tmp_path, monkeypatch):
+    # Covariances beyond +-1: Fisher-z clipping would make both controls identical
+    mats = np.array([np.full((3, 3), v) for v in (5.0, 4.0, 9.0)])
+
+    matches = run_main(tmp_path, monkeypatch, mats, "covariance")
+
+    assert list(matches["control"]) == ["c0", "c1"]
+    edges = upper_triangle(mats)
+    np.testing.assert_allclose(matches["distance"], np.linalg.norm(edges[1:] - edges[0], axis=1), rtol=1e-5)
+
+
+def test_correlation_is_fisher_z_transformed(tmp_path, monkeypatch):
+    mats = np.array([np.full((3, 3), v) for v in (0.5, 0.9, 0.2)])
+
+    matches = run_main(tmp_path, monkeypatch, mats, "correlation")
+
+    edges = np.arctanh(upper_triangle(mats).astype(np.float64))
+    expected = sorted(np.linalg.norm(edges[1:] - edges[0], axis=1))
+    np.testing.assert_allclose(matches["distance"], expected, rtol=1e-4)
@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+import nibabel as nib
+import pandas as pd
+import pytest
+
+from denoise import denoise_stack, denoise_store, nifti_tr, subject_trs
+from fmri_loader import load_dat_file
+from parcellation import save_timeseries
+
+
+def write_subjects(folder, names, n_timepoints=120, n_regions=4):
+    folder.mkdir()
+    rng = np.random.default_rng(0)
+    paths = []
+    for name in names:
+        path = str(folder / f"{name}_MNI_2mm.dat")
+        save_timeseries(rng.standard_normal((n_timepoints, n_regions)), path)
+        paths.append(path)
+    return paths
+
+
+def test_denoise_store_filters_each_subject_with_its_tr(tmp_path):
+    paths = write_subjects(tmp_path / "in", ["NYU_0051036", "Pitt_0050003", "UM_1_0050272"])
+    phenotype = pd.DataFrame({"FILE_ID": ["NYU_0051036", "Pitt_0050003"], "TR": [2.0, 1.5]})
+    trs = subject_trs(paths, tr=3.0, tr_table=phenotype)
+    assert list(trs.values()) == [2.0, 1.5, 3.0]
+
+    counts = denoise_store(paths, str(tmp_path / "out"), trs, num_workers=2)
+
+    assert counts == {"denoised": 3, "skipped": 0, "failed": 0}
+    for path, tr in trs.items():
+        expected = denoise_stack(load_dat_file(path)[None], tr=tr)[0]
+        out = load_dat_file(os.path.join(tmp_path, "out", os.path.basename(path)))
+        np.testing.assert_allclose(out, expected, atol=1e-12)
+
+
+def test_denoise_store_fails_without_tr(tmp_path):
+    paths = write_subjects(tmp_path / "in", ["NYU_0051036", "Pitt_0050003"])
+    trs = subject_trs(paths, tr_table=pd.DataFrame({"FILE_ID": ["NYU_0051036"], "TR": [2.0]}))
+
+    with pytest.raises(ValueError, match="No TR for 1 subjects"):
+        denoise_store(paths, str(tmp_path / "out"), trs)
+    assert not (tmp_path / "out" / "NYU_0051036_MNI_2mm.dat").exists()
+
+
+def test_tr_from_nifti_header(tmp_path):
+    paths = write_subjects(tmp_path / "in", ["Caltech_0051456", "SDSU_0050182"])
+    (tmp_path / "nifti").mkdir()
+    for name, tr, unit in [("Caltech_0051456", 2.0, "sec"), ("SDSU_0050182", 2000.0, "msec")]:
+        img = nib.Nifti1Image(np.zeros((2, 2, 2, 3), dtype=np.float32), np.eye(4))
+        img.header.set_zooms((3.0, 3.0, 3.0, tr))
+        img.header.set_xyzt_units("mm", unit)
+        nib.save(img, str(tmp_path / "nifti" / f"{name}_func_preproc.nii.gz"))
+
+    assert nifti_tr(str(tmp_path / "nifti" / "SDSU_0050182_func_preproc.nii.gz")) == 2.0
+    assert subject_trs(paths, nifti_dir=str(tmp_path / "nifti")) == {paths[0]: 2.0, paths[1]: 2.0}
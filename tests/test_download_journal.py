@@ -0,0 +1,15 @@
+import pandas as pd
+
+from download_journal import DownloadJournal
+
+
+def test_compact_parquet_with_sentinels(tmp_path):
+    with DownloadJournal(str(tmp_path / "journal.jsonl"), fsync=False) as journal:
+        journal.record("1", Doi="10.1000/xyz", pdf_url="https://example.org/a.pdf", download_status=1)
+        journal.record("2", Doi=-1, pdf_url=-1, download_status=-1)
+        journal.compact(str(tmp_path / "status.parquet"))
+
+    df = pd.read_parquet(tmp_path / "status.parquet")
+    assert df["Doi"].tolist()[0] == "10.1000/xyz" and pd.isna(df["Doi"].tolist()[1])
+    assert df["pdf_url"].tolist()[0] == "https://example.org/a.pdf" and pd.isna(df["pdf_url"].tolist()[1])
+    assert df["download_status"].tolist() == [1, -1]
@@ -0,0 +1,142 @@
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import download_manager
+from download_manager import DownloadTask, download_file, download_many, make_session
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves self.server.objects {path: bytes} with ETag, Range and If-Range
+    support. Paths in self.server.cut_after are cut after that many bytes once.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def _etag(self, body):
+        return f'"{self.server.etag_kind(body)}"'
+
+    def do_HEAD(self):
+        body = self.server.objects.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", self._etag(body))
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        body = self.server.objects.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        etag = self._etag(body)
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range", etag) == etag:
+            start = int(range_header.split("=")[1].split("-")[0])
+        if start >= len(body) and start > 0:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{len(body)}")
+            self.end_headers()
+            return
+
+        self.send_response(206 if start else 200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body) - start))
+        if start:
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+        self.end_headers()
+        cut = self.server.cut_after.pop(self.path, None)
+        if cut is not None:
+            self.wfile.write(body[start:start + cut])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # Small blocks, so the bytes received before a cut reach the partial file
+    monkeypatch.setattr(download_manager, "DOWNLOAD_CHUNK_SIZE", 1000)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    httpd.objects, httpd.requests, httpd.cut_after = {}, [], {}
+    httpd.etag_kind = lambda body: hashlib.md5(body).hexdigest()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def url(server, path):
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+
+def test_download_many_and_skip(server, tmp_path):
+    server.objects = {"/a.bin": b"a" * 5000, "/b.bin": b"b" * 3000}
+    tasks = [DownloadTask(url(server, p), str(tmp_path / p[1:])) for p in ("/a.bin", "/b.bin", "/missing.bin")]
+    manifest = str(tmp_path / "manifest.jsonl")
+
+    results = {r.path: r for r in download_many(tasks, num_workers=2, manifest_path=manifest, retries=0)}
+    assert results[tasks[0].path].status == "done"
+    assert results[tasks[2].path].status == "missing"
+    assert (tmp_path / "a.bin").read_bytes() == server.objects["/a.bin"]
+
+    n_requests = len(server.requests)
+    again = download_many(tasks[:2], num_workers=2, manifest_path=manifest)
+    assert {r.status for r in again} == {"skipped"}
+    assert len(server.requests) == n_requests
+
+
+def test_interrupted_transfer_resumes_with_range(server, tmp_path):
+    body = bytes(range(256)) * 400
+    server.objects = {"/f.bin": body}
+    server.cut_after = {"/f.bin": 30000}
+    task = DownloadTask(url(server, "/f.bin"), str(tmp_path / "f.bin"))
+
+    result = download_file(make_session(retries=0), task, retries=2, backoff=0.0, timeout=5.0)
+
+    assert result.status == "done" and result.attempts == 2
+    assert (tmp_path / "f.bin").read_bytes() == body
+    assert server.requests[1][1]["Range"] == "bytes=30000-"
+    assert server.requests[1][1]["If-Range"] == f'"{hashlib.md5(body).hexdigest()}"'
+    assert not (tmp_path / "f.bin.part.validator").exists()
+
+
+def test_partial_of_changed_object_restarts(server, tmp_path):
+    # Multipart-style ETags are not an MD5, so only If-Range can catch the change
+    server.etag_kind = lambda body: hashlib.sha1(body).hexdigest()[:20] + "-2"
+    old, new = b"o" * 8000, b"n" * 9000
+    server.objects = {"/f.bin": old}
+    server.cut_after = {"/f.bin": 4000}
+    task = DownloadTask(url(server, "/f.bin"), str(tmp_path / "f.bin"))
+    assert download_file(make_session(retries=0), task, retries=0, timeout=5.0).status == "failed"
+    assert (tmp_path / "f.bin.part").stat().st_size == 4000
+
+    server.objects = {"/f.bin": new}
+    result = download_file(make_session(retries=0), task, retries=0, timeout=5.0)
+
+    assert result.status == "done"
+    assert (tmp_path / "f.bin").read_bytes() == new
+
+
+def test_partial_without_validator_is_discarded(server, tmp_path):
+    server.etag_kind = lambda body: hashlib.sha1(body).hexdigest()[:20] + "-2"
+    new = b"n" * 9000
+    server.objects = {"/f.bin": new}
+    (tmp_path / "f.bin.part").write_bytes(b"o" * 4000)
+    task = DownloadTask(url(server, "/f.bin"), str(tmp_path / "f.bin"))
+
+    result = download_file(make_session(retries=0), task, retries=0, timeout=5.0)
+
+    assert result.status == "done"
+    assert (tmp_path / "f.bin").read_bytes() == new
+    assert "Range" not in server.requests[0][1]
@@ -0,0 +1,48 @@
+import os
+
+import pandas as pd
+
+from filter_ukb_csv import extract_fields, filter_csv_by_prefix, read_fields
+
+
+def test_types_widen_across_chunks(tmp_path):
+    csv = tmp_path / "ukb.csv"
+    pd.DataFrame({
+        "eid": [1, 2, 3, 4, 5, 6, 7],
+        "21001-0.0": ["25", "26", "27", "25.5", "", "26.1", "30"],
+        "31-0.0": ["1", "0", "1", "0", "1", "0", "x"],
+    }).to_csv(csv, index=False)
+
+    extract_fields(str(csv), str(tmp_path / "fields"), ["21001", "31"], chunksize=3)
+    df = read_fields(str(tmp_path / "fields"), ["21001", "31"])
+
+    assert df["eid"].tolist() == [1, 2, 3, 4, 5, 6, 7]
+    assert df["21001-0.0"].dtype == "float64"
+    assert df["21001-0.0"].tolist()[3] == 25.5 and df["21001-0.0"].tolist()[5] == 26.1
+    assert df["21001-0.0"].isna().sum() == 1
+    assert df["31-0.0"].tolist() == ["1", "0", "1", "0", "1", "0", "x"]
+
+
+def test_csv_is_read_once(tmp_path, monkeypatch):
+    csv = tmp_path / "ukb.csv"
+    pd.DataFrame({"eid": range(1, 10), "31-0.0": ["1"] * 8 + ["x"]}).to_csv(csv, index=False)
+    calls = []
+    read_csv = pd.read_csv
+    monkeypatch.setattr(pd, "read_csv", lambda *args, **kwargs: calls.append(kwargs) or read_csv(*args, **kwargs))
+
+    extract_fields(str(csv), str(tmp_path / "fields"), ["31"], chunksize=2)
+
+    assert [kwargs.get("nrows") for kwargs in calls] == [0, None]
+    assert read_fields(str(tmp_path / "fields"), ["31"])["31-0.0"].tolist() == ["1"] * 8 + ["x"]
+    assert sorted(os.listdir(tmp_path / "fields" / "field=31")) == ["part-0.parquet"]
+
+
+def test_filter_csv_matches_field_ids_exactly(tmp_path):
+    csv = tmp_path / "ukb.csv"
+    pd.DataFrame({"eid": [1], "31-0.0": [0], "3140-0.0": [5], "41202-0.0": ["F330"], "41202-0.1": ["G20"]}).to_csv(
+        csv, index=False
+    )
+
+    filter_csv_by_prefix(str(csv), str(tmp_path / "out.csv"), ["eid", "31", "41202-0.1"])
+
+    assert list(pd.read_csv(tmp_path / "out.csv").columns) == ["eid", "31-0.0", "41202-0.1"]
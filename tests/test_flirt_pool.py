@@ -0,0 +1,118 @@
+import os
+import sys
+import stat
+import threading
+
+from flirt_pool import FlirtJob, build_jobs, register_many, run_flirt_job, write_report
+
+
+STUB_FLIRT = """#!{python}
+# Stand-in for FSL flirt: copies -in to -out, logging how many copies run at once
+import os, sys, time, shutil, signal
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+state = os.environ["STUB_STATE"]
+marker = os.path.join(state, "running", str(os.getpid()))
+open(marker, "w").close()
+with open(os.path.join(state, "calls.log"), "a") as f:
+    f.write(f"{{len(os.listdir(os.path.dirname(marker)))}} {{os.environ['OMP_NUM_THREADS']}} {{args['-applyisoxfm']}}\\n")
+time.sleep(0.2)
+os.remove(marker)
+name = os.path.basename(args["-in"])
+failed_before = os.path.join(state, "failed_once_" + name)
+first_call = not os.path.exists(failed_before)
+open(failed_before, "w").close()
+if name.startswith("slow"):
+    time.sleep(10)
+if name.startswith("broken"):
+    sys.exit("ERROR: invalid image")
+if name.startswith("busy") and first_call:
+    sys.exit(3)
+if name.startswith("crash") or (name.startswith("flaky") and first_call):
+    # Killed after writing part of the output
+    open(args["-out"], "w").write("partial")
+    os.kill(os.getpid(), signal.SIGKILL)
+shutil.copyfile(args["-in"], args["-out"])
+"""
+
+
+def make_stub(tmp_path, monkeypatch):
+    state = tmp_path / "state"
+    (state / "running").mkdir(parents=True)
+    monkeypatch.setenv("STUB_STATE", str(state))
+    flirt = tmp_path / "bin" / "flirt"
+    flirt.parent.mkdir()
+    flirt.write_text(STUB_FLIRT.format(python=sys.executable))
+    flirt.chmod(flirt.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{flirt.parent}{os.pathsep}{os.environ['PATH']}")
+    return state
+
+
+def make_inputs(folder, names):
+    folder.mkdir()
+    for name in names:
+        (folder / name).write_bytes(name.encode())
+    return [str(folder / name) for name in names]
+
+
+def test_register_many_caps_concurrency(tmp_path, monkeypatch):
+    state = make_stub(tmp_path, monkeypatch)
+    in_paths = make_inputs(tmp_path / "in", [f"sub{i}.nii.gz" for i in range(6)])
+    jobs = build_jobs(in_paths, "ref.nii.gz", out_dir=str(tmp_path / "out"), out_suffix="_MNI.nii.gz")
+
+    results = register_many(jobs, max_concurrent=2, threads_per_job=3, backoff=0.0)
+
+    assert sorted(r.status for r in results) == ["done"] * 6
+    assert (tmp_path / "out" / "sub0_MNI.nii.gz").read_bytes() == b"sub0.nii.gz"
+    calls = [line.split() for line in (state / "calls.log").read_text().splitlines()]
+    assert len(calls) == 6
+    assert max(int(running) for running, _, _ in calls) <= 2
+    assert {(threads, iso) for _, threads, iso in calls} == {("3", "2")}
+
+    again = register_many(jobs, max_concurrent=2)
+    assert {r.status for r in again} == {"skipped"}
+    assert len((state / "calls.log").read_text().splitlines()) == 6
+
+
+def test_run_flirt_job_retries_transient_failures(tmp_path, monkeypatch):
+    make_stub(tmp_path, monkeypatch)
+    in_paths = make_inputs(tmp_path / "in", ["flaky.nii.gz", "busy.nii.gz", "crash.nii.gz", "slow.nii.gz"])
+    flaky, busy, crash, slow = build_jobs(in_paths, "ref.nii.gz")
+    slots = threading.BoundedSemaphore(1)
+
+    result = run_flirt_job(flaky, slots, retries=1, backoff=0.0)
+    assert (result.status, result.attempts, result.returncode) == ("done", 2, 0)
+    assert (tmp_path / "in" / "flaky_MNI.nii.gz").read_bytes() == b"flaky.nii.gz"
+
+    result = run_flirt_job(busy, slots, retries=1, backoff=0.0, retry_exit_codes=(3,))
+    assert (result.status, result.attempts) == ("done", 2)
+
+    # A crash mid-write leaves no output to be skipped as done on the next run
+    result = run_flirt_job(crash, slots, retries=1, backoff=0.0)
+    assert (result.status, result.attempts, result.returncode) == ("failed", 2, -9)
+    assert sorted(os.listdir(tmp_path / "in")) == sorted(
+        ["busy.nii.gz", "busy_MNI.nii.gz", "crash.nii.gz", "flaky.nii.gz", "flaky_MNI.nii.gz", "slow.nii.gz"]
+    )
+
+    result = run_flirt_job(slow, slots, retries=0, timeout=1.0)
+    assert (result.status, result.message) == ("failed", "flirt timed out after 1.0s")
+
+
+def test_run_flirt_job_reports_deterministic_failures(tmp_path, monkeypatch):
+    state = make_stub(tmp_path, monkeypatch)
+    in_paths = make_inputs(tmp_path / "in", ["broken.nii.gz", "busy.nii.gz"])
+    broken, busy = build_jobs(in_paths, "ref.nii.gz")
+    slots = threading.BoundedSemaphore(1)
+
+    result = run_flirt_job(broken, slots, retries=2, backoff=0.0)
+    assert (result.status, result.attempts, result.returncode) == ("failed", 1, 1)
+    assert result.message == "ERROR: invalid image"
+
+    result = run_flirt_job(busy, slots, retries=2, backoff=0.0)
+    assert (result.status, result.attempts, result.returncode) == ("failed", 1, 3)
+    assert len((state / "calls.log").read_text().splitlines()) == 2
+
+    missing = run_flirt_job(FlirtJob(str(tmp_path / "none.nii.gz"), str(tmp_path / "o.nii.gz"), "ref"), slots)
+    assert (missing.status, missing.attempts) == ("failed", 0)
+
+    write_report([result, missing], str(tmp_path / "report.csv"))
+    assert (tmp_path / "report.csv").read_text().splitlines()[0].startswith("in_path,out_path,status")
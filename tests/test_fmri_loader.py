@@ -0,0 +1,18 @@
+import numpy as np
+
+from fmri_loader import SubjectRecord, _load_batch, compute_fisher_z
+
+
+def test_short_scan_connectivity_ignores_padding(tmp_path):
+    rng = np.random.default_rng(0)
+    data = 1000.0 + rng.standard_normal((150, 6))
+    path = tmp_path / "sub.dat"
+    np.savetxt(path, data, delimiter="\t")
+
+    batch = _load_batch([SubjectRecord("sub", str(path), 0)], seq_len=200, n_regions=6, seeds=[0])
+
+    assert np.all(batch["timeseries"][0, 150:] == 0)
+    expected = compute_fisher_z(data.astype(np.float32))
+    np.testing.assert_allclose(batch["connectivity"][0], expected, atol=1e-5)
+    off_diagonal = batch["connectivity"][0][~np.eye(6, dtype=bool)]
+    assert np.abs(off_diagonal).max() < 1.0
@@ -0,0 +1,52 @@
+import sys
+
+from pipeline import Stage, run_pipeline
+
+# Writes half its output, then exits 1 when the input holds 'crash'
+WRITE_OUTPUT = (
+    "import sys; data = open(sys.argv[1]).read(); out = open(sys.argv[2], 'w'); out.write(data[:2]); out.flush();"
+    "sys.exit(1) if 'crash' in data else out.write(data[2:])"
+)
+
+
+def make_stages():
+    return [
+        Stage(name="first", outputs=["{mid}"], command=[sys.executable, "-c", WRITE_OUTPUT, "{in_file}", "{mid}"]),
+        Stage(name="second", outputs=["{out}"], command=[sys.executable, "-c", WRITE_OUTPUT, "{mid}", "{out}"]),
+    ]
+
+
+def test_partial_output_is_not_complete(tmp_path):
+    subject = {
+        "subject_id": "sub1",
+        "in_file": str(tmp_path / "in.txt"),
+        "mid": str(tmp_path / "mid" / "sub1.txt"),
+        "out": str(tmp_path / "out" / "sub1.txt"),
+    }
+    (tmp_path / "in.txt").write_text("crash")
+
+    status = run_pipeline(make_stages(), [subject], num_workers=1)
+    assert status["sub1"]["first"].startswith("failed")
+    assert (tmp_path / "mid" / "sub1.txt").read_text() == "cr"
+    assert not make_stages()[0].is_complete(subject)
+
+    (tmp_path / "in.txt").write_text("fixed")
+    status = run_pipeline(make_stages(), [subject], num_workers=1)
+    assert status["sub1"] == {"first": "done", "second": "done"}
+    assert (tmp_path / "out" / "sub1.txt").read_text() == "fixed"
+
+    status = run_pipeline(make_stages(), [subject], num_workers=1)
+    assert status["sub1"] == {"first": "skipped", "second": "skipped"}
+
+
+def test_output_without_marker_is_redone(tmp_path):
+    subject = {"subject_id": "sub1", "in_file": str(tmp_path / "in.txt"),
+               "mid": str(tmp_path / "mid.txt"), "out": str(tmp_path / "out.txt")}
+    (tmp_path / "in.txt").write_text("value")
+    # Left by a job killed mid-write
+    (tmp_path / "mid.txt").write_text("va")
+
+    status = run_pipeline(make_stages(), [subject], num_workers=1)
+
+    assert status["sub1"] == {"first": "done", "second": "done"}
+    assert (tmp_path / "out.txt").read_text() == "value"